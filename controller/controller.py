@@ -2,10 +2,14 @@ import os
 import json
 import numpy as np
 import tifffile
-import cv2
-import csv
 
 from . import utilities
+from .mc_cache import MotionCorrectionCache
+from .roi_state import ROIState, roi_states_to_roi_data, roi_states_from_roi_data
+from .roi_export import export_rois
+from .roi_geometry import get_roi_centroids, get_roi_bounding_boxes
+from .lazy_video import open_video
+from .roi_store import ROIStore, ROI_DATA_FILENAME, is_roi_store, save_roi_groups
 
 # set default parameters dictionary
 DEFAULT_PARAMS = {'use_patches'          : True,
@@ -53,6 +57,12 @@ DEFAULT_PARAMS = {'use_patches'          : True,
                   'sc_use_nn'            : True,
                   'sc_threshold'         : 0,
                   'sc_sigma'             : 1,
+                  'parallel_planes'      : False,
+                  'max_workers'          : 0,
+                  'use_mc_cache'         : False,
+                  'mc_cache_max_size'    : 2,
+                  'mc_shifts_only'       : False,
+                  'export_formats'       : ['csv'],
                   }
 
 # set filename for saving current parameters
@@ -99,13 +109,19 @@ class Controller():
         self.roi_temporal_residuals  = {}
         self.bg_spatial_footprints   = {}
         self.bg_temporal_footprints  = {}
-        self.filtered_out_rois       = {}
         self.mask_points             = {}
+        self.roi_metrics             = {} # cached quality metrics of the ROIs in each group & plane
+        self.footprint_dims          = {} # (height, width) of the images that the footprints of each group are flattened from
 
     def reset_roi_filtering_variables(self):
-        self.manually_removed_rois = {}
-        self.all_removed_rois      = {}
-        self.locked_rois           = {}
+        self.roi_states = {} # kept/removed state of the ROIs in each group & plane
+
+    def reset_roi_states(self):
+        # start with all of the ROIs that were found being kept
+        self.roi_states = { group_num: [ ROIState(footprints.shape[-1]) for footprints in self.roi_spatial_footprints[group_num] ] for group_num in self.roi_spatial_footprints.keys() }
+
+    def roi_state(self, group_num, z):
+        return self.roi_states[group_num][z]
 
     def import_videos(self, video_paths):
         # add the new video paths to the currently loaded video paths
@@ -132,7 +148,56 @@ class Controller():
         # initialize mask points list
         self.mask_points[group_num] = [ [] for z in range(num_z) ]
 
+    def roi_dims(self, group_num):
+        # shape of the images that ROI footprints are flattened from (in C order) -- ROIs are found in videos with their
+        # spatial axes swapped and flattened in Fortran order, which is the same as C order over the original (height, width)
+        if group_num not in self.footprint_dims.keys():
+            video_shape = open_video(self.video_paths_in_group(self.video_paths, group_num)[0]).shape
+
+            self.footprint_dims[group_num] = (int(video_shape[2]), int(video_shape[3]))
+
+        return self.footprint_dims[group_num]
+
+    def update_footprint_dims(self):
+        # record the footprint dims of each group when its ROIs are found, so that they're saved along with them
+        self.footprint_dims = {}
+
+        for group_num in self.roi_spatial_footprints.keys():
+            self.roi_dims(group_num)
+
+    def roi_planes(self, group_num, video_path=None):
+        # get the ROI data of each plane in a group, only keeping the frames of one video if video_path is given
+        if video_path is not None:
+            group_indices = self.video_indices_in_group(self.video_paths, group_num)
+            group_lengths = [ self.video_lengths[i] for i in group_indices ]
+            group_paths   = [ self.video_paths[i] for i in group_indices ]
+
+            index = group_paths.index(video_path)
+
+            frames = slice(int(np.sum(group_lengths[:index])), int(np.sum(group_lengths[:index+1])))
+        else:
+            frames = slice(None)
+
+        dims = self.roi_dims(group_num)
+
+        planes = []
+        for z in range(len(self.roi_spatial_footprints[group_num])):
+            planes.append({'roi_spatial_footprints' : self.roi_spatial_footprints[group_num][z],
+                           'roi_temporal_footprints': self.roi_temporal_footprints[group_num][z][:, frames],
+                           'roi_temporal_residuals' : self.roi_temporal_residuals[group_num][z][:, frames],
+                           'bg_spatial_footprints'  : self.bg_spatial_footprints[group_num][z],
+                           'bg_temporal_footprints' : self.bg_temporal_footprints[group_num][z][:, frames],
+                           'roi_state'              : self.roi_states[group_num][z],
+                           'roi_centroids'          : get_roi_centroids(self.roi_spatial_footprints[group_num][z], dims),
+                           'roi_bounding_boxes'     : get_roi_bounding_boxes(self.roi_spatial_footprints[group_num][z], dims)})
+
+        return planes
+
     def save_rois(self, save_path, group_num=None, video_path=None):
+        if is_roi_store(save_path):
+            self.save_roi_store(save_path, group_num=group_num, video_path=video_path)
+            return
+
         if group_num is None:
             # set video paths
             if self.use_mc_video and len(self.mc_video_paths) > 0:
@@ -141,17 +206,21 @@ class Controller():
                 video_paths = self.video_paths
 
             # create a dictionary to hold the ROI data
-            roi_data = {'roi_spatial_footprints' : self.roi_spatial_footprints,
-                        'roi_temporal_footprints': self.roi_temporal_footprints,
-                        'roi_temporal_residuals' : self.roi_temporal_residuals,
-                        'bg_spatial_footprints'  : self.bg_spatial_footprints,
-                        'bg_temporal_footprints' : self.bg_temporal_footprints,
-                        'filtered_out_rois'      : self.filtered_out_rois,
-                        'manually_removed_rois'  : self.manually_removed_rois,
-                        'all_removed_rois'       : self.all_removed_rois,
-                        'locked_rois'            : self.locked_rois,
+            roi_data = {'roi_spatial_footprints' : { group_num: list(planes) for group_num, planes in self.roi_spatial_footprints.items() },
+                        'roi_temporal_footprints': { group_num: list(planes) for group_num, planes in self.roi_temporal_footprints.items() },
+                        'roi_temporal_residuals' : { group_num: list(planes) for group_num, planes in self.roi_temporal_residuals.items() },
+                        'bg_spatial_footprints'  : { group_num: list(planes) for group_num, planes in self.bg_spatial_footprints.items() },
+                        'bg_temporal_footprints' : { group_num: list(planes) for group_num, planes in self.bg_temporal_footprints.items() },
                         'video_paths'            : video_paths,
-                        'masks'                  : self.mask_points}
+                        'masks'                  : self.mask_points,
+                        'footprint_dims'         : { group_num: self.roi_dims(group_num) for group_num in self.roi_spatial_footprints.keys() }}
+
+            # add the ROI states of each group
+            for group_num in self.roi_states.keys():
+                for key, value in roi_states_to_roi_data(self.roi_states[group_num]).items():
+                    if key not in roi_data.keys():
+                        roi_data[key] = {}
+                    roi_data[key][group_num] = value
         else:
             group_indices = [ i for i in range(len(self.video_paths)) if self.video_groups[i] == group_num ]
             group_lengths = [ self.video_lengths[i] for i in group_indices ]
@@ -159,12 +228,8 @@ class Controller():
 
             index = group_paths.index(video_path)
 
-            roi_spatial_footprints = self.roi_spatial_footprints[group_num]
-            bg_spatial_footprints  = self.bg_spatial_footprints[group_num]
-            filtered_out_rois      = self.filtered_out_rois[group_num]
-            manually_removed_rois  = self.manually_removed_rois[group_num]
-            all_removed_rois       = self.all_removed_rois[group_num]
-            locked_rois            = self.locked_rois[group_num]
+            roi_spatial_footprints = list(self.roi_spatial_footprints[group_num])
+            bg_spatial_footprints  = list(self.bg_spatial_footprints[group_num])
             masks                  = self.mask_points[group_num]
             if index == 0:
                 roi_temporal_footprints = [ self.roi_temporal_footprints[group_num][z][:, :group_lengths[0]] for z in range(len(roi_spatial_footprints)) ]
@@ -180,122 +245,77 @@ class Controller():
                         'roi_temporal_residuals' : roi_temporal_residuals,
                         'bg_spatial_footprints'  : bg_spatial_footprints,
                         'bg_temporal_footprints' : bg_temporal_footprints,
-                        'filtered_out_rois'      : filtered_out_rois,
-                        'manually_removed_rois'  : manually_removed_rois,
-                        'all_removed_rois'       : all_removed_rois,
-                        'locked_rois'            : locked_rois,
                         'video_paths'            : [video_path],
-                        'masks'                  : masks}
+                        'masks'                  : masks,
+                        'footprint_dims'         : self.roi_dims(group_num)}
+
+            roi_data.update(roi_states_to_roi_data(self.roi_states[group_num]))
 
         # save the ROI data
         np.save(save_path, roi_data)
-    
-    def save_all_rois(self, save_directory):
-        # set video paths
-        if self.use_mc_video and len(self.mc_video_paths) > 0:
-            video_paths = self.mc_video_paths
+
+    def save_roi_store(self, save_path, group_num=None, video_path=None):
+        # save ROI data to an HDF5 file, replacing any groups that were saved there before
+        if group_num is None:
+            # set video paths
+            if self.use_mc_video and len(self.mc_video_paths) > 0:
+                video_paths = self.mc_video_paths
+            else:
+                video_paths = self.video_paths
+
+            groups = { group_num: (self.roi_planes(group_num), self.mask_points.get(group_num, []), self.roi_dims(group_num)) for group_num in self.roi_spatial_footprints.keys() }
         else:
-            video_paths = self.video_paths
-            
-        for i in range(len(video_paths)):
+            video_paths = [video_path]
+
+            groups = { group_num: (self.roi_planes(group_num, video_path=video_path), self.mask_points[group_num], self.roi_dims(group_num)) }
+
+        save_roi_groups(save_path, groups, video_paths=video_paths)
+    
+    def save_all_rois(self, save_directory, formats=None):
+        if formats is None:
+            formats = self.params['export_formats']
+
+        jobs = []
+
+        for i in range(len(self.video_paths)):
             video_path = self.video_paths[i]
 
             base_name      = os.path.basename(video_path)
             name           = os.path.splitext(base_name)[0]
-            directory      = os.path.dirname(video_path)
             video_dir_path = os.path.join(save_directory, name)
 
             # make a folder to hold the results
             if not os.path.exists(video_dir_path):
                 os.makedirs(video_dir_path)
 
-            video = tifffile.memmap(video_path)
-
-            if len(video.shape) == 3:
-                # add z dimension
-                video = video[:, np.newaxis, :, :]
-
             group_num = self.video_groups[i]
 
-            roi_spatial_footprints  = self.roi_spatial_footprints[group_num]
-            roi_temporal_footprints = self.roi_temporal_footprints[group_num]
-            roi_temporal_residuals  = self.roi_temporal_residuals[group_num]
-            bg_spatial_footprints   = self.bg_spatial_footprints[group_num]
-            bg_temporal_footprints  = self.bg_temporal_footprints[group_num]
-            
-            manually_removed_rois = self.manually_removed_rois[group_num]
-            all_removed_rois      = self.all_removed_rois[group_num]
-            locked_rois           = self.locked_rois[group_num]
-
-            # save centroids & traces
-            for z in range(video.shape[1]):
+            # get the traces & centroids of kept ROIs
+            planes = []
+            for z, plane in enumerate(self.roi_planes(group_num, video_path=video_path)):
                 print("Calculating ROI activities for z={}...".format(z))
 
-                centroids = np.zeros((roi_spatial_footprints[z].shape[-1], 2))
-                kept_rois = [ roi for roi in range(roi_spatial_footprints[z].shape[-1]) if (roi not in all_removed_rois[z]) or (roi in locked_rois[z]) ]
-
-                footprints_2d = roi_spatial_footprints[z].toarray().reshape((video.shape[2], video.shape[3], roi_spatial_footprints[z].shape[-1]))
-
-                for roi in kept_rois:
-                    footprint_2d = footprints_2d[:, :, roi]
+                kept_rois = plane['roi_state'].kept_rois()
 
-                    mask = footprint_2d > 0
+                planes.append({'rois'     : kept_rois,
+                               'traces'   : plane['roi_temporal_footprints'][kept_rois],
+                               'centroids': plane['roi_centroids'][kept_rois]})
 
-                    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            jobs.append((video_dir_path, planes, formats))
 
-                    if len(contours) > 0:
-                        contour = contours[0]
+            # save ROIs
+            self.save_rois(os.path.join(video_dir_path, ROI_DATA_FILENAME), group_num=group_num, video_path=video_path)
 
-                        M = cv2.moments(contour)
-                        if M["m00"] > 0:
-                            center_x = int(M["m10"] / M["m00"])
-                            center_y = int(M["m01"] / M["m00"])
-                        else:
-                            center_x = 0
-                            center_y = 0
+        # save centroids & traces
+        export_rois(jobs, use_multiprocessing=self.use_multiprocessing, max_workers=self.params['max_workers'])
 
-                        centroids[roi] = [center_x, center_y]
-
-                temporal_footprints = roi_temporal_footprints[z]
-
-                group_indices = [ i for i in range(len(self.video_paths)) if self.video_groups[i] == group_num ]
-                group_paths   = [ self.video_paths[i] for i in group_indices ]
-                group_lengths = [ self.video_lengths[i] for i in group_indices ]
-                
-                index = group_paths.index(video_path)
-
-                if index == 0:
-                    temporal_footprints = temporal_footprints[:, :group_lengths[0]]
-                else:
-                    temporal_footprints = temporal_footprints[:, np.sum(group_lengths[:index]):np.sum(group_lengths[:index+1])]
-
-                traces = temporal_footprints[kept_rois]
-                centroids = centroids[kept_rois]
-
-                print("Saving CSV for z={}...".format(z))
-
-                with open(os.path.join(video_dir_path, 'z_{}_traces.csv'.format(z)), 'w') as file:
-                    writer = csv.writer(file)
-
-                    writer.writerow(['ROI #'] + [ "Frame {}".format(frame) for frame in range(traces.shape[1]) ])
-
-                    for j in range(traces.shape[0]):
-                        writer.writerow(['{}'.format(kept_rois[j])] + traces[j].tolist())
-
-                with open(os.path.join(video_dir_path, 'z_{}_centroids.csv'.format(z)), 'w') as file:
-                    writer = csv.writer(file)
-
-                    writer.writerow(['Label', 'X', 'Y'])
-
-                    for j in range(centroids.shape[0]):
-                        writer.writerow(["ROI #{}".format(kept_rois[j]+1)] + centroids[j].tolist())
-
-                # save ROIs
-                self.save_rois(os.path.join(video_dir_path, 'roi_data.npy'), group_num=group_num, video_path=video_path)
-
-                print("Done.")
+        print("Done.")
 
     def load_rois(self, load_path, group_num=None, video_path=None):
+        if is_roi_store(load_path):
+            self.load_roi_store(load_path, group_num=group_num)
+            return
+
         # load the saved ROIs
         roi_data = np.load(load_path, allow_pickle=True)
 
@@ -309,16 +329,8 @@ class Controller():
             self.roi_temporal_residuals  = roi_data['roi_temporal_residuals']
             self.bg_spatial_footprints   = roi_data['bg_spatial_footprints']
             self.bg_temporal_footprints  = roi_data['bg_temporal_footprints']
-            self.filtered_out_rois       = roi_data['filtered_out_rois']
-            if 'manually_removed_rois' in roi_data.keys():
-                self.manually_removed_rois = roi_data['manually_removed_rois']
-            else:
-                self.manually_removed_rois = roi_data['discarded_rois']
-            if 'all_removed_rois' in roi_data.keys():
-                self.all_removed_rois = roi_data['all_removed_rois']
-            else:
-                self.all_removed_rois = roi_data['removed_rois']
-            self.locked_rois = roi_data['locked_rois']
+            self.roi_states              = { group_num: roi_states_from_roi_data(roi_data, self.roi_spatial_footprints[group_num], group_num=group_num) for group_num in self.roi_spatial_footprints.keys() }
+            self.footprint_dims          = roi_data.get('footprint_dims', {})
             if 'masks' in roi_data.keys():
                 self.mask_points = roi_data['masks']
             else:
@@ -339,16 +351,7 @@ class Controller():
             roi_temporal_residuals  = roi_data['roi_temporal_residuals']
             bg_spatial_footprints   = roi_data['bg_spatial_footprints']
             bg_temporal_footprints  = roi_data['bg_temporal_footprints']
-            filtered_out_rois       = roi_data['filtered_out_rois']
-            if 'manually_removed_rois' in roi_data.keys():
-                manually_removed_rois = roi_data['manually_removed_rois']
-            else:
-                manually_removed_rois = roi_data['discarded_rois']
-            if 'all_removed_rois' in roi_data.keys():
-                all_removed_rois = roi_data['all_removed_rois']
-            else:
-                all_removed_rois = roi_data['removed_rois']
-            locked_rois = roi_data['locked_rois']
+            roi_states              = roi_states_from_roi_data(roi_data, roi_spatial_footprints)
             if 'masks' in roi_data.keys():
                 masks = roi_data['masks']
             else:
@@ -364,17 +367,50 @@ class Controller():
 
             self.roi_spatial_footprints[group_num]  = roi_spatial_footprints
             self.bg_spatial_footprints[group_num]   = bg_spatial_footprints
-            self.filtered_out_rois[group_num]       = filtered_out_rois
-            self.manually_removed_rois[group_num]   = manually_removed_rois
-            self.all_removed_rois[group_num]        = all_removed_rois
-            self.locked_rois[group_num]             = locked_rois
+            self.roi_states[group_num]              = roi_states
             self.mask_points[group_num]             = masks
             self.roi_temporal_footprints[group_num] = roi_temporal_footprints
             self.roi_temporal_residuals[group_num]  = roi_temporal_residuals
             self.bg_temporal_footprints[group_num]  = bg_temporal_footprints
 
+            if 'footprint_dims' in roi_data.keys():
+                self.footprint_dims[group_num] = roi_data['footprint_dims']
+            else:
+                self.footprint_dims.pop(group_num, None)
+
         self.find_new_rois = False
 
+    def load_roi_store(self, load_path, group_num=None):
+        # open an HDF5 file of ROI data -- planes are only read from disk when they are first used
+        store = ROIStore(load_path)
+
+        if group_num is None:
+            self.reset_roi_finding_variables()
+            self.reset_roi_filtering_variables()
+
+            group_nums = [ (stored_group_num, stored_group_num) for stored_group_num in store.group_nums() ]
+        else:
+            # a file saved for a single video holds one group, which is loaded into the given group
+            group_nums = [ (store.group_nums()[0], group_num) ]
+
+        for stored_group_num, group_num in group_nums:
+            self.roi_spatial_footprints[group_num]  = store.planes(stored_group_num, 'roi_spatial_footprints')
+            self.roi_temporal_footprints[group_num] = store.planes(stored_group_num, 'roi_temporal_footprints')
+            self.roi_temporal_residuals[group_num]  = store.planes(stored_group_num, 'roi_temporal_residuals')
+            self.bg_spatial_footprints[group_num]   = store.planes(stored_group_num, 'bg_spatial_footprints')
+            self.bg_temporal_footprints[group_num]  = store.planes(stored_group_num, 'bg_temporal_footprints')
+            self.roi_states[group_num]              = store.planes(stored_group_num, 'roi_state')
+
+            if stored_group_num in store.dims.keys():
+                self.footprint_dims[group_num] = store.dims[stored_group_num]
+            else:
+                self.footprint_dims.pop(group_num, None)
+
+            if len(store.masks[stored_group_num]) > 0:
+                self.mask_points[group_num] = store.masks[stored_group_num]
+            else:
+                self.mask_points[group_num] = [ [] for z in range(store.n_planes[stored_group_num]) ]
+
     def remove_videos_at_indices(self, indices):
         # sort the indices in increasing order
         indices = sorted(indices)
@@ -418,6 +454,11 @@ class Controller():
             self.mask_points[group_num] = [ [] for z in range(num_z) ]
 
     def remove_group(self, group, remove_videos=True):
+        # remove memmaps that were kept after finding ROIs in this group
+        utilities.remove_plane_memmaps(self.video_paths_in_group(self.video_paths, group))
+        if len(self.mc_video_paths) > 0:
+            utilities.remove_plane_memmaps(self.video_paths_in_group(self.mc_video_paths, group))
+
         if group in self.mc_borders.keys():
             del self.mc_borders[group]
         if group in self.roi_spatial_footprints.keys():
@@ -430,16 +471,12 @@ class Controller():
             del self.bg_spatial_footprints[group]
         if group in self.bg_temporal_footprints.keys():
             del self.bg_temporal_footprints[group]
-        if group in self.filtered_out_rois.keys():
-            del self.filtered_out_rois[group]
+        if group in self.roi_states.keys():
+            del self.roi_states[group]
+        if group in self.roi_metrics.keys():
+            del self.roi_metrics[group]
         if group in self.mask_points.keys():
             del self.mask_points[group]
-        if group in self.manually_removed_rois.keys():
-            del self.manually_removed_rois[group]
-        if group in self.all_removed_rois.keys():
-            del self.all_removed_rois[group]
-        if group in self.locked_rois.keys():
-            del self.locked_rois[group]
 
         if remove_videos:
 	        video_indices = self.video_indices_in_group(self.video_paths, group)
@@ -452,20 +489,15 @@ class Controller():
     def video_indices_in_group(self, video_paths, group_num):
         return [ i for i in range(len(video_paths)) if self.video_groups[i] == group_num ]
 
+    def get_mc_cache(self):
+        # create the motion correction cache, if it's being used
+        if self.params['use_mc_cache']:
+            return MotionCorrectionCache(max_size=self.params['mc_cache_max_size'])
+        else:
+            return None
+
     def motion_correct(self):
-        mc_videos, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.video_groups, self.params['max_shift'], self.params['patch_stride'], self.params['patch_overlap'], use_multiprocessing=self.use_multiprocessing)
-
-        mc_video_paths = []
-        for i in range(len(mc_videos)):
-            video_path    = self.video_paths[i]
-            directory     = os.path.dirname(video_path)
-            filename      = os.path.basename(video_path)
-            mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
-            
-            # save the motion-corrected video
-            tifffile.imsave(mc_video_path, mc_videos[i])
-            
-            mc_video_paths.append(mc_video_path)
+        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.video_groups, self.params['max_shift'], self.params['patch_stride'], self.params['patch_overlap'], use_multiprocessing=self.use_multiprocessing, parallel_planes=self.params['parallel_planes'], max_workers=self.params['max_workers'], mc_cache=self.get_mc_cache(), shifts_only=self.params['mc_shifts_only'])
 
         self.mc_video_paths = mc_video_paths
         self.mc_borders     = mc_borders
@@ -487,10 +519,8 @@ class Controller():
         self.bg_spatial_footprints   = bg_spatial_footprints
         self.bg_temporal_footprints  = bg_temporal_footprints
 
-        self.filtered_out_rois     = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.manually_removed_rois = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.all_removed_rois      = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.locked_rois           = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
+        self.update_footprint_dims()
+        self.reset_roi_states()
 
     def filter_rois(self, mean_images, group_num):
         # set video paths
@@ -502,39 +532,36 @@ class Controller():
         # only use videos in the given group
         video_paths = self.video_paths_in_group(video_paths, group_num)
 
-        # filter out ROIs and update the removed ROIs
-        self.filtered_out_rois[group_num] = utilities.filter_rois(video_paths, self.roi_spatial_footprints[group_num], self.roi_temporal_footprints[group_num], self.roi_temporal_residuals[group_num], self.bg_spatial_footprints[group_num], self.bg_temporal_footprints[group_num], mean_images, self.params)
-        
-        # keep locked ROIs
-        for z in range(len(self.filtered_out_rois[group_num])):
-            self.manually_removed_rois[group_num][z] = []
-            self.filtered_out_rois[group_num][z] = [ roi for roi in self.filtered_out_rois[group_num][z] if roi not in self.locked_rois[group_num][z] ]
-            self.all_removed_rois[group_num][z]      = self.filtered_out_rois[group_num][z] + self.manually_removed_rois[group_num][z]
+        # compute the ROI quality metrics, reusing cached metrics of planes whose footprints haven't changed
+        self.roi_metrics[group_num] = utilities.compute_roi_metrics(video_paths, self.roi_spatial_footprints[group_num], self.roi_temporal_footprints[group_num], self.roi_temporal_residuals[group_num], self.bg_spatial_footprints[group_num], self.bg_temporal_footprints[group_num], mean_images, self.params, roi_metrics=self.roi_metrics.get(group_num))
 
-    def discard_roi(self, roi, z, group_num):
-        # add to discarded ROIs list
-        self.manually_removed_rois[group_num][z].append(roi)
-        self.all_removed_rois[group_num][z] = self.filtered_out_rois[group_num][z] + self.manually_removed_rois[group_num][z]
+        self.apply_roi_filters(group_num)
+
+    def has_roi_metrics(self, group_num):
+        # check whether the cached metrics of every plane are up to date with the current footprints
+        if group_num not in self.roi_metrics.keys():
+            return False
 
-        # remove from locked ROIs if it's there
-        if roi in self.locked_rois[group_num][z]:
-            i = self.locked_rois[group_num][z].index(roi)
-            del self.locked_rois[group_num][z][i]
+        roi_spatial_footprints = self.roi_spatial_footprints[group_num]
+
+        return len(self.roi_metrics[group_num]) == len(roi_spatial_footprints) and all([ utilities.roi_metrics_valid(self.roi_metrics[group_num][z], roi_spatial_footprints[z], self.params) for z in range(len(roi_spatial_footprints)) ])
+
+    def apply_roi_filters(self, group_num):
+        # filter out ROIs using the cached metrics
+        filtered_out_rois = utilities.apply_roi_filters(self.roi_metrics[group_num], self.params)
+
+        # update the removed ROIs, keeping locked ROIs
+        for z in range(len(filtered_out_rois)):
+            self.roi_states[group_num][z].clear_manually_removed()
+            self.roi_states[group_num][z].set_filtered_out(filtered_out_rois[z])
+
+    def discard_roi(self, roi, z, group_num):
+        # add to discarded ROIs, and remove from locked ROIs if it's there
+        self.roi_states[group_num][z].discard([roi])
 
     def keep_roi(self, roi, z, group_num):
-        # remove from discared ROIs or filtered out ROIs list if it's there
-        if roi in self.manually_removed_rois[group_num][z]:
-            i = self.manually_removed_rois[group_num][z].index(roi)
-            del self.manually_removed_rois[group_num][z][i]
-        elif roi in self.filtered_out_rois[group_num][z]:
-            i = self.filtered_out_rois[group_num][z].index(roi)
-            del self.filtered_out_rois[group_num][z][i]
-
-        # add to locked ROIs list
-        if roi not in self.locked_rois[group_num][z]:
-            self.locked_rois[group_num][z].append(roi)
-
-        self.all_removed_rois[group_num][z] = self.filtered_out_rois[group_num][z] + self.manually_removed_rois[group_num][z]
+        # remove from discarded & filtered out ROIs, and add to locked ROIs
+        self.roi_states[group_num][z].keep([roi])
 
     def add_mask(self, mask_points, z, num_z, group_num):
         if len(mask_points) >= 3:
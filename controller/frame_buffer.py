@@ -0,0 +1,158 @@
+import time
+import threading
+import collections
+
+# number of ready-to-display frames that are read ahead of the one being shown
+FRAME_BUFFER_SIZE = 32
+
+# period of time (in seconds) over which the achieved frame rate is measured
+FPS_WINDOW = 1.0
+
+class FrameRingBuffer():
+    '''
+    A bounded buffer of upcoming frames, filled by a reading thread and emptied by the GUI.
+
+    Frames are identified by a playback position that keeps increasing as the video loops
+    (the frame number is the position modulo the number of frames). The reader blocks when
+    the buffer is full, but the GUI never waits: when it asks for a position that isn't ready
+    it gets nothing, and any older frames are dropped so that the reader skips ahead.
+
+    Each reset gives the buffer a source -- whatever the reader needs to read frames, captured
+    by the GUI thread -- so that the reader never touches state that the GUI may be changing.
+    The reader waits while there is no source.
+    '''
+
+    def __init__(self, capacity=FRAME_BUFFER_SIZE):
+        self.capacity  = capacity
+        self.frames    = collections.deque()
+        self.condition = threading.Condition()
+
+        self.generation    = 0     # increased whenever the buffered frames become stale
+        self.next_position = 0     # next position to be read
+        self.last_taken    = -1    # last position that the GUI asked for
+        self.lead          = 1     # how far ahead of playback the reader skips to when it falls behind
+        self.n_frames      = 1
+        self.source        = None  # what frames of the current generation are read from
+        self.stopped       = False
+
+        self.n_shown   = 0
+        self.n_dropped = 0
+
+    def reset(self, position, n_frames=None, source=None):
+        '''Discards any buffered frames and starts reading from a new position and source.'''
+
+        with self.condition:
+            self.generation   += 1
+            self.next_position = position
+            self.last_taken    = position - 1
+            self.lead          = 1
+
+            self.source        = source
+
+            if n_frames is not None:
+                self.n_frames = max(1, n_frames)
+
+            self.frames.clear()
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.frames.clear()
+            self.condition.notify_all()
+
+    def next_request(self):
+        '''
+        Waits until there is a source and room in the buffer, and returns the (generation, position,
+        frame number, source) that should be read next, or None if the buffer has been stopped.
+        '''
+
+        with self.condition:
+            while not self.stopped and (self.source is None or len(self.frames) >= self.capacity):
+                self.condition.wait()
+
+            if self.stopped:
+                return None
+
+            position = self.next_position
+            self.next_position += 1
+
+            return self.generation, position, position % self.n_frames, self.source
+
+    def put(self, generation, position, image):
+        with self.condition:
+            # drop frames that were read before a reset, or that the GUI has already skipped past
+            if generation != self.generation or position <= self.last_taken:
+                return
+
+            self.frames.append((position, image))
+
+    def take(self, position):
+        '''
+        Returns the frame at a playback position, or None if it hasn't been read yet. Older frames
+        are dropped, and if the reader has fallen behind it is moved ahead to this position.
+        '''
+
+        with self.condition:
+            self.last_taken = max(self.last_taken, position)
+
+            while len(self.frames) > 0 and self.frames[0][0] < position:
+                self.frames.popleft()
+                self.n_dropped += 1
+
+            if len(self.frames) > 0 and self.frames[0][0] == position:
+                image = self.frames.popleft()[1]
+                self.n_shown += 1
+            else:
+                image = None
+                self.n_dropped += 1
+
+                if self.next_position <= position:
+                    # skip ahead so that the reader catches up with playback, going further
+                    # ahead each time it falls behind again
+                    self.next_position = position + self.lead
+                    self.lead          = min(2*self.lead, self.capacity)
+
+            self.condition.notify_all()
+
+            return image
+
+class PlaybackClock():
+    '''
+    Maps the time since playback started to a playback position at the requested frame rate,
+    and measures the rate at which frames are actually shown.
+    '''
+
+    def __init__(self, fps):
+        self.start(fps)
+
+    def start(self, fps, position=0):
+        self.fps            = float(fps)
+        self.start_time     = time.perf_counter()
+        self.start_position = position
+        self.shown_times    = collections.deque()
+
+    def position(self):
+        return self.start_position + int((time.perf_counter() - self.start_time)*self.fps)
+
+    def set_fps(self, fps):
+        # keep the current position when the frame rate changes
+        position = self.position()
+
+        self.fps            = float(fps)
+        self.start_time     = time.perf_counter()
+        self.start_position = position
+
+    def frame_shown(self):
+        now = time.perf_counter()
+
+        self.shown_times.append(now)
+
+        while now - self.shown_times[0] > FPS_WINDOW:
+            self.shown_times.popleft()
+
+    def achieved_fps(self):
+        if len(self.shown_times) < 2:
+            return 0.0
+
+        return (len(self.shown_times) - 1)/max(1e-6, self.shown_times[-1] - self.shown_times[0])
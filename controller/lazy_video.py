@@ -0,0 +1,503 @@
+import abc
+import copy
+import threading
+import collections
+import numpy as np
+import tifffile
+import cv2
+
+# suffix of the files that hold the motion correction shifts of a video, in place of a motion-corrected video
+MC_SHIFTS_SUFFIX = "_mc_shifts.npz"
+
+# maximum number of bytes of recently viewed planes that a PlaneVideo keeps in memory
+PLANE_CACHE_BYTES = 1024*1024*1024
+
+def open_video(video_path):
+    '''
+    Opens a TIFF video as a read-only memory map of shape (frames, z planes, height, width).
+
+    Videos without a z dimension are given one. Opening the file read-only means that
+    callers can never accidentally write back into the original video. Motion correction
+    shift files are opened as a ShiftCorrectedVideo.
+    '''
+
+    if video_path.endswith(MC_SHIFTS_SUFFIX):
+        return ShiftCorrectedVideo(video_path)
+
+    video = tifffile.memmap(video_path, mode='r')
+
+    if len(video.shape) == 3:
+        # add a z dimension
+        video = video[:, np.newaxis, :, :]
+    elif len(video.shape) == 5:
+        # merge the two leading dimensions into a single frame dimension
+        video = video.reshape((video.shape[0]*video.shape[1],) + video.shape[2:])
+
+    return video
+
+def open_video_or_pages(video_path):
+    '''
+    Opens a video that is going to be read through once (eg. to compute its statistics). Videos
+    are memory-mapped where possible, while compressed TIFFs, which can't be memory-mapped, are
+    opened as a PlaneVideo that decodes pages as they are read without keeping them in memory.
+    '''
+
+    try:
+        return open_video(video_path)
+    except ValueError:
+        return PlaneVideo(video_path, cache_bytes=0)
+
+def frames_for_key(key, n_frames):
+    '''Returns the array of frame indices selected by an integer, slice or index array.'''
+    return np.arange(n_frames)[key]
+
+class LazyVideo(abc.ABC):
+    '''
+    Base class for read-only 4D videos (frames, z planes, height, width) that are only
+    read from disk when they are indexed.
+
+    Subclasses implement read_frames(), which returns the requested frames and z planes
+    in the orientation in which they are stored on disk. Indexing supports integers,
+    slices and index arrays along the frame and z axes, and basic slicing along the two
+    spatial axes.
+    '''
+
+    def __init__(self, file_shape, dtype):
+        self.file_shape = tuple(file_shape) # shape of the video as stored on disk
+        self.dtype      = np.dtype(dtype)
+        self.flipped    = False             # whether the last two axes are swapped
+        self.masks      = None              # optional (z, height, width) boolean array of pixels to zero out
+
+    @property
+    def shape(self):
+        if self.flipped:
+            return self.file_shape[:2] + self.file_shape[2:][::-1]
+        else:
+            return self.file_shape
+
+    @property
+    def ndim(self):
+        return len(self.file_shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def transpose(self, axes):
+        if tuple(axes) != (0, 1, 3, 2):
+            raise ValueError("Lazy videos only support swapping their two spatial axes.")
+
+        video = copy.copy(self)
+        video.flipped = not self.flipped
+
+        return video
+
+    def set_masks(self, masks):
+        '''Sets a (z, height, width) boolean array of pixels that read frames will have zeroed out.'''
+        self.masks = masks
+
+    @abc.abstractmethod
+    def read_frames(self, frames, z_planes):
+        '''Returns an array of the given frames and z planes, with shape (frames, z planes, *file_shape[2:]).'''
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > 4:
+            raise IndexError("Too many indices for a 4D video.")
+
+        key = key + (slice(None),)*(4 - len(key))
+
+        t_key, z_key, y_key, x_key = key
+
+        frames   = np.atleast_1d(frames_for_key(t_key, self.shape[0]))
+        z_planes = np.atleast_1d(frames_for_key(z_key, self.shape[1]))
+
+        data = self.read_frames(frames, z_planes)
+
+        if self.flipped:
+            data = data.transpose((0, 1, 3, 2))
+
+        if self.masks is not None:
+            data = np.array(data)
+            data[:, self.masks[z_planes]] = 0
+
+        data = data[:, :, y_key, x_key]
+
+        # drop the frame & z axes if they were indexed with integers
+        index = (0 if np.ndim(t_key) == 0 and not isinstance(t_key, slice) else slice(None),
+                 0 if np.ndim(z_key) == 0 and not isinstance(z_key, slice) else slice(None))
+
+        return data[index]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+
+        if dtype is not None:
+            data = data.astype(dtype)
+
+        return data
+
+    def iter_chunks(self, z, frames=None, chunk_size=100):
+        '''
+        Yields (start, chunk) pairs covering the given frames (default: all frames) of
+        plane z, where start is the position of the chunk within the requested frames
+        and chunk has shape (frames, height, width).
+        '''
+
+        if frames is None:
+            frames = np.arange(self.shape[0])
+
+        for start in range(0, len(frames), chunk_size):
+            yield start, self[frames[start:start+chunk_size], z]
+
+class GroupVideo(LazyVideo):
+    '''
+    A virtual concatenation (along the frame axis) of all of the videos in a group.
+
+    No data is copied -- each of the videos is memory-mapped read-only and frames are
+    read from whichever video they belong to when the group video is indexed.
+    '''
+
+    def __init__(self, video_paths):
+        self.video_paths = list(video_paths)
+
+        self.open()
+
+        video_shapes = [ video.shape for video in self.videos ]
+
+        for video_shape in video_shapes[1:]:
+            if video_shape[1:] != video_shapes[0][1:]:
+                raise ValueError("All videos in a group must have the same number of z planes and frame size.")
+
+        self.video_lengths = [ video_shape[0] for video_shape in video_shapes ]
+        self.offsets       = np.concatenate([[0], np.cumsum(self.video_lengths)]).astype(int)
+
+        LazyVideo.__init__(self, (int(self.offsets[-1]),) + video_shapes[0][1:], self.videos[0].dtype)
+
+    def open(self):
+        self.videos = [ open_video(video_path) for video_path in self.video_paths ]
+
+    def close(self):
+        self.videos = []
+
+    def __getstate__(self):
+        # don't pickle the memory maps -- they are re-opened when unpickling
+        state = self.__dict__.copy()
+        state['videos'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def read_frames(self, frames, z_planes):
+        data = np.zeros((len(frames), len(z_planes)) + self.file_shape[2:], dtype=self.dtype)
+
+        # figure out which video each frame belongs to
+        video_indices = np.searchsorted(self.offsets[1:], frames, side='right')
+
+        for i in np.unique(video_indices):
+            positions    = np.nonzero(video_indices == i)[0]
+            local_frames = frames[positions] - self.offsets[i]
+
+            if isinstance(self.videos[i], LazyVideo):
+                data[positions] = self.videos[i].read_frames(local_frames, z_planes)
+            else:
+                data[positions] = self.videos[i][local_frames[:, np.newaxis], z_planes[np.newaxis, :]]
+
+        return data
+
+class PlaneCache():
+    '''
+    The frames of the most recently used planes of a video, up to cache_bytes. Frames are only
+    read (by the function given to read()) the first time they are requested, and memory is
+    only used by the frames that have actually been read.
+    '''
+
+    def __init__(self, n_frames, frame_shape, dtype, cache_bytes=PLANE_CACHE_BYTES):
+        self.n_frames    = n_frames
+        self.frame_shape = tuple(frame_shape)
+        self.dtype       = np.dtype(dtype)
+        self.cache_bytes = cache_bytes
+
+        self.lock   = threading.Lock()
+        self.planes = collections.OrderedDict() # z -> (frames of the plane, whether each frame has been read)
+
+    def plane(self, z):
+        if z in self.planes.keys():
+            self.planes.move_to_end(z)
+        else:
+            self.planes[z] = (np.empty((self.n_frames,) + self.frame_shape, dtype=self.dtype), np.zeros(self.n_frames, dtype=bool))
+
+            # forget the least recently used planes, keeping at least this one
+            plane_bytes = self.planes[z][0].nbytes
+            while len(self.planes) > 1 and len(self.planes)*plane_bytes > self.cache_bytes:
+                self.planes.popitem(last=False)
+
+        return self.planes[z]
+
+    def read(self, frames, z, read_frames):
+        '''Returns the given frames of plane z, calling read_frames(frames, z) for any that haven't been read yet.'''
+
+        # frames may be read by the GUI and a playback thread at the same time
+        with self.lock:
+            plane, loaded = self.plane(z)
+
+            missing = np.unique(frames[~loaded[frames]])
+
+            if len(missing) > 0:
+                plane[missing]  = read_frames(missing, z)
+                loaded[missing] = True
+
+            return plane[frames]
+
+class PlaneVideo(LazyVideo):
+    '''
+    A TIFF video that is read one z plane at a time, for previewing.
+
+    Frames are read from the pages of the requested plane only, rather than striding across
+    every plane of the movie. The frames that have been read are kept for the planes that were
+    viewed most recently (up to cache_bytes), so switching back to a plane doesn't read it again;
+    if cache_bytes is 0, nothing is kept. Compressed TIFFs, which can't be memory-mapped, are read
+    page by page.
+    '''
+
+    def __init__(self, video_path, cache_bytes=PLANE_CACHE_BYTES):
+        self.video_path  = video_path
+        self.cache_bytes = cache_bytes
+
+        self.open()
+
+        LazyVideo.__init__(self, self.source_shape, self.source_dtype)
+
+    def open(self):
+        try:
+            self.video = open_video(self.video_path)
+            self.tiff  = None
+
+            self.source_shape = self.video.shape
+            self.source_dtype = self.video.dtype
+        except ValueError:
+            # the file can't be memory-mapped, so pages are decoded as they are needed
+            self.video = None
+            self.tiff  = tifffile.TiffFile(self.video_path)
+
+            series = self.tiff.series[0]
+            shape  = tuple(series.shape)
+
+            if len(shape) == 3:
+                shape = (shape[0], 1) + shape[1:]
+
+            self.source_shape = shape
+            self.source_dtype = series.dtype
+
+        if self.cache_bytes > 0:
+            self.cache = PlaneCache(self.source_shape[0], self.source_shape[2:], self.source_dtype, self.cache_bytes)
+        else:
+            self.cache = None
+
+    def close(self):
+        if self.tiff is not None:
+            self.tiff.close()
+
+        self.video = None
+        self.tiff  = None
+        self.cache = None
+
+    def __getstate__(self):
+        # don't pickle the memory map, open file or cached planes -- they are re-opened when unpickling
+        state = self.__dict__.copy()
+        state['video'] = None
+        state['tiff']  = None
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def read_pages(self, frames, z):
+        if self.video is not None:
+            return self.video[frames, z]
+        else:
+            # pages of a z stack are stored frame by frame
+            return np.stack([ self.tiff.pages[int(frame)*self.file_shape[1] + int(z)].asarray() for frame in frames ])
+
+    def read_frames(self, frames, z_planes):
+        data = np.zeros((len(frames), len(z_planes)) + self.file_shape[2:], dtype=self.dtype)
+
+        for j in range(len(z_planes)):
+            if self.cache is not None:
+                data[:, j] = self.cache.read(frames, int(z_planes[j]), self.read_pages)
+            else:
+                data[:, j] = self.read_pages(frames, int(z_planes[j]))
+
+        return data
+
+class ShiftCorrectedVideo(LazyVideo):
+    '''
+    A motion-corrected video that is never saved to disk.
+
+    Only the piecewise rigid shifts of each frame are stored (along with the border & minimum
+    of each plane). Frames of the original video are warped with them, one at a time in Python,
+    the first time they are read -- this costs about as much as motion correcting the frames
+    again, so warped frames of the most recently used planes are kept (up to cache_bytes).
+
+    The frames have the same warp & border as a saved motion-corrected video, but the minimum
+    of the raw video (not of the warped frames) is subtracted, so pixel values can be offset
+    slightly from it.
+    '''
+
+    def __init__(self, shifts_path, cache_bytes=PLANE_CACHE_BYTES):
+        self.shifts_path = shifts_path
+        self.cache_bytes = cache_bytes
+
+        self.open()
+
+        LazyVideo.__init__(self, self.video.shape, self.video.dtype)
+
+    def open(self):
+        with np.load(self.shifts_path) as data:
+            self.shifts = { name: data[name] for name in data.files }
+
+        self.video = open_video(str(self.shifts['video_path']))
+        self.cache = PlaneCache(self.video.shape[0], self.video.shape[2:], self.video.dtype, self.cache_bytes)
+
+    def close(self):
+        self.video  = None
+        self.shifts = None
+        self.cache  = None
+
+    def __getstate__(self):
+        # don't pickle the memory map, shifts or warped frames -- they are re-opened when unpickling
+        state = self.__dict__.copy()
+        state['video']  = None
+        state['shifts'] = None
+        state['cache']  = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def warp_frames(self, frames, z):
+        raw_frames = self.video[frames, z]
+
+        grid_shape = tuple(self.shifts['grid_shape'])
+
+        corrected = np.zeros(raw_frames.shape, dtype=np.float32)
+
+        for k in range(len(frames)):
+            # shifts were estimated on frames flipped 90 degrees
+            corrected[k] = apply_pw_rigid_shifts(raw_frames[k].T, self.shifts['x_shifts_els'][z, frames[k]], self.shifts['y_shifts_els'][z, frames[k]], grid_shape).T
+
+        corrected = apply_border(np.maximum(corrected - self.shifts['min_value'][z], 0), int(self.shifts['border'][z]))
+
+        return corrected.astype(self.dtype)
+
+    def read_frames(self, frames, z_planes):
+        data = np.zeros((len(frames), len(z_planes)) + self.file_shape[2:], dtype=self.dtype)
+
+        for j in range(len(z_planes)):
+            data[:, j] = self.cache.read(frames, int(z_planes[j]), self.warp_frames)
+
+        return data
+
+def save_plane_tiff(video, z, save_path, frames=None, dtype=None, chunk_size=100):
+    '''Writes the given frames (default: all frames) of plane z of a video to a TIFF, one chunk at a time.'''
+
+    if frames is None:
+        frames = np.arange(video.shape[0])
+
+    if dtype is None:
+        dtype = video.dtype
+
+    plane = tifffile.memmap(save_path, shape=(len(frames),) + tuple(video.shape[2:]), dtype=dtype)
+
+    for start, chunk in video.iter_chunks(z, frames=frames, chunk_size=chunk_size):
+        plane[start:start+chunk.shape[0]] = chunk
+
+    plane.flush()
+    del plane
+
+    return save_path
+
+def plane_memmap_name(base_name, dims, n_frames):
+    '''Returns the filename that CaImAn gives a C-order memmap of a single plane.'''
+    return "{}_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap".format(base_name, dims[0], dims[1], n_frames)
+
+def save_plane_memmap(video, z, base_name, frames=None, chunk_size=100):
+    '''
+    Writes the given frames (default: all frames) of plane z of a video directly to a
+    C-order CaImAn memory-mapped file, one chunk at a time, and returns its filename.
+
+    This is equivalent to writing the plane to a TIFF and calling cm.save_memmap() on it,
+    without the intermediate TIFF.
+    '''
+
+    if frames is None:
+        frames = np.arange(video.shape[0])
+
+    dims     = video.shape[2:]
+    n_frames = len(frames)
+
+    fname = plane_memmap_name(base_name, dims, n_frames)
+
+    Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(int(np.prod(dims)), n_frames), order='C')
+
+    for start, chunk in video.iter_chunks(z, frames=frames, chunk_size=chunk_size):
+        # pixels are flattened in Fortran order, as CaImAn expects
+        Yr[:, start:start+chunk.shape[0]] = chunk.reshape((chunk.shape[0], -1), order='F').T
+
+    Yr.flush()
+    del Yr
+
+    return fname
+
+def get_patch_grid_shape(dims, patch_stride, patch_overlap):
+    '''Returns the shape of the grid of patches that CaImAn lays out over a frame for piecewise rigid motion correction.'''
+
+    grid_shape = []
+    for dim in dims:
+        window_size = patch_stride + patch_overlap
+
+        # same layout as caiman.motion_correction.sliding_window()
+        grid_shape.append(len(list(range(0, dim - window_size, patch_stride)) + [dim - window_size]))
+
+    return tuple(grid_shape)
+
+def apply_pw_rigid_shifts(frame, x_shifts, y_shifts, grid_shape):
+    '''
+    Warps a frame using the piecewise rigid shifts of its patches, the same way that
+    CaImAn does when it saves a piecewise rigid motion-corrected movie.
+    '''
+
+    dims = frame.shape
+
+    # upsample the patch shifts to the full frame
+    shift_x = cv2.resize(np.reshape(x_shifts, grid_shape).astype(np.float32), dims[::-1])
+    shift_y = cv2.resize(np.reshape(y_shifts, grid_shape).astype(np.float32), dims[::-1])
+
+    x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(np.float32), np.arange(0., dims[0]).astype(np.float32))
+
+    return cv2.remap(frame.astype(np.float32), x_grid - shift_y, y_grid - shift_x, cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+def apply_border(frames, border):
+    '''Zeroes out a border of the given width around each frame, in place.'''
+
+    if border > 0:
+        frames[:, :border, :]  = 0
+        frames[:, :, :border]  = 0
+        frames[:, -border:, :] = 0
+        frames[:, :, -border:] = 0
+
+    return frames
@@ -0,0 +1,143 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+# set default directory & maximum size (in GB) of the motion correction cache
+MC_CACHE_DIRECTORY = "../mc_cache"
+MC_CACHE_MAX_SIZE  = 2
+
+# number & size of the blocks of a file that are hashed to identify its contents
+N_HASH_BLOCKS   = 16
+HASH_BLOCK_SIZE = 2**20
+
+def hash_file(path):
+    '''
+    Returns a hash that identifies the contents of a file.
+
+    Hashing every byte of a multi-gigabyte video would take about as long as reading it for
+    motion correction, so only the file size and a set of evenly spaced blocks are hashed.
+    '''
+
+    size = os.path.getsize(path)
+
+    file_hash = hashlib.sha1(str(size).encode())
+
+    with open(path, 'rb') as f:
+        if size <= N_HASH_BLOCKS*HASH_BLOCK_SIZE:
+            file_hash.update(f.read())
+        else:
+            for offset in np.linspace(0, size - HASH_BLOCK_SIZE, N_HASH_BLOCKS).astype(np.int64):
+                f.seek(int(offset))
+                file_hash.update(f.read(HASH_BLOCK_SIZE))
+
+    return file_hash.hexdigest()
+
+def hash_array(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+class MotionCorrectionCache():
+    '''
+    Disk cache of motion correction results.
+
+    Each entry holds the rigid & piecewise rigid shifts, template and border of one plane of
+    one video, and is keyed on the size, modification time & contents of the video, the plane
+    and the motion correction parameters. Entries are stored as .npz files; the least recently
+    used entries are removed once the cache grows past its maximum size (in GB).
+    '''
+
+    def __init__(self, directory=MC_CACHE_DIRECTORY, max_size=MC_CACHE_MAX_SIZE):
+        self.directory   = directory
+        self.max_size    = max_size
+        self.file_hashes = {}
+
+    def key(self, video_path, z, max_shift, patch_stride, patch_overlap):
+        # only re-hash a file if it has changed since it was last hashed
+        stat = os.stat(video_path)
+        file_id = (os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+
+        if file_id not in self.file_hashes:
+            self.file_hashes[file_id] = hash_file(video_path)
+
+        # the sampled hash can miss edits, so the file's size & modification time are part of the key too
+        key = "{}_size_{}_mtime_{}_z_{}_shift_{}_stride_{}_overlap_{}".format(self.file_hashes[file_id], stat.st_size, stat.st_mtime, z, max_shift, patch_stride, patch_overlap)
+
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        path = self.entry_path(key)
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                entry = { name: data[name] for name in data.files }
+        except:
+            return None
+
+        # mark the entry as recently used -- another job may have just evicted it
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            pass
+
+        return entry
+
+    def save(self, key, entry):
+        # planes may be motion corrected by concurrent jobs that all create the directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = self.entry_path(key)
+
+        # write to a temporary file first so that concurrent jobs never read a partial entry
+        temp_path = os.path.join(self.directory, key + "_temp_{}.npz".format(os.getpid()))
+        np.savez(temp_path, **entry)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def entry_paths(self):
+        return [ path for path in glob.glob(os.path.join(self.directory, "*.npz")) if "_temp_" not in os.path.basename(path) ]
+
+    def entry_stats(self):
+        # (path, modification time, size) of each entry, skipping any that another job removes in the meantime
+        entries = []
+
+        for path in self.entry_paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            entries.append((path, stat.st_mtime, stat.st_size))
+
+        return entries
+
+    def size(self):
+        return sum([ size for path, mtime, size in self.entry_stats() ])
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits
+        entries = sorted(self.entry_stats(), key=lambda entry: entry[1])
+
+        total_size = sum([ size for path, mtime, size in entries ])
+
+        while total_size > self.max_size*2**30 and len(entries) > 0:
+            path, mtime, size = entries.pop(0)
+            total_size -= size
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for path in self.entry_paths():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,106 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# see if psutil is available
+try:
+    import psutil
+    psutil_enabled = True
+except:
+    psutil_enabled = False
+
+def get_worker_budget(max_workers=0):
+    '''Returns the number of worker processes to use. A max_workers of 0 uses all of the available cores.'''
+
+    n_cores = multiprocessing.cpu_count()
+
+    if max_workers is None or max_workers <= 0:
+        return n_cores
+    else:
+        return min(int(max_workers), n_cores)
+
+def split_workers(n_workers, n_jobs):
+    '''
+    Splits a budget of worker processes between jobs.
+
+    Returns the number of jobs to run concurrently and the number of processes that
+    each job can use for its own cluster.
+    '''
+
+    n_concurrent = max(1, min(n_workers, n_jobs))
+    n_processes  = max(1, n_workers // n_concurrent)
+
+    return n_concurrent, n_processes
+
+def get_available_memory():
+    '''Returns the amount of memory (in bytes) that is available for new processes, or None if it can't be determined.'''
+
+    if psutil_enabled:
+        return psutil.virtual_memory().available
+    else:
+        return None
+
+def plan_jobs(n_jobs, job_memory=0, max_workers=0):
+    '''
+    Decides how many jobs to run concurrently and how many processes each job can use.
+
+    The worker budget is split between the jobs, and the number of concurrent jobs is
+    limited so that their estimated memory use (job_memory bytes each) fits into the
+    memory that is currently available.
+    '''
+
+    n_workers = get_worker_budget(max_workers)
+
+    n_concurrent, n_processes = split_workers(n_workers, n_jobs)
+
+    available_memory = get_available_memory()
+
+    if job_memory > 0 and available_memory is not None:
+        n_concurrent = max(1, min(n_concurrent, int(available_memory // job_memory)))
+        n_processes  = max(1, n_workers // n_concurrent)
+
+    return n_concurrent, n_processes
+
+def run_jobs(function, jobs, n_concurrent, callback=None):
+    '''
+    Runs function(*job) for each job in a list of argument tuples, using a pool of
+    n_concurrent processes.
+
+    callback(index, result) is called in the calling process as each job finishes.
+    Returns the results in the same order as the jobs.
+    '''
+
+    results = [ None for job in jobs ]
+
+    if n_concurrent <= 1:
+        for i in range(len(jobs)):
+            results[i] = function(*jobs[i])
+
+            if callback is not None:
+                callback(i, results[i])
+    else:
+        # worker processes of an executor are not daemonic, so jobs can start their own clusters
+        with ProcessPoolExecutor(max_workers=n_concurrent) as executor:
+            futures = { executor.submit(function, *jobs[i]): i for i in range(len(jobs)) }
+
+            for future in as_completed(futures):
+                i = futures[future]
+
+                results[i] = future.result()
+
+                if callback is not None:
+                    callback(i, results[i])
+
+    return results
+
+def start_local_cluster(n_processes):
+    '''Creates a pool of processes to use as a CaImAn dview inside of a job, or None if only one process is available.'''
+
+    if n_processes > 1:
+        return multiprocessing.Pool(n_processes)
+    else:
+        return None
+
+def stop_local_cluster(dview):
+    if dview is not None:
+        dview.close()
+        dview.join()
@@ -1,25 +1,32 @@
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import tifffile
 import csv
-from scipy.stats.stats import pearsonr
-from sklearn import linear_model
 from matplotlib.widgets import Slider, CheckButtons
 from scipy.signal import convolve, deconvolve
 from scipy.interpolate import interp1d
 from matplotlib import cm
 import matplotlib.patches as mpatches
-import cv2
 
 import scipy
+import scipy.special
 import os
 
+from . import parallel
+from .roi_store import ROIStore, is_roi_store
+from .lazy_video import open_video_or_pages
+from .roi_geometry import get_roi_centroids
+from .video_stats import compute_plane_means, get_plane_means
+
 tail_fps     = 349.0
 calcium_fps  = 3
 tail_calcium_offset = 0
 frame_ratio  = tail_fps/calcium_fps
 
+# rough number of (ROIs, frames) float64 arrays held in memory by a shuffled correlation job -- the normalized traces,
+# their FFT (complex, so two) and the correlations with every shift of a regressor
+SHUFFLE_MEMORY_FACTOR = 4
+
 def get_bout_data(bout_fname, calcium_fps, n_frames, tail_calcium_offset=0):
     '''
     Given a filename containing labeled tail bouts, returns a dictionary of the format:
@@ -201,13 +208,19 @@ def get_tail_angles(tail_angle_fname):
     return tail_angles
 
 def get_calcium_video(calcium_video_fname):
-    return tifffile.imread(calcium_video_fname)
+    # memory-map the video (frames, z planes, height, width) rather than reading it into memory -- compressed
+    # TIFFs can't be memory-mapped, so their pages are decoded as they are read instead
+    return open_video_or_pages(calcium_video_fname)
+
+def get_mean_images(calcium_video, invert=False, plane_means=None):
+    # compute the mean of each plane in one chunked pass, unless it's given
+    if plane_means is None:
+        plane_means = compute_plane_means(calcium_video)
 
-def get_mean_images(calcium_video, invert=False):
     mean_images = np.zeros(calcium_video.shape[1:]).astype(np.uint8)
 
     for z in range(calcium_video.shape[1]):
-        mean_image = np.mean(calcium_video[:, z, :, :], axis=0)
+        mean_image = plane_means[z].copy()
         mean_image -= np.amin(mean_image[100:-100, 100:-100])
         mean_image = 255.0*mean_image/np.amax(mean_image)
 
@@ -219,6 +232,9 @@ def get_mean_images(calcium_video, invert=False):
     return mean_images
 
 def get_roi_data(roi_data_fname):
+    if is_roi_store(roi_data_fname):
+        return get_roi_store_data(roi_data_fname)
+
     roi_data = np.load(roi_data_fname, allow_pickle=True)
 
     # extract spatial and temporal footprints, and removed ROIs
@@ -241,28 +257,49 @@ def get_roi_data(roi_data_fname):
 
     return spatial_footprints, temporal_footprints
 
-def get_roi_centers(spatial_footprints):
-    roi_centers = [ np.zeros((spatial_footprints[z].shape[1], 2)) for z in range(len(spatial_footprints)) ]
+def get_roi_store_data(roi_data_fname):
+    # ROI data files saved for a single video hold one group
+    store     = ROIStore(roi_data_fname)
+    group_num = store.group_nums()[0]
 
-    video_shape = int(np.sqrt(spatial_footprints[0].shape[0])), int(np.sqrt(spatial_footprints[0].shape[0]))
+    spatial_footprints  = []
+    temporal_footprints = []
 
-    for z in range(len(spatial_footprints)):
-        for i in range(spatial_footprints[z].shape[1]):
-            mask = (spatial_footprints[z][:, i] > 0).reshape(video_shape).toarray()
+    # only read the traces of kept ROIs
+    for z in range(store.n_planes[group_num]):
+        kept_rois = store.read(group_num, z, 'roi_state').kept_rois()
 
-            contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        spatial_footprints.append(store.read(group_num, z, 'roi_spatial_footprints')[:, kept_rois])
 
-            contour = max(contours, key=cv2.contourArea)
+        traces = store.read_trace_rows(group_num, z, 'roi_temporal_footprints', kept_rois)
 
-            M = cv2.moments(contour)
-            if M["m00"] != 0:
-                center_x = int(M["m10"] / M["m00"])
-                center_y = int(M["m01"] / M["m00"])
-            else:
-                center_x = 0
-                center_y = 0
-            
-            roi_centers[z][i] = center_x, center_y
+        temporal_footprints.append((traces - np.mean(traces, axis=1)[:, np.newaxis])/np.std(traces, axis=1)[:, np.newaxis])
+
+    return spatial_footprints, temporal_footprints
+
+def get_roi_centers(spatial_footprints, dims, roi_data_fname=None):
+    # use the centroids that were cached with the ROI data, if there are any
+    if roi_data_fname is not None and is_roi_store(roi_data_fname):
+        roi_centers = get_cached_roi_centers(roi_data_fname)
+
+        if roi_centers is not None:
+            return roi_centers
+
+    return [ get_roi_centroids(spatial_footprints[z], dims) for z in range(len(spatial_footprints)) ]
+
+def get_cached_roi_centers(roi_data_fname):
+    store     = ROIStore(roi_data_fname)
+    group_num = store.group_nums()[0]
+
+    roi_centers = []
+
+    for z in range(store.n_planes[group_num]):
+        if not store.has(group_num, z, 'roi_centroids'):
+            return None
+
+        kept_rois = store.read(group_num, z, 'roi_state').kept_rois()
+
+        roi_centers.append(store.read(group_num, z, 'roi_centroids')[kept_rois])
 
     return roi_centers
 
@@ -388,43 +425,243 @@ def create_regressors(bouts, stimuli, calcium_fps, n_frames):
 
     return regressors
 
-def get_correlations(regressors, temporal_footprints):
+def normalize_rows(x):
+    # center each row & scale it to unit length, so that dot products between rows are Pearson correlations
+    x = x - np.mean(x, axis=-1)[..., np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return x/np.linalg.norm(x, axis=-1)[..., np.newaxis]
+
+def pearson_p_values(r, n_samples):
+    # two-sided p-values of correlations from the t-distribution with n - 2 degrees of freedom,
+    # written as a regularized incomplete beta function of r (as in scipy.stats.pearsonr)
+    return scipy.special.betainc(0.5*(n_samples - 2), 0.5, 1 - r**2)
+
+def get_correlations(regressors, temporal_footprints, chunk_size=4096):
     regressor_names = list(regressors.keys())
 
+    # normalized regressors, (frames, regressors)
+    X = normalize_rows(np.array([ regressors[regressor_names[i]] for i in range(len(regressor_names)) ], dtype=float)).T
+
     correlation_results = [ np.zeros((temporal_footprints[z].shape[0], len(regressor_names), 2)) for z in range(len(temporal_footprints)) ]
 
-    for i in range(len(regressor_names)):
-        for z in range(len(temporal_footprints)):
-            for j in range(temporal_footprints[z].shape[0]):
-                correlation_results[z][j, i] = pearsonr(regressors[regressor_names[i]], temporal_footprints[z][j])
+    for z in range(len(temporal_footprints)):
+        # correlate chunks of ROIs with all of the regressors at once
+        for start in range(0, temporal_footprints[z].shape[0], chunk_size):
+            r = np.clip(np.dot(normalize_rows(temporal_footprints[z][start:start+chunk_size]), X), -1, 1)
+
+            correlation_results[z][start:start+chunk_size, :, 0] = r
+            correlation_results[z][start:start+chunk_size, :, 1] = pearson_p_values(r, X.shape[0])
 
     return correlation_results
 
-def filter_correlation_results(correlation_results, z, regressor, max_p=0.05):
-    return [ i for i in range(correlation_results[z].shape[0]) if correlation_results[z][i, regressor, 1] <= max_p ]
+def circular_correlations(traces, x):
+    '''
+    Returns the correlations of normalized traces (ROIs, frames) with a normalized regressor
+    that is circularly shifted by every possible shift, as (ROIs, shifts).
+
+    All shifts are found at once as a circular cross-correlation using FFTs.
+    '''
+
+    return np.fft.irfft(np.fft.rfft(traces, axis=1)*np.conj(np.fft.rfft(x)), n=len(x), axis=1)
+
+def block_shuffle_correlations(traces, X, permutations, block_size):
+    '''
+    Returns the correlations of normalized traces (ROIs, frames) with normalized regressors
+    (frames, regressors) whose blocks of frames are reordered by each permutation, as
+    (ROIs, regressors, permutations). All permutations are correlated with one matrix multiply.
+    '''
+
+    n_frames = X.shape[0]
+    n_blocks = permutations.shape[1]
+
+    # frames in each block, with any frames left over at the end kept in place
+    blocks = np.arange(n_blocks*block_size).reshape((n_blocks, block_size))
+
+    frames = np.tile(np.arange(n_frames), (len(permutations), 1))
+    frames[:, :n_blocks*block_size] = blocks[permutations].reshape((len(permutations), -1))
+
+    # (frames, regressors*permutations)
+    X_shuffled = np.transpose(X[frames], (1, 2, 0)).reshape((n_frames, -1))
+
+    return np.dot(traces, X_shuffled).reshape((traces.shape[0], X.shape[1], len(permutations)))
+
+def count_shuffled_correlations(traces, X, correlations, shuffles, method='circular', block_size=None, batch_size=100):
+    # count how many shuffled correlations are at least as large (in magnitude) as the actual correlations
+    traces     = normalize_rows(traces)
+    counts     = np.zeros(correlations.shape, dtype=int)
+    thresholds = np.abs(correlations) - 1e-12
+
+    if method == 'circular':
+        # correlations with every shift of a regressor are found at once, then the sampled shifts are counted
+        for i in range(X.shape[1]):
+            shuffled_correlations = circular_correlations(traces, X[:, i])[:, shuffles]
+
+            counts[:, i] = np.sum(np.abs(shuffled_correlations) >= thresholds[:, i, np.newaxis], axis=-1)
+    else:
+        # process shuffles in batches
+        for start in range(0, len(shuffles), batch_size):
+            shuffled_correlations = block_shuffle_correlations(traces, X, shuffles[start:start+batch_size], block_size)
+
+            counts += np.sum(np.abs(shuffled_correlations) >= thresholds[:, :, np.newaxis], axis=-1)
+
+    return counts
+
+def get_shuffled_correlations(regressors, temporal_footprints, n_shuffles=1000, method='circular', min_shift=None, block_size=None, chunk_size=4096, seed=None, use_multiprocessing=True, max_workers=0):
+    '''
+    Returns correlation results like get_correlations, but with empirical p-values found by
+    correlating each ROI with shuffled regressors.
+
+    Regressors are either circularly shifted (method='circular') by at least min_shift frames,
+    or have blocks of block_size frames shuffled (method='block'), so that the null distribution
+    keeps the autocorrelation of the regressors. Chunks of ROIs are processed in parallel.
+    '''
+
+    correlation_results = get_correlations(regressors, temporal_footprints, chunk_size=chunk_size)
 
-def multilinear_regression(regressors, temporal_footprints):
     regressor_names = list(regressors.keys())
-    
-    # make a 2D array containing the regressors
-    X = np.zeros((temporal_footprints[0].shape[1], len(regressor_names)))
-    for i in range(len(regressor_names)):
-        X[:, i] = regressors[regressor_names[i]]
 
-    regression_coefficients = [ np.zeros((temporal_footprints[z].shape[0], len(regressor_names))) for z in range(len(temporal_footprints)) ]
-    regression_intercepts   = [ np.zeros((temporal_footprints[z].shape[0], 1)) for z in range(len(temporal_footprints)) ]
-    regression_scores       = [ np.zeros((temporal_footprints[z].shape[0], len(regressor_names))) for z in range(len(temporal_footprints)) ]
+    # normalized regressors, (frames, regressors)
+    X = normalize_rows(np.array([ regressors[regressor_names[i]] for i in range(len(regressor_names)) ], dtype=float)).T
 
+    n_frames = X.shape[0]
+
+    rng = np.random.RandomState(seed)
+
+    if method == 'circular':
+        # by default, shift by at least the length of the calcium kernel used in convolve_gcamp6f
+        if min_shift is None:
+            min_shift = int(10*calcium_fps)
+        min_shift = max(1, min(min_shift, n_frames//2 - 1))
+
+        shuffles = rng.randint(min_shift, n_frames - min_shift + 1, size=n_shuffles)
+    else:
+        if block_size is None:
+            block_size = int(10*calcium_fps)
+        block_size = max(1, min(block_size, n_frames//2))
+
+        shuffles = np.array([ rng.permutation(n_frames//block_size) for i in range(n_shuffles) ])
+
+    jobs = []
+    for z in range(len(temporal_footprints)):
+        for start in range(0, temporal_footprints[z].shape[0], chunk_size):
+            jobs.append((temporal_footprints[z][start:start+chunk_size], X, correlation_results[z][start:start+chunk_size, :, 0], shuffles, method, block_size))
+
+    if use_multiprocessing and len(jobs) > 1:
+        job_rows = max([ job[0].shape[0] for job in jobs ])
+
+        n_concurrent, n_processes = parallel.plan_jobs(len(jobs), job_memory=SHUFFLE_MEMORY_FACTOR*job_rows*n_frames*8, max_workers=max_workers)
+    else:
+        n_concurrent = 1
+
+    counts = parallel.run_jobs(count_shuffled_correlations, jobs, n_concurrent)
+
+    i = 0
     for z in range(len(temporal_footprints)):
-        for i in range(temporal_footprints[z].shape[0]):
-            clf = linear_model.LinearRegression()
-            clf.fit(X, temporal_footprints[z][i])
+        for start in range(0, temporal_footprints[z].shape[0], chunk_size):
+            correlation_results[z][start:start+chunk_size, :, 1] = (1 + counts[i])/(1 + n_shuffles)
+
+            i += 1
+
+    return correlation_results
+
+def fdr_mask(p_values, alpha=0.05):
+    '''Returns which p-values are significant after Benjamini-Hochberg correction for a false discovery rate of alpha.'''
+
+    p_values = np.asarray(p_values)
+
+    order  = np.argsort(p_values, kind='stable')
+    ranked = p_values[order]
+
+    below = np.nonzero(ranked <= alpha*np.arange(1, len(ranked)+1)/len(ranked))[0]
+
+    mask = np.zeros(len(p_values), dtype=bool)
+
+    if len(below) > 0:
+        mask[order[:below[-1]+1]] = True
+
+    return mask
+
+def filter_correlation_results(correlation_results, z, regressor, max_p=0.05, fdr=False):
+    # with fdr, max_p is the false discovery rate over all of the ROIs in the plane
+    p_values = correlation_results[z][:, regressor, 1]
+
+    if fdr:
+        return np.nonzero(fdr_mask(p_values, alpha=max_p))[0].tolist()
+    else:
+        return np.nonzero(p_values <= max_p)[0].tolist()
+
+def multilinear_regression(regressors, temporal_footprints):
+    return RegressionCache(regressors, temporal_footprints).fit()
+
+class RegressionCache():
+    '''
+    Cross products of the centered regressors & traces of each plane (X^T X, X^T Y and the
+    sums of squares of Y), computed once.
+
+    The coefficients, intercepts and R^2 scores of a regression on any subset of the
+    regressors are solved from sub-blocks of these, without touching the traces again.
+    '''
+
+    def __init__(self, regressors, temporal_footprints):
+        self.regressor_names = list(regressors.keys())
+
+        # make a 2D array containing the regressors
+        X = np.zeros((temporal_footprints[0].shape[1], len(self.regressor_names)))
+        for i in range(len(self.regressor_names)):
+            X[:, i] = regressors[self.regressor_names[i]]
+
+        # center the regressors, so that intercepts can be found from the means (as in sklearn's LinearRegression)
+        self.n_frames   = X.shape[0]
+        self.X_mean     = np.mean(X, axis=0)
+        X_centered      = X - self.X_mean
+        self.gram       = np.dot(X_centered.T, X_centered)
+
+        # centered regressors sum to zero over frames, so traces don't need to be centered
+        self.XtY    = [ np.dot(X_centered.T, temporal_footprints[z].T) for z in range(len(temporal_footprints)) ]
+        self.Y_mean = [ np.mean(temporal_footprints[z], axis=1) for z in range(len(temporal_footprints)) ]
+        self.ss_tot = [ self.n_frames*np.var(temporal_footprints[z], axis=1) for z in range(len(temporal_footprints)) ]
+
+    def regressor_indices(self, regressor_names=None):
+        if regressor_names is None:
+            return np.arange(len(self.regressor_names))
+        else:
+            return np.array([ self.regressor_names.index(name) for name in regressor_names ], dtype=int)
 
-            regression_coefficients[z][i] = clf.coef_
-            regression_intercepts[z][i]   = clf.intercept_
-            regression_scores[z][i]       = clf.score(X, temporal_footprints[z][i])
+    def solve(self, indices, z):
+        # least squares coefficients of every ROI, & the sum of squares of their fits
+        gram_pinv = np.linalg.pinv(self.gram[np.ix_(indices, indices)])
 
-    return regression_coefficients, regression_intercepts, regression_scores
+        XtY = self.XtY[z][indices]
+
+        coefficients = np.dot(gram_pinv, XtY).T
+        ss_fit       = np.sum(coefficients.T*XtY, axis=0)
+
+        return coefficients, ss_fit
+
+    def scores(self, ss_fit, z):
+        ss_res = np.maximum(self.ss_tot[z] - ss_fit, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.ss_tot[z] > 0, 1 - ss_res/self.ss_tot[z], 1.0)
+
+    def fit(self, regressor_names=None):
+        '''Returns the regression coefficients, intercepts and scores of each plane, using the given regressors (default: all).'''
+
+        indices = self.regressor_indices(regressor_names)
+
+        regression_coefficients = []
+        regression_intercepts   = []
+        regression_scores       = []
+
+        for z in range(len(self.XtY)):
+            coefficients, ss_fit = self.solve(indices, z)
+
+            regression_coefficients.append(coefficients)
+            regression_intercepts.append((self.Y_mean[z] - np.dot(coefficients, self.X_mean[indices]))[:, np.newaxis])
+            regression_scores.append(np.repeat(self.scores(ss_fit, z)[:, np.newaxis], len(indices), axis=1))
+
+        return regression_coefficients, regression_intercepts, regression_scores
 
 def get_correlation_colors(correlation_results, cmap=cm.RdBu):
     correlation_colors = [ np.zeros((correlation_results[z].shape[0], correlation_results[z].shape[1], 4)) for z in range(len(correlation_results)) ]
@@ -468,16 +705,20 @@ def get_top_regressor_rois(regression_coefficients, regressor, z):
 
     return top_regressor_rois
 
-def regressor_analysis(calcium_video_fname, roi_data_fname, bout_fname, frame_timestamp_fname, tail_calcium_offset):
+def regressor_analysis(calcium_video_fname, roi_data_fname, bout_fname, frame_timestamp_fname, tail_calcium_offset, n_shuffles=0):
     calcium_video = get_calcium_video(calcium_video_fname)
 
-    mean_images = get_mean_images(calcium_video, invert=True)
+    # mean images are cached next to the ROI data
+    plane_means = get_plane_means(calcium_video_fname, cache_directory=os.path.dirname(roi_data_fname), video=calcium_video)
+
+    mean_images = get_mean_images(calcium_video, invert=True, plane_means=plane_means)
 
     n_frames = calcium_video.shape[0]
 
     spatial_footprints, temporal_footprints = get_roi_data(roi_data_fname)
     
-    roi_centers = get_roi_centers(spatial_footprints)
+    # ROI footprints are flattened (in C order) from images with the video's (height, width)
+    roi_centers = get_roi_centers(spatial_footprints, calcium_video.shape[2:], roi_data_fname=roi_data_fname)
 
     bouts = get_bout_data(bout_fname, calcium_fps, n_frames, tail_calcium_offset=tail_calcium_offset)
 
@@ -487,7 +728,11 @@ def regressor_analysis(calcium_video_fname, roi_data_fname, bout_fname, frame_ti
 
     regression_coefficients, regression_intercepts, regression_scores = multilinear_regression(regressors, temporal_footprints)
 
-    correlation_results = get_correlations(regressors, temporal_footprints)
+    # use empirical p-values from shuffled regressors if n_shuffles > 0
+    if n_shuffles > 0:
+        correlation_results = get_shuffled_correlations(regressors, temporal_footprints, n_shuffles=n_shuffles)
+    else:
+        correlation_results = get_correlations(regressors, temporal_footprints)
 
     return correlation_results, regression_coefficients, regression_intercepts, regression_scores, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers
 
@@ -646,7 +891,7 @@ def plot_regressor_analysis(correlation_results, regression_coefficients, regres
     if not existing_figure:
         plt.show()
 
-def plot_correlation(correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index, fig=None):
+def plot_correlation(correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index, fig=None, fdr=False):
     regressor_names = list(regressors.keys())
 
     cmap = get_cmap(len(regressor_names)+1)
@@ -691,7 +936,7 @@ def plot_correlation(correlation_results, regressors, spatial_footprints, tempor
     im = plt.imshow(mean_images[z], cmap='gray')
 
     # filter ROIs based on p-value
-    indices = filter_correlation_results(correlation_results, z=z, regressor=regressor_index, max_p=max_p)
+    indices = filter_correlation_results(correlation_results, z=z, regressor=regressor_index, max_p=max_p, fdr=fdr)
 
     if len(indices) > 0:
         scatter = plt.scatter(roi_centers[z][indices, 0], roi_centers[z][indices, 1], s=80*fig.dpi/72, c=correlation_colors[z][indices, regressor_index, :], edgecolors=None, linewidths=0)
@@ -0,0 +1,93 @@
+import os
+import csv
+import numpy as np
+import h5py
+
+from . import parallel
+
+# formats that ROI traces & centroids can be exported to
+EXPORT_FORMATS = ['csv', 'npz', 'h5']
+
+# filename of the HDF5 file holding the traces & centroids of every plane of a video
+EXPORT_H5_FILENAME = "roi_traces.h5"
+
+# shape of the chunks that exported traces are stored in (ROIs, frames)
+EXPORT_CHUNK_SHAPE = (64, 1024)
+
+# rough memory use of an export job, as a multiple of the size of the traces being exported
+EXPORT_MEMORY_FACTOR = 3
+
+def save_traces_csv(path, rois, traces):
+    with open(path, 'w') as file:
+        writer = csv.writer(file)
+
+        writer.writerow(['ROI #'] + [ "Frame {}".format(frame) for frame in range(traces.shape[1]) ])
+
+        writer.writerows([ ['{}'.format(roi)] + row for roi, row in zip(rois.tolist(), traces.tolist()) ])
+
+def save_centroids_csv(path, rois, centroids):
+    with open(path, 'w') as file:
+        writer = csv.writer(file)
+
+        writer.writerow(['Label', 'X', 'Y'])
+
+        writer.writerows([ ["ROI #{}".format(roi+1)] + row for roi, row in zip(rois.tolist(), centroids.tolist()) ])
+
+def save_planes_h5(path, planes):
+    with h5py.File(path, 'w') as f:
+        for z in range(len(planes)):
+            group  = f.create_group("z_{}".format(z))
+            traces = planes[z]['traces']
+
+            if traces.size > 0:
+                chunks = (min(EXPORT_CHUNK_SHAPE[0], traces.shape[0]), min(EXPORT_CHUNK_SHAPE[1], traces.shape[1]))
+            else:
+                chunks = None
+
+            group.create_dataset('rois', data=planes[z]['rois'])
+            group.create_dataset('traces', data=traces, chunks=chunks)
+            group.create_dataset('centroids', data=planes[z]['centroids'])
+
+def export_video_rois(video_dir_path, planes, formats=['csv']):
+    '''
+    Exports the kept ROIs of each plane of a video to a directory.
+
+    Each plane is a dictionary holding the indices of the kept ROIs ('rois'), their
+    traces ('traces') and their centroids ('centroids'). CSV & NPZ files are saved per
+    plane, and an HDF5 file holds every plane.
+    '''
+
+    for z in range(len(planes)):
+        rois      = np.asarray(planes[z]['rois'], dtype=int)
+        traces    = planes[z]['traces']
+        centroids = planes[z]['centroids']
+
+        if 'csv' in formats:
+            print("Saving CSV for z={}...".format(z))
+
+            save_traces_csv(os.path.join(video_dir_path, 'z_{}_traces.csv'.format(z)), rois, traces)
+            save_centroids_csv(os.path.join(video_dir_path, 'z_{}_centroids.csv'.format(z)), rois, centroids)
+
+        if 'npz' in formats:
+            np.savez(os.path.join(video_dir_path, 'z_{}_rois.npz'.format(z)), rois=rois, traces=traces, centroids=centroids)
+
+    if 'h5' in formats:
+        save_planes_h5(os.path.join(video_dir_path, EXPORT_H5_FILENAME), planes)
+
+def export_rois(jobs, use_multiprocessing=True, max_workers=0):
+    '''
+    Runs export_video_rois for each job in a list of (video_dir_path, planes, formats) tuples,
+    exporting videos in parallel when multiprocessing is used.
+    '''
+
+    if len(jobs) == 0:
+        return
+
+    if use_multiprocessing:
+        job_memory = max([ EXPORT_MEMORY_FACTOR*sum([ plane['traces'].nbytes for plane in job[1] ]) for job in jobs ])
+
+        n_concurrent, n_processes = parallel.plan_jobs(len(jobs), job_memory, max_workers)
+    else:
+        n_concurrent = 1
+
+    parallel.run_jobs(export_video_rois, jobs, n_concurrent)
@@ -0,0 +1,169 @@
+import numpy as np
+import scipy.sparse
+import cv2
+
+def positive_pixels(roi_spatial_footprints, dims, rois=None):
+    '''
+    Returns the ROI, row & column of every pixel where the footprints (or the given ROIs'
+    footprints) are positive, along with the number of positive pixels of each ROI.
+
+    Footprints are (pixels, ROIs) matrices of images with shape dims, flattened in C order.
+    '''
+
+    footprints = scipy.sparse.csc_matrix(roi_spatial_footprints)
+
+    if footprints.shape[0] != dims[0]*dims[1]:
+        raise ValueError("Footprints have {} pixels, but the image shape is {}.".format(footprints.shape[0], tuple(dims)))
+
+    if rois is not None:
+        footprints = footprints[:, np.asarray(rois, dtype=int)]
+
+    mask = scipy.sparse.csc_matrix(footprints > 0)
+
+    counts     = np.diff(mask.indptr)
+    entry_rois = np.repeat(np.arange(mask.shape[-1]), counts)
+
+    return entry_rois, mask.indices // dims[1], mask.indices % dims[1], counts
+
+def get_roi_centroids(roi_spatial_footprints, dims, rois=None):
+    '''
+    Returns the (x, y) centroid of each ROI (or of the given ROIs), as the mean position of the
+    pixels where its footprint is positive, rounded down to whole pixels. x is the column and
+    y is the row in an image of shape dims (height, width). ROIs with no positive pixels get (0, 0).
+
+    A blob around x=80, y=10 in a non-square 40x100 image:
+
+    >>> image = np.zeros((40, 100))
+    >>> image[9:12, 79:82] = 1
+    >>> get_roi_centroids(image.reshape((-1, 1)), image.shape)
+    array([[80., 10.]])
+    '''
+
+    entry_rois, rows, cols, counts = positive_pixels(roi_spatial_footprints, dims, rois)
+
+    n_rois = len(counts)
+
+    x_sums = np.bincount(entry_rois, weights=cols, minlength=n_rois)
+    y_sums = np.bincount(entry_rois, weights=rows, minlength=n_rois)
+
+    centroids = np.zeros((n_rois, 2))
+
+    nonempty = counts > 0
+    centroids[nonempty, 0] = np.floor(x_sums[nonempty]/counts[nonempty])
+    centroids[nonempty, 1] = np.floor(y_sums[nonempty]/counts[nonempty])
+
+    return centroids
+
+def get_roi_bounding_boxes(roi_spatial_footprints, dims, rois=None):
+    '''
+    Returns the (x_min, y_min, x_max, y_max) bounding box of the positive pixels of each ROI
+    (or of the given ROIs), with the same axes as get_roi_centroids. ROIs with no positive
+    pixels get a box of zeros.
+    '''
+
+    entry_rois, rows, cols, counts = positive_pixels(roi_spatial_footprints, dims, rois)
+
+    n_rois = len(counts)
+
+    boxes = np.zeros((n_rois, 4), dtype=int)
+
+    nonempty = counts > 0
+
+    # reduce over the pixels of each ROI, which are stored contiguously
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+
+    if len(starts) > 0:
+        boxes[nonempty, 0] = np.minimum.reduceat(cols, starts)
+        boxes[nonempty, 1] = np.minimum.reduceat(rows, starts)
+        boxes[nonempty, 2] = np.maximum.reduceat(cols, starts)
+        boxes[nonempty, 3] = np.maximum.reduceat(rows, starts)
+
+    return boxes
+
+class ROISpatialIndex():
+    '''
+    An index of which ROIs cover each pixel of a plane.
+
+    The footprints are stored by pixel (in CSR form), so the ROIs covering a pixel are found
+    with a single slice, and the ROIs inside a rectangle or polygon by gathering the rows of
+    its pixels. Points are (row, column) positions in an image of shape dims.
+    '''
+
+    def __init__(self, roi_spatial_footprints, dims):
+        self.dims = tuple(dims)
+
+        # only keep the positive pixels of each footprint
+        footprints = scipy.sparse.csr_matrix(roi_spatial_footprints, copy=True)
+        footprints.data[footprints.data < 0] = 0
+        footprints.eliminate_zeros()
+        footprints.sort_indices()
+
+        self.footprints = footprints
+
+    def pixel(self, point):
+        # flattened index of a point, or None if it's outside of the image
+        row, col = int(point[0]), int(point[1])
+
+        if 0 <= row < self.dims[0] and 0 <= col < self.dims[1]:
+            return row*self.dims[1] + col
+        else:
+            return None
+
+    def rois_at(self, point):
+        '''Returns all of the ROIs covering a point.'''
+
+        pixel = self.pixel(point)
+
+        if pixel is None:
+            return np.zeros(0, dtype=int)
+
+        return self.footprints.indices[self.footprints.indptr[pixel]:self.footprints.indptr[pixel+1]]
+
+    def roi_at(self, point):
+        '''Returns the ROI whose footprint is largest at a point, or None if no ROI covers it.'''
+
+        pixel = self.pixel(point)
+
+        if pixel is None:
+            return None
+
+        start, end = self.footprints.indptr[pixel], self.footprints.indptr[pixel+1]
+
+        if start == end:
+            return None
+
+        return int(self.footprints.indices[start + np.argmax(self.footprints.data[start:end])])
+
+    def rois_in_mask(self, mask):
+        '''Returns the ROIs that cover any of the pixels of a boolean image of shape dims.'''
+
+        pixels = np.flatnonzero(mask)
+
+        return np.unique(self.footprints[pixels].indices)
+
+    def rois_in_rectangle(self, corner_1, corner_2):
+        '''Returns the ROIs that cover any pixel of the rectangle between two corner points.'''
+
+        top, bottom = sorted([int(corner_1[0]), int(corner_2[0])])
+        left, right = sorted([int(corner_1[1]), int(corner_2[1])])
+
+        # clip the rectangle to the image
+        top, bottom = max(top, 0), min(bottom, self.dims[0]-1)
+        left, right = max(left, 0), min(right, self.dims[1]-1)
+
+        mask = np.zeros(self.dims, dtype=bool)
+
+        if top <= bottom and left <= right:
+            mask[top:bottom+1, left:right+1] = True
+
+        return self.rois_in_mask(mask)
+
+    def rois_in_polygon(self, points):
+        '''Returns the ROIs that cover any pixel inside of a polygon (eg. a lasso), given as a list of points.'''
+
+        mask = np.zeros(self.dims, dtype=np.uint8)
+
+        # OpenCV takes (x, y) points
+        cv2.fillPoly(mask, [ np.array([ [int(point[1]), int(point[0])] for point in points ], dtype=np.int32) ], 1)
+
+        return self.rois_in_mask(mask > 0)
@@ -0,0 +1,241 @@
+import numpy as np
+
+class ROISet():
+    '''
+    A live, read-only view of one of the boolean arrays of an ROIState as a set of ROI indices.
+
+    Membership tests are O(1), and the view can be iterated over or converted to an array
+    like the lists of ROIs that were used before.
+    '''
+
+    def __init__(self, state, name):
+        self.state = state
+        self.name  = name
+
+    def mask(self):
+        return getattr(self.state, self.name)
+
+    def __contains__(self, roi):
+        mask = self.mask()
+
+        try:
+            roi = int(roi)
+        except:
+            return False
+
+        return 0 <= roi < len(mask) and bool(mask[roi])
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __len__(self):
+        return int(np.sum(self.mask()))
+
+    def __array__(self, dtype=None):
+        rois = np.nonzero(self.mask())[0]
+
+        if dtype is not None:
+            rois = rois.astype(dtype)
+
+        return rois
+
+    def tolist(self):
+        return np.nonzero(self.mask())[0].tolist()
+
+    def __repr__(self):
+        return "ROISet({})".format(self.tolist())
+
+class ROIState():
+    '''
+    Kept/removed state of the ROIs in one z plane.
+
+    ROIs can be filtered out (by the automatic filters), manually removed, or locked
+    (manually kept, so that they are never filtered out). Each of these is stored as a
+    boolean array over the ROIs, so membership tests are O(1) and bulk updates are
+    vectorized. An ROI is removed if it's filtered out or manually removed.
+    '''
+
+    def __init__(self, n_rois=0):
+        self.filtered_out     = np.zeros(n_rois, dtype=bool)
+        self.manually_removed = np.zeros(n_rois, dtype=bool)
+        self.locked           = np.zeros(n_rois, dtype=bool)
+
+        self.update()
+
+    @property
+    def n_rois(self):
+        return len(self.filtered_out)
+
+    def update(self):
+        self.removed = self.filtered_out | self.manually_removed
+
+    def mask(self, rois):
+        # convert a list of ROIs to a boolean array, ignoring any that are out of range
+        rois = np.asarray(rois, dtype=int).ravel()
+
+        mask = np.zeros(self.n_rois, dtype=bool)
+        mask[rois[(rois >= 0) & (rois < self.n_rois)]] = True
+
+        return mask
+
+    @property
+    def filtered_out_rois(self):
+        return ROISet(self, 'filtered_out')
+
+    @property
+    def manually_removed_rois(self):
+        return ROISet(self, 'manually_removed')
+
+    @property
+    def all_removed_rois(self):
+        return ROISet(self, 'removed')
+
+    @property
+    def locked_rois(self):
+        return ROISet(self, 'locked')
+
+    def kept_rois(self):
+        '''Returns the indices of the ROIs that are kept -- ROIs that aren't removed, or that are locked.'''
+        return np.nonzero(~self.removed | self.locked)[0]
+
+    def set_filtered_out(self, rois):
+        # locked ROIs are never filtered out
+        self.filtered_out = self.mask(rois) & ~self.locked
+
+        self.update()
+
+    def clear_manually_removed(self):
+        self.manually_removed[:] = False
+
+        self.update()
+
+    def discard(self, rois):
+        mask = self.mask(rois)
+
+        self.manually_removed |= mask
+        self.locked           &= ~mask
+
+        self.update()
+
+    def keep(self, rois):
+        mask = self.mask(rois)
+
+        self.manually_removed &= ~mask
+        self.filtered_out     &= ~mask
+        self.locked           |= mask
+
+        self.update()
+
+    def discard_all(self):
+        self.manually_removed[:] = True
+        self.filtered_out[:]     = False
+
+        self.update()
+
+    def keep_all(self):
+        self.manually_removed[:] = False
+        self.filtered_out[:]     = False
+
+        self.update()
+
+    def remove(self, rois):
+        '''Deletes the given ROIs, shifting the indices of the ROIs after them down.'''
+
+        kept = ~self.mask(rois)
+
+        self.filtered_out     = self.filtered_out[kept]
+        self.manually_removed = self.manually_removed[kept]
+        self.locked           = self.locked[kept]
+
+        self.update()
+
+    def resize(self, n_rois):
+        '''Adds new (kept) ROIs to the end, or deletes ROIs from the end, so that there are n_rois ROIs.'''
+
+        n_copied = min(n_rois, self.n_rois)
+
+        for name in ('filtered_out', 'manually_removed', 'locked'):
+            mask = np.zeros(n_rois, dtype=bool)
+            mask[:n_copied] = getattr(self, name)[:n_copied]
+
+            setattr(self, name, mask)
+
+        self.update()
+
+    def merge(self, rois, n_rois):
+        '''Deletes ROIs that were merged, and adds the merged ROIs to the end so that there are n_rois ROIs.'''
+
+        self.remove(rois)
+        self.resize(n_rois)
+
+    def to_dict(self):
+        # boolean arrays are packed into bits
+        return {'n_rois'          : self.n_rois,
+                'filtered_out'    : np.packbits(self.filtered_out),
+                'manually_removed': np.packbits(self.manually_removed),
+                'locked'          : np.packbits(self.locked)}
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(data['n_rois'])
+
+        for name in ('filtered_out', 'manually_removed', 'locked'):
+            setattr(state, name, np.unpackbits(data[name])[:state.n_rois].astype(bool))
+
+        state.update()
+
+        return state
+
+    @classmethod
+    def from_lists(cls, n_rois, filtered_out_rois, manually_removed_rois, locked_rois):
+        state = cls(n_rois)
+
+        state.filtered_out     = state.mask(filtered_out_rois)
+        state.manually_removed = state.mask(manually_removed_rois)
+        state.locked           = state.mask(locked_rois)
+
+        state.update()
+
+        return state
+
+def roi_states_to_roi_data(roi_states):
+    '''
+    Returns the ROI data entries that describe the states of each plane of a group.
+
+    States are saved compactly under 'roi_states'. Lists of filtered out, manually removed,
+    removed and locked ROIs are saved too, so the file can still be read as before.
+    '''
+
+    return {'roi_states'           : [ state.to_dict() for state in roi_states ],
+            'filtered_out_rois'    : [ state.filtered_out_rois.tolist() for state in roi_states ],
+            'manually_removed_rois': [ state.manually_removed_rois.tolist() for state in roi_states ],
+            'all_removed_rois'     : [ state.all_removed_rois.tolist() for state in roi_states ],
+            'locked_rois'          : [ state.locked_rois.tolist() for state in roi_states ]}
+
+def roi_states_from_roi_data(roi_data, roi_spatial_footprints, group_num=None):
+    '''
+    Returns the states of each plane of a group from saved ROI data. group_num selects a
+    group when the data holds all groups.
+
+    Older files, which only have lists of ROIs (with older names), are supported.
+    '''
+
+    def get(key):
+        if group_num is None:
+            return roi_data[key]
+        else:
+            return roi_data[key][group_num]
+
+    if 'roi_states' in roi_data.keys():
+        return [ ROIState.from_dict(data) for data in get('roi_states') ]
+
+    filtered_out_rois = get('filtered_out_rois')
+
+    if 'manually_removed_rois' in roi_data.keys():
+        manually_removed_rois = get('manually_removed_rois')
+    else:
+        manually_removed_rois = get('discarded_rois')
+
+    locked_rois = get('locked_rois')
+
+    return [ ROIState.from_lists(roi_spatial_footprints[z].shape[-1], filtered_out_rois[z], manually_removed_rois[z], locked_rois[z]) for z in range(len(roi_spatial_footprints)) ]
@@ -0,0 +1,229 @@
+import os
+import json
+import numpy as np
+import scipy.sparse
+import h5py
+
+from .roi_state import ROIState
+
+# version of the layout of ROI data files
+ROI_STORE_VERSION = 1
+
+# default filename of ROI data files
+ROI_DATA_FILENAME = "roi_data.h5"
+
+# shape of the chunks that traces are stored in (ROIs, frames)
+TRACE_CHUNK_SHAPE = (64, 1024)
+
+# per-plane ROI data, and whether each entry is a trace array that is stored in chunks
+PLANE_KEYS = {'roi_spatial_footprints' : False,
+              'roi_temporal_footprints': True,
+              'roi_temporal_residuals' : True,
+              'bg_spatial_footprints'  : False,
+              'bg_temporal_footprints' : True}
+
+# per-plane ROI geometry, which is cached in the file if it's given when saving
+GEOMETRY_KEYS = ['roi_centroids', 'roi_bounding_boxes']
+
+def is_roi_store(path):
+    '''Returns whether a path is an HDF5 ROI data file, rather than a legacy pickled .npy file.'''
+    return os.path.splitext(path)[1].lower() in (".h5", ".hdf5")
+
+def write_matrix(parent, name, matrix, chunked=False):
+    # replace any existing entry
+    if name in parent:
+        del parent[name]
+
+    if scipy.sparse.issparse(matrix):
+        # store sparse matrices as their CSC components
+        matrix = scipy.sparse.csc_matrix(matrix)
+
+        group = parent.create_group(name)
+        group.attrs['format'] = "csc"
+        group.attrs['shape']  = matrix.shape
+
+        group.create_dataset('data', data=matrix.data)
+        group.create_dataset('indices', data=matrix.indices)
+        group.create_dataset('indptr', data=matrix.indptr)
+    else:
+        matrix = np.asarray(matrix)
+
+        if chunked and matrix.ndim == 2 and matrix.size > 0:
+            chunks = (min(TRACE_CHUNK_SHAPE[0], matrix.shape[0]), min(TRACE_CHUNK_SHAPE[1], matrix.shape[1]))
+        else:
+            chunks = None
+
+        parent.create_dataset(name, data=matrix, chunks=chunks)
+
+def read_matrix(node):
+    if isinstance(node, h5py.Group):
+        return scipy.sparse.csc_matrix((node['data'][()], node['indices'][()], node['indptr'][()]), shape=tuple(node.attrs['shape']))
+    else:
+        return node[()]
+
+def write_roi_state(parent, roi_state):
+    if 'roi_state' in parent:
+        del parent['roi_state']
+
+    group = parent.create_group('roi_state')
+
+    for key, value in roi_state.to_dict().items():
+        if key == 'n_rois':
+            group.attrs[key] = value
+        else:
+            group.create_dataset(key, data=value)
+
+def read_roi_state(node):
+    data = { key: node[key][()] for key in node.keys() }
+    data['n_rois'] = int(node.attrs['n_rois'])
+
+    return ROIState.from_dict(data)
+
+def write_roi_group(groups, group_num, planes, masks=[], dims=None):
+    group = groups.create_group(str(int(group_num)))
+    group.attrs['n_planes'] = len(planes)
+    group.attrs['masks']    = json.dumps(masks, default=lambda value: value.tolist())
+
+    if dims is not None:
+        group.attrs['dims'] = [ int(dim) for dim in dims ]
+
+    planes_group = group.create_group('planes')
+
+    for z in range(len(planes)):
+        plane = planes_group.create_group(str(z))
+
+        for key, chunked in PLANE_KEYS.items():
+            write_matrix(plane, key, planes[z][key], chunked=chunked)
+
+        for key in GEOMETRY_KEYS:
+            if key in planes[z].keys():
+                write_matrix(plane, key, planes[z][key])
+
+        write_roi_state(plane, planes[z]['roi_state'])
+
+def save_roi_groups(path, groups, video_paths=[]):
+    '''
+    Saves the ROI data of a set of groups to an HDF5 file, as /groups/<group_num>/planes/<z>.
+
+    groups maps each group number to a tuple of (planes, masks, dims), where each plane is a
+    dictionary holding its footprints, traces and ROIState, and dims is the (height, width) of
+    the images that the footprints are flattened from. HDF5 never reclaims the space of deleted
+    objects, so rather than replacing groups in place the whole file is written to a temporary
+    file which then replaces any existing one.
+    '''
+
+    temp_path = "{}_temp_{}".format(path, os.getpid())
+
+    try:
+        with h5py.File(temp_path, 'w') as f:
+            f.attrs['version']     = ROI_STORE_VERSION
+            f.attrs['video_paths'] = json.dumps(list(video_paths))
+
+            groups_group = f.create_group('groups')
+
+            for group_num, (planes, masks, dims) in groups.items():
+                write_roi_group(groups_group, group_num, planes, masks=masks, dims=dims)
+
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class ROIStore():
+    '''
+    Read-only access to an HDF5 ROI data file.
+
+    Only the metadata (groups, number of planes, masks, footprint dims & video paths) is read
+    when the store is opened; footprints, traces and ROI states are read one plane at a time.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        with h5py.File(path, 'r') as f:
+            self.video_paths = json.loads(f.attrs['video_paths'])
+
+            self.n_planes = {}
+            self.masks    = {}
+            self.dims     = {}
+            for name in f['groups'].keys():
+                self.n_planes[int(name)] = int(f['groups'][name].attrs['n_planes'])
+                self.masks[int(name)]    = json.loads(f['groups'][name].attrs['masks'])
+
+                # files saved before footprint dims were stored don't have them
+                if 'dims' in f['groups'][name].attrs:
+                    self.dims[int(name)] = tuple([ int(dim) for dim in f['groups'][name].attrs['dims'] ])
+
+    def group_nums(self):
+        return sorted(self.n_planes.keys())
+
+    def read(self, group_num, z, key):
+        with h5py.File(self.path, 'r') as f:
+            plane = f['groups'][str(int(group_num))]['planes'][str(z)]
+
+            if key == 'roi_state':
+                return read_roi_state(plane['roi_state'])
+            else:
+                return read_matrix(plane[key])
+
+    def has(self, group_num, z, key):
+        with h5py.File(self.path, 'r') as f:
+            return key in f['groups'][str(int(group_num))]['planes'][str(z)]
+
+    def read_trace_rows(self, group_num, z, key, rows):
+        '''Reads only the given rows (ROIs) of a trace array.'''
+
+        with h5py.File(self.path, 'r') as f:
+            dataset = f['groups'][str(int(group_num))]['planes'][str(z)][key]
+
+            rows = np.asarray(rows, dtype=int)
+            order = np.argsort(rows)
+
+            # h5py needs increasing indices
+            data = dataset[rows[order].tolist(), :] if len(rows) > 0 else np.zeros((0, dataset.shape[1]), dtype=dataset.dtype)
+
+            return data[np.argsort(order)]
+
+    def planes(self, group_num, key):
+        return LazyPlanes(self, group_num, key)
+
+class LazyPlanes():
+    '''
+    A list-like view of one kind of ROI data (eg. spatial footprints) for each plane of a
+    group in an ROIStore. Each plane is read from disk the first time it is accessed, and
+    planes can be replaced like items of a list.
+    '''
+
+    def __init__(self, store, group_num, key):
+        self.store     = store
+        self.group_num = group_num
+        self.key       = key
+        self.cache     = {}
+
+    def __len__(self):
+        return self.store.n_planes[self.group_num]
+
+    def __getitem__(self, z):
+        if isinstance(z, slice):
+            return [ self[i] for i in range(len(self))[z] ]
+
+        if z < 0:
+            z += len(self)
+
+        if not 0 <= z < len(self):
+            raise IndexError("Plane index out of range.")
+
+        if z not in self.cache.keys():
+            self.cache[z] = self.store.read(self.group_num, z, self.key)
+
+        return self.cache[z]
+
+    def __setitem__(self, z, value):
+        self.cache[z] = value
+
+    def __iter__(self):
+        for z in range(len(self)):
+            yield self[z]
+
+    def tolist(self):
+        return [ self[z] for z in range(len(self)) ]
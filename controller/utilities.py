@@ -18,7 +18,6 @@ from caiman.source_extraction.cnmf import cnmf as cnmf
 from caiman.source_extraction.cnmf import params as cnmf_params
 from caiman.source_extraction.cnmf import estimates as estimates
 from caiman.components_evaluation import estimate_components_quality_auto
-from caiman.source_extraction.cnmf.temporal import update_temporal_components
 from caiman.source_extraction.cnmf.pre_processing import preprocess_data
 from caiman.motion_correction import MotionCorrect
 from caiman.paths import caiman_datadir
@@ -29,6 +28,11 @@ from keras import optimizers
 from keras.preprocessing.image import ImageDataGenerator
 import logging
 
+from .lazy_video import GroupVideo, save_plane_tiff, save_plane_memmap, plane_memmap_name, get_patch_grid_shape, apply_pw_rigid_shifts, apply_border, MC_SHIFTS_SUFFIX
+from .mc_cache import hash_array
+from . import parallel
+from .roi_geometry import ROISpatialIndex
+
 # see if suite2p is available
 try:
     import suite2p
@@ -51,14 +55,63 @@ def adjust_contrast(image, contrast):
 def adjust_gamma(image, gamma):
     return skimage.exposure.adjust_gamma(image, gamma)
 
-def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_stride, patch_overlap, progress_signal=None, thread=None, use_multiprocessing=True):
+class ContrastLUT():
+    '''
+    A lookup table that maps pixel values (0 to video_max) straight to the uint8 values that are
+    displayed after contrast & gamma adjustment, ie. 255*adjust_gamma(adjust_contrast(value))/video_max.
+
+    The table has a whole number of entries per unit of pixel value (at least 256 entries in
+    total), so integer frames are adjusted exactly with a single table lookup, while videos with
+    a small range (eg. floats up to 1) are quantized to 256 levels.
+    '''
+
+    def __init__(self, contrast, gamma, video_max):
+        self.contrast  = contrast
+        self.gamma     = gamma
+        self.video_max = video_max
+
+        # number of table entries per unit of pixel value
+        self.scale = max(1, int(np.ceil(255.0/video_max)))
+
+        n_levels = int(np.ceil(video_max*self.scale)) + 1
+
+        values = adjust_gamma(adjust_contrast(np.arange(n_levels)/self.scale, contrast), gamma)
+
+        self.lut = np.clip(255.0*values/video_max, 0, 255).astype(np.uint8)
+
+    def matches(self, contrast, gamma, video_max):
+        return (self.contrast, self.gamma, self.video_max) == (contrast, gamma, video_max)
+
+    def __call__(self, image):
+        image = np.asarray(image)
+
+        if image.dtype.kind in 'ui':
+            indices = image if self.scale == 1 else image.astype(np.intp)*self.scale
+        else:
+            indices = np.rint(image*self.scale).astype(np.intp)
+
+        # values outside of the table's range are clipped to its ends
+        return np.take(self.lut, indices, mode='clip')
+
+# rough number of copies of a plane (as float32) held in memory by a motion correction, CNMF or ROI filtering job
+MC_MEMORY_FACTOR     = 3
+CNMF_MEMORY_FACTOR   = 4
+FILTER_MEMORY_FACTOR = 2
+
+def plane_memory(video):
+    '''Returns the size (in bytes) of one plane of a video as float32.'''
+    return video.shape[0]*int(np.prod(video.shape[2:]))*4
+
+def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_stride, patch_overlap, progress_signal=None, thread=None, use_multiprocessing=True, parallel_planes=False, max_workers=0, mc_cache=None, shifts_only=False):
     start_time = time.time()
 
     mc_video_paths = []
-    mc_videos  = []
     mc_borders = {}
 
-    if use_multiprocessing:
+    # whether to motion correct all planes of all groups concurrently
+    parallel_planes = use_multiprocessing and parallel_planes
+
+    if use_multiprocessing and not parallel_planes:
         print("Using multiprocessing.")
 
         backend = 'multiprocessing'
@@ -73,85 +126,67 @@ def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_s
 
     group_nums = np.unique(video_groups)
 
+    group_videos         = []
+    group_mc_video_paths = []
+
     for n in range(len(group_nums)):
         group_num = group_nums[n]
         paths = [ video_paths[i] for i in range(len(video_paths)) if video_groups[i] == group_num ]
 
-        video_lengths = []
-
-        directory = os.path.dirname(paths[0])
+        # create a lazy view of the concatenated videos in this group,
+        # flipped 90 degrees to match what is shown in Fiji
+        group_video = GroupVideo(paths).transpose((0, 1, 3, 2))
 
-        final_video_path = os.path.join(directory, "final_video_temp.tif")
-
-        with tifffile.TiffWriter(final_video_path) as tif:
-            for i in range(len(paths)):
-                video_path = paths[i]
-                new_video_path = os.path.join(directory, "video_temp.tif")
-
-                shutil.copyfile(video_path, new_video_path)
-
-                video = tifffile.memmap(new_video_path)
-
-                if len(video.shape) == 3:
-                    # add a z dimension
-                    video = video[:, np.newaxis, :, :]
-
-                # flip video 90 degrees to match what is shown in Fiji
-                video = video.transpose((0, 1, 3, 2))
-
-                video_lengths.append(video.shape[0])
-
-                for k in range(video.shape[0]):
-                    tif.save(video[k])
+        # create the motion-corrected videos, which are filled in one z plane at a time,
+        # or pick the paths of the files that will hold their shifts
+        paths_mc = []
+        for i in range(len(paths)):
+            video_path = paths[i]
+            directory  = os.path.dirname(video_path)
+            filename   = os.path.basename(video_path)
 
-                del video
+            if shifts_only:
+                mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + MC_SHIFTS_SUFFIX)
+            else:
+                mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
 
-                if os.path.exists(new_video_path):
-                    os.remove(new_video_path)
+                mc_video = tifffile.memmap(mc_video_path, shape=(group_video.video_lengths[i],) + group_video.file_shape[1:], dtype=np.uint16)
+                del mc_video
 
-        final_video = tifffile.memmap(final_video_path)
+            paths_mc.append(mc_video_path)
 
-        if len(final_video.shape) == 5:
-            final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-            tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-            if os.path.exists(final_video_path):
-                os.remove(final_video_path)
-        else:
-            final_video_path_2 = final_video_path
+        group_videos.append(group_video)
+        group_mc_video_paths.append(paths_mc)
 
-        del final_video
+        mc_video_paths += paths_mc
 
-        mc_video, new_video_path, mc_borders[group_num] = motion_correct(final_video_path_2, max_shift, patch_stride, patch_overlap, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes)
-        
-        mc_video = mc_video.transpose((0, 1, 3, 2))
+    if parallel_planes:
+        mc_borders, n_cached = motion_correct_planes_parallel(group_nums, group_videos, group_mc_video_paths, max_shift, patch_stride, patch_overlap, progress_signal=progress_signal, max_workers=max_workers, mc_cache=mc_cache, shifts_only=shifts_only)
+    else:
+        n_cached = 0
+        for n in range(len(group_nums)):
+            group_num = group_nums[n]
 
-        print(len(paths))
+            mc_borders[group_num], group_n_cached, plane_shifts = motion_correct(group_videos[n], group_mc_video_paths[n], max_shift, patch_stride, patch_overlap, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, mc_cache=mc_cache, shifts_only=shifts_only)
 
-        for i in range(len(paths)):
-            print("Saving motion-corrected video for {}.".format(paths[i]))
+            n_cached += group_n_cached
 
-            video_path    = paths[i]
-            directory     = os.path.dirname(video_path)
-            filename      = os.path.basename(video_path)
-            mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
+            if shifts_only:
+                save_mc_shifts(group_videos[n], group_mc_video_paths[n], plane_shifts)
 
-            if i == 0:
-                tifffile.imsave(mc_video_path, mc_video[:video_lengths[0]])
-            else:
-                tifffile.imsave(mc_video_path, mc_video[np.sum(video_lengths[:i]):np.sum(video_lengths[:i]) + video_lengths[i]])
+            for mc_video_path in group_mc_video_paths[n]:
+                print("Saved motion-corrected video {}.".format(mc_video_path))
 
-            mc_video_paths.append(mc_video_path)
+            if progress_signal is not None:
+                progress_signal.emit(n)
 
-        if progress_signal is not None:
-            progress_signal.emit(n)
+    if mc_cache is not None:
+        n_planes = sum([ len(group_video.video_paths)*group_video.shape[1] for group_video in group_videos ])
+        print("Motion correction cache: reused {} of {} video planes ({} misses).".format(n_cached, n_planes, n_planes - n_cached))
 
-        if os.path.exists(final_video_path_2):
-            os.remove(final_video_path_2)
-            os.remove(new_video_path)
+    del group_videos
 
-        del mc_video
-
-    if use_multiprocessing:
+    if use_multiprocessing and not parallel_planes:
         if backend == 'multiprocessing':
             dview.close()
         else:
@@ -161,152 +196,388 @@ def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_s
                 dview.shutdown()
         cm.stop_server()
 
+    log_files = glob.glob('Yr*_LOG_*')
+    for log_file in log_files:
+        os.remove(log_file)
+
     end_time = time.time()
 
     print("---- Motion correction finished. Elapsed time: {} s.".format(end_time - start_time))
             
     return mc_video_paths, mc_borders
 
-def motion_correct(video_path, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, c=None, dview=None, n_processes=1):
-    full_video_path = video_path
-
-    directory = os.path.dirname(full_video_path)
-    filename  = os.path.basename(full_video_path)
-
-    memmap_video = tifffile.memmap(video_path)
-
-    z_range = list(range(memmap_video.shape[1]))
+def motion_correct_planes_parallel(group_nums, group_videos, group_mc_video_paths, max_shift, patch_stride, patch_overlap, progress_signal=None, max_workers=0, mc_cache=None, shifts_only=False):
+    # create a job for every plane of every group
+    jobs       = []
+    job_groups = []
+    for n in range(len(group_nums)):
+        for z in range(group_videos[n].shape[1]):
+            jobs.append([group_videos[n], z, group_mc_video_paths[n], max_shift, patch_stride, patch_overlap])
+            job_groups.append(n)
 
-    new_video_path = os.path.join(directory, "mc_video_temp.tif")
-
-    shutil.copyfile(video_path, new_video_path)
-
-    mc_video = tifffile.memmap(new_video_path).astype(np.uint16)
-
-    mc_borders = [ None for z in z_range ]
-
-    counter = 0
-
-    for z in z_range:
-        print("Motion correcting plane z={}...".format(z))
-        z_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_z_{}_temp.tif".format(z))
-        tifffile.imsave(z_video_path, memmap_video[:, z, :, :])
-
-        mc_video[:, z, :, :] *= 0
-
-        # --- PARAMETERS --- #
-
-        params_movie = {'fname': z_video_path,
-                        'max_shifts': (max_shift, max_shift),  # maximum allow rigid shift (2,2)
-                        'niter_rig': 3,
-                        'splits_rig': 1,  # for parallelization split the movies in  num_splits chuncks across time
-                        'num_splits_to_process_rig': None,  # if none all the splits are processed and the movie is saved
-                        'strides': (patch_stride, patch_stride),  # intervals at which patches are laid out for motion correction
-                        'overlaps': (patch_overlap, patch_overlap),  # overlap between pathes (size of patch strides+overlaps)
-                        'splits_els': 1,  # for parallelization split the movies in  num_splits chuncks across time
-                        'num_splits_to_process_els': [None],  # if none all the splits are processed and the movie is saved
-                        'upsample_factor_grid': 4,  # upsample factor to avoid smearing when merging patches
-                        'max_deviation_rigid': 3,  # maximum deviation allowed for patch with respect to rigid shift         
-                        }
-
-        # load movie (in memory!)
-        fname = params_movie['fname']
-        niter_rig = params_movie['niter_rig']
-        # maximum allow rigid shift
-        max_shifts = params_movie['max_shifts']  
-        # for parallelization split the movies in  num_splits chuncks across time
-        splits_rig = params_movie['splits_rig']  
-        # if none all the splits are processed and the movie is saved
-        num_splits_to_process_rig = params_movie['num_splits_to_process_rig']
-        # intervals at which patches are laid out for motion correction
-        strides = params_movie['strides']
-        # overlap between pathes (size of patch strides+overlaps)
-        overlaps = params_movie['overlaps']
-        # for parallelization split the movies in  num_splits chuncks across time
-        splits_els = params_movie['splits_els'] 
-        # if none all the splits are processed and the movie is saved
-        num_splits_to_process_els = params_movie['num_splits_to_process_els']
-        # upsample factor to avoid smearing when merging patches
-        upsample_factor_grid = params_movie['upsample_factor_grid'] 
-        # maximum deviation allowed for patch with respect to rigid
-        # shift
-        max_deviation_rigid = params_movie['max_deviation_rigid']
-
-        # --- RIGID MOTION CORRECTION --- #
-
-        # Load the original movie
-        m_orig = tifffile.memmap(fname)
-        # m_orig = cm.load(fname)
-        min_mov = np.min(m_orig) # movie must be mostly positive for this to work
-
-        offset_mov = -min_mov
-
-        # Create motion correction object
-        mc = MotionCorrect(fname, min_mov,
-                           dview=dview, max_shifts=max_shifts, niter_rig=niter_rig, splits_rig=splits_rig, 
-                           num_splits_to_process_rig=num_splits_to_process_rig, 
-                        strides= strides, overlaps= overlaps, splits_els=splits_els,
-                        num_splits_to_process_els=num_splits_to_process_els, 
-                        upsample_factor_grid=upsample_factor_grid, max_deviation_rigid=max_deviation_rigid, 
-                        shifts_opencv = True, nonneg_movie = True, border_nan='min')
-
-        # Do rigid motion correction
-        mc.motion_correct_rigid(save_movie=False)
-
-        # --- ELASTIC MOTION CORRECTION --- #
-
-        # Do elastic motion correction
-        mc.motion_correct_pwrigid(save_movie=True, template=mc.total_template_rig, show_template=False)
-
-        # # Save elastic shift border
-        bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
-                                 np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
-
-        fnames = mc.fname_tot_els   # name of the pw-rigidly corrected file.
-        border_to_0 = bord_px_els     # number of pixels to exclude
-        fname_new = cm.save_memmap(fnames, base_name='memmap_z_{}'.format(z), order = 'C',
-                                   border_to_0 = bord_px_els) # exclude borders
-
-        # now load the file
-        Yr, dims, T = cm.load_memmap(fname_new)
-        d1, d2 = dims
-        images = np.reshape(Yr.T, [T] + list(dims), order='F') 
-
-        mc_borders[z] = bord_px_els
-
-        mc_video[:, z, :, :] = (images - np.amin(images)).astype(memmap_video.dtype)
-
-        del m_orig
-        if os.path.exists(z_video_path):
-            os.remove(z_video_path)
+    # split the worker budget between the planes, making sure they fit in memory
+    job_memory = max([ plane_memory(group_video) for group_video in group_videos ])*MC_MEMORY_FACTOR
+    n_concurrent, n_processes = parallel.plan_jobs(len(jobs), job_memory, max_workers)
+
+    print("Motion correcting {} planes using {} concurrent jobs with {} process(es) each.".format(len(jobs), n_concurrent, n_processes))
+
+    for job in jobs:
+        job += [n_processes, mc_cache, shifts_only]
+
+    mc_borders   = { group_num: [ None for z in range(group_videos[n].shape[1]) ] for n, group_num in enumerate(group_nums) }
+    plane_shifts = { group_num: [ None for z in range(group_videos[n].shape[1]) ] for n, group_num in enumerate(group_nums) }
+
+    planes_left = [ job_groups.count(n) for n in range(len(group_nums)) ]
+    groups_done = [ 0 ]
+    n_cached    = [ 0 ]
+
+    def job_finished(i, result):
+        n = job_groups[i]
+        z = jobs[i][1]
+
+        mc_borders[group_nums[n]][z]   = result[0]
+        plane_shifts[group_nums[n]][z] = result[2]
+        n_cached[0] += result[1]
+
+        planes_left[n] -= 1
+
+        print("Finished motion correcting plane z={} of group {}.".format(z, group_nums[n]))
+
+        # report progress each time all of the planes in a group are done
+        if planes_left[n] == 0:
+            if shifts_only:
+                save_mc_shifts(group_videos[n], group_mc_video_paths[n], plane_shifts[group_nums[n]])
+
+            for mc_video_path in group_mc_video_paths[n]:
+                print("Saved motion-corrected video {}.".format(mc_video_path))
+
+            if progress_signal is not None:
+                progress_signal.emit(groups_done[0])
+
+            groups_done[0] += 1
+
+    parallel.run_jobs(motion_correct_plane_job, [ tuple(job) for job in jobs ], n_concurrent, callback=job_finished)
+
+    return mc_borders, n_cached[0]
+
+def motion_correct_plane_job(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, n_processes=1, mc_cache=None, shifts_only=False):
+    # start a cluster for this plane using its share of the worker budget
+    dview = parallel.start_local_cluster(n_processes)
+
+    try:
+        result = motion_correct_plane(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, dview=dview, mc_cache=mc_cache, shifts_only=shifts_only)
+    finally:
+        parallel.stop_local_cluster(dview)
+
+    return result
+
+def motion_correct(video, mc_video_paths, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, c=None, dview=None, n_processes=1, mc_cache=None, shifts_only=False):
+    mc_borders   = [ None for z in range(video.shape[1]) ]
+    plane_shifts = [ None for z in range(video.shape[1]) ]
+    n_cached     = 0
+
+    for z in range(video.shape[1]):
+        mc_borders[z], plane_n_cached, plane_shifts[z] = motion_correct_plane(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, dview=dview, mc_cache=mc_cache, shifts_only=shifts_only)
+
+        n_cached += plane_n_cached
+
+    return mc_borders, n_cached, plane_shifts
+
+def motion_correct_plane(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, dview=None, mc_cache=None, shifts_only=False):
+    if mc_cache is not None or shifts_only:
+        return motion_correct_plane_from_shifts(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, dview=dview, mc_cache=mc_cache, shifts_only=shifts_only)
+
+    directory = os.path.dirname(mc_video_paths[0])
+    filename  = os.path.basename(mc_video_paths[0])
+
+    print("Motion correcting plane z={}...".format(z))
+
+    # temporary files are named after the group & plane so that planes can be corrected concurrently
+    z_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_z_{}_temp.tif".format(z))
+    save_plane_tiff(video, z, z_video_path)
+
+    # --- PARAMETERS --- #
+
+    params_movie = {'fname': z_video_path,
+                    'max_shifts': (max_shift, max_shift),  # maximum allow rigid shift (2,2)
+                    'niter_rig': 3,
+                    'splits_rig': 1,  # for parallelization split the movies in  num_splits chuncks across time
+                    'num_splits_to_process_rig': None,  # if none all the splits are processed and the movie is saved
+                    'strides': (patch_stride, patch_stride),  # intervals at which patches are laid out for motion correction
+                    'overlaps': (patch_overlap, patch_overlap),  # overlap between pathes (size of patch strides+overlaps)
+                    'splits_els': 1,  # for parallelization split the movies in  num_splits chuncks across time
+                    'num_splits_to_process_els': [None],  # if none all the splits are processed and the movie is saved
+                    'upsample_factor_grid': 4,  # upsample factor to avoid smearing when merging patches
+                    'max_deviation_rigid': 3,  # maximum deviation allowed for patch with respect to rigid shift         
+                    }
+
+    # load movie (in memory!)
+    fname = params_movie['fname']
+    niter_rig = params_movie['niter_rig']
+    # maximum allow rigid shift
+    max_shifts = params_movie['max_shifts']  
+    # for parallelization split the movies in  num_splits chuncks across time
+    splits_rig = params_movie['splits_rig']  
+    # if none all the splits are processed and the movie is saved
+    num_splits_to_process_rig = params_movie['num_splits_to_process_rig']
+    # intervals at which patches are laid out for motion correction
+    strides = params_movie['strides']
+    # overlap between pathes (size of patch strides+overlaps)
+    overlaps = params_movie['overlaps']
+    # for parallelization split the movies in  num_splits chuncks across time
+    splits_els = params_movie['splits_els'] 
+    # if none all the splits are processed and the movie is saved
+    num_splits_to_process_els = params_movie['num_splits_to_process_els']
+    # upsample factor to avoid smearing when merging patches
+    upsample_factor_grid = params_movie['upsample_factor_grid'] 
+    # maximum deviation allowed for patch with respect to rigid
+    # shift
+    max_deviation_rigid = params_movie['max_deviation_rigid']
+
+    # --- RIGID MOTION CORRECTION --- #
+
+    # Load the original movie
+    m_orig = tifffile.memmap(fname)
+    # m_orig = cm.load(fname)
+    min_mov = np.min(m_orig) # movie must be mostly positive for this to work
+
+    offset_mov = -min_mov
+
+    # Create motion correction object
+    mc = MotionCorrect(fname, min_mov,
+                       dview=dview, max_shifts=max_shifts, niter_rig=niter_rig, splits_rig=splits_rig, 
+                       num_splits_to_process_rig=num_splits_to_process_rig, 
+                    strides= strides, overlaps= overlaps, splits_els=splits_els,
+                    num_splits_to_process_els=num_splits_to_process_els, 
+                    upsample_factor_grid=upsample_factor_grid, max_deviation_rigid=max_deviation_rigid, 
+                    shifts_opencv = True, nonneg_movie = True, border_nan='min')
+
+    # Do rigid motion correction
+    mc.motion_correct_rigid(save_movie=False)
+
+    # --- ELASTIC MOTION CORRECTION --- #
+
+    # Do elastic motion correction
+    mc.motion_correct_pwrigid(save_movie=True, template=mc.total_template_rig, show_template=False)
+
+    # # Save elastic shift border
+    bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
+                             np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
+
+    fnames = mc.fname_tot_els   # name of the pw-rigidly corrected file.
+    border_to_0 = bord_px_els     # number of pixels to exclude
+    fname_new = cm.save_memmap(fnames, base_name=os.path.splitext(os.path.basename(z_video_path))[0] + '_memmap', order = 'C',
+                               border_to_0 = bord_px_els) # exclude borders
+
+    # now load the file
+    Yr, dims, T = cm.load_memmap(fname_new)
+    d1, d2 = dims
+    images = np.reshape(Yr.T, [T] + list(dims), order='F') 
+
+    # write this plane into each of the motion-corrected videos, flipped back to their original orientation
+    min_value = np.amin(images)
+    for i in range(len(mc_video_paths)):
+        mc_video = tifffile.memmap(mc_video_paths[i], mode='r+')
+        if len(mc_video.shape) == 3:
+            mc_video = mc_video[:, np.newaxis, :, :]
+
+        mc_video[:, z, :, :] = (images[video.offsets[i]:video.offsets[i+1]] - min_value).astype(video.dtype).transpose((0, 2, 1))
+
+        mc_video.flush()
+        del mc_video
+
+    del m_orig, Yr, images
 
+    # remove this plane's temporary files
+    temp_paths = [z_video_path, fname_new] + list(np.atleast_1d(mc.fname_tot_rig)) + list(np.atleast_1d(mc.fname_tot_els))
+    for temp_path in temp_paths:
         try:
-            os.remove(mc.fname_tot_rig)
-            os.remove(mc.fname_tot_els)
+            os.remove(temp_path)
         except:
             pass
 
-        counter += 1
+    return bord_px_els, 0, None
+
+def motion_correct_plane_from_shifts(video, z, mc_video_paths, max_shift, patch_stride, patch_overlap, dview=None, mc_cache=None, shifts_only=False):
+    n_videos = len(video.video_paths)
+
+    if mc_cache is not None:
+        keys    = [ mc_cache.key(video_path, z, max_shift, patch_stride, patch_overlap) for video_path in video.video_paths ]
+        entries = [ mc_cache.load(key) for key in keys ]
+    else:
+        entries = [ None for i in range(n_videos) ]
+
+    # only reuse entries that were estimated against the same template, picking the most common one
+    template_ids = [ str(entry['template_id']) for entry in entries if entry is not None ]
+    if len(template_ids) > 0:
+        template_id = max(set(template_ids), key=template_ids.count)
+        entries     = [ entry if entry is not None and str(entry['template_id']) == template_id else None for entry in entries ]
+        template    = [ entry for entry in entries if entry is not None ][0]['template']
+    else:
+        template = None
+
+    missing = [ i for i in range(n_videos) if entries[i] is None ]
+
+    print("Motion correcting plane z={} ({} of {} videos cached)...".format(z, n_videos - len(missing), n_videos))
+
+    if len(missing) > 0:
+        # estimate shifts for the videos that aren't cached, against the cached template if there is one
+        new_entries = estimate_motion(video, z, missing, mc_video_paths, max_shift, patch_stride, patch_overlap, template=template, dview=dview)
+
+        for i in range(len(missing)):
+            entries[missing[i]] = new_entries[i]
+
+            if mc_cache is not None:
+                mc_cache.save(keys[missing[i]], new_entries[i])
+
+    border = max([ int(entry['border']) for entry in entries ])
+
+    if shifts_only:
+        # minimum of the raw frames -- finding the minimum of the warped frames would mean warping the whole video
+        min_value = min([ float(entry['min_value']) for entry in entries ])
+
+        # return the shifts instead of applying them
+        plane_shifts = {'x_shifts_els': [ entry['x_shifts_els'] for entry in entries ],
+                        'y_shifts_els': [ entry['y_shifts_els'] for entry in entries ],
+                        'shifts_rig'  : [ entry['shifts_rig'] for entry in entries ],
+                        'grid_shape'  : entries[0]['grid_shape'],
+                        'min_value'   : min_value,
+                        'border'      : border}
+
+        return border, n_videos - len(missing), plane_shifts
+
+    # apply the shifts to each video, keeping the warped frames in temporary files -- like the
+    # motion-corrected movie saved by CaImAn, the minimum of the warped frames of all of the
+    # videos is subtracted, so it has to be known before anything is written
+    directory = os.path.dirname(mc_video_paths[0])
+    filename  = os.path.basename(mc_video_paths[0])
+
+    warped_paths = [ os.path.join(directory, os.path.splitext(filename)[0] + "_z_{}_video_{}_warped_temp.npy".format(z, i)) for i in range(n_videos) ]
+
+    min_value = np.inf
+
+    for i in range(n_videos):
+        frames = np.arange(video.offsets[i], video.offsets[i+1])
+
+        warped = np.lib.format.open_memmap(warped_paths[i], mode='w+', dtype=np.float32, shape=(len(frames),) + tuple(video.shape[2:]))
+
+        for start, chunk in video.iter_chunks(z, frames=frames):
+            for k in range(chunk.shape[0]):
+                warped[start+k] = apply_pw_rigid_shifts(chunk[k], entries[i]['x_shifts_els'][start+k], entries[i]['y_shifts_els'][start+k], tuple(entries[i]['grid_shape']))
+
+            min_value = min(min_value, float(np.amin(warped[start:start+chunk.shape[0]])))
+
+        warped.flush()
+        del warped
+
+    for i in range(n_videos):
+        mc_video = tifffile.memmap(mc_video_paths[i], mode='r+')
+        if len(mc_video.shape) == 3:
+            mc_video = mc_video[:, np.newaxis, :, :]
+
+        warped = np.load(warped_paths[i], mmap_mode='r')
+
+        for start in range(0, warped.shape[0], 100):
+            # the border is set to the minimum, as CaImAn does when saving the movie
+            corrected = apply_border(warped[start:start+100] - min_value, border)
+
+            mc_video[start:start+corrected.shape[0], z, :, :] = corrected.astype(video.dtype).transpose((0, 2, 1))
+
+        mc_video.flush()
+        del mc_video, warped
 
-    mmap_files = glob.glob(os.path.join(directory, '*.mmap'))
-    for mmap_file in mmap_files:
         try:
-            os.remove(mmap_file)
+            os.remove(warped_paths[i])
         except:
             pass
 
-    log_files = glob.glob('Yr*_LOG_*')
-    for log_file in log_files:
-        os.remove(log_file)
+    return border, n_videos - len(missing), None
+
+def save_mc_shifts(video, mc_shifts_paths, plane_shifts):
+    '''Saves the motion correction shifts of every plane of each video in a group, in place of motion-corrected videos.'''
+
+    for i in range(len(mc_shifts_paths)):
+        np.savez(mc_shifts_paths[i],
+                 video_path=os.path.abspath(video.video_paths[i]),
+                 x_shifts_els=np.stack([ shifts['x_shifts_els'][i] for shifts in plane_shifts ], axis=0),
+                 y_shifts_els=np.stack([ shifts['y_shifts_els'][i] for shifts in plane_shifts ], axis=0),
+                 shifts_rig=np.stack([ shifts['shifts_rig'][i] for shifts in plane_shifts ], axis=0),
+                 grid_shape=plane_shifts[0]['grid_shape'],
+                 min_value=np.array([ shifts['min_value'] for shifts in plane_shifts ]),
+                 border=np.array([ shifts['border'] for shifts in plane_shifts ]))
+
+def estimate_motion(video, z, video_indices, mc_video_paths, max_shift, patch_stride, patch_overlap, template=None, dview=None):
+    '''Estimates the rigid & piecewise rigid shifts of plane z of the videos at the given indices. Returns a motion correction cache entry for each video.'''
+
+    directory = os.path.dirname(mc_video_paths[0])
+    filename  = os.path.basename(mc_video_paths[0])
+
+    frames = np.concatenate([ np.arange(video.offsets[i], video.offsets[i+1]) for i in video_indices ])
 
-    return mc_video, new_video_path, mc_borders
+    z_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_z_{}_temp.tif".format(z))
+    save_plane_tiff(video, z, z_video_path, frames=frames)
 
-def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params, mc_borders={}, progress_signal=None, thread=None, use_multiprocessing=True, method="cnmf", mask_points=[], ignored_frames=[]):
+    m_orig  = tifffile.memmap(z_video_path)
+    min_mov = np.min(m_orig) # movie must be mostly positive for this to work
+
+    # Create motion correction object
+    mc = MotionCorrect(z_video_path, min_mov,
+                       dview=dview, max_shifts=(max_shift, max_shift), niter_rig=3, splits_rig=1, num_splits_to_process_rig=None,
+                       strides=(patch_stride, patch_stride), overlaps=(patch_overlap, patch_overlap), splits_els=1,
+                       num_splits_to_process_els=[None], upsample_factor_grid=4, max_deviation_rigid=3,
+                       shifts_opencv=True, nonneg_movie=True, border_nan='min')
+
+    # Do rigid & elastic motion correction, without saving the movies -- the shifts are applied later
+    mc.motion_correct_rigid(template=template, save_movie=False)
+
+    if template is None:
+        template = mc.total_template_rig
+
+    mc.motion_correct_pwrigid(save_movie=False, template=template, show_template=False)
+
+    x_shifts_els = np.array(mc.x_shifts_els, dtype=np.float32)
+    y_shifts_els = np.array(mc.y_shifts_els, dtype=np.float32)
+    shifts_rig   = np.array(mc.shifts_rig, dtype=np.float32)
+    grid_shape   = np.array(get_patch_grid_shape(video.shape[2:], patch_stride, patch_overlap))
+
+    # videos estimated together share a template
+    template    = np.array(template, dtype=np.float32)
+    template_id = hash_array(template)
+
+    entries = []
+    start   = 0
+    for i in video_indices:
+        end = start + video.video_lengths[i]
+
+        entries.append({'x_shifts_els': x_shifts_els[start:end],
+                        'y_shifts_els': y_shifts_els[start:end],
+                        'shifts_rig'  : shifts_rig[start:end],
+                        'grid_shape'  : grid_shape,
+                        'template'    : template,
+                        'template_id' : template_id,
+                        'min_value'   : np.min(m_orig[start:end]),
+                        'border'      : int(np.ceil(np.maximum(np.max(np.abs(x_shifts_els[start:end])), np.max(np.abs(y_shifts_els[start:end])))))})
+
+        start = end
+
+    del m_orig
+
+    try:
+        os.remove(z_video_path)
+    except:
+        pass
+
+    return entries
+
+def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params, mc_borders={}, progress_signal=None, thread=None, use_multiprocessing=True, method="cnmf", mask_points=[], ignored_frames=[], plane_progress_signal=None):
     start_time = time.time()
 
     group_nums = np.unique(video_groups)
 
-    if use_multiprocessing and method == "cnmf":
+    # whether to find ROIs in all planes of all groups concurrently
+    parallel_planes = use_multiprocessing and method == "cnmf" and params['parallel_planes']
+
+    if use_multiprocessing and method == "cnmf" and not parallel_planes:
         backend = 'multiprocessing'
 
         # Create the cluster
@@ -323,104 +594,91 @@ def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params,
     new_bg_spatial_footprints   = {}
     new_bg_temporal_footprints  = {}
 
+    group_videos             = []
+    group_ignored_frames     = []
+    group_mc_borders         = []
+
     for n in range(len(group_nums)):
         group_num = group_nums[n]
         paths   = [ video_paths[i] for i in range(len(video_paths)) if video_groups[i] == group_num ]
         lengths = [ video_lengths[i] for i in range(len(video_lengths)) if video_groups[i] == group_num ]
 
-        group_ignored_frames = []
+        ignored = []
         for i in range(len(paths)):
             path = paths[i]
             index = video_paths.index(path)
-            group_ignored_frames += [ int(f + np.sum(lengths[:i])) for f in ignored_frames[index] ]
-
-        print("Ignoring frames {}.".format(group_ignored_frames))
+            ignored += [ int(f + np.sum(lengths[:i])) for f in ignored_frames[index] ]
 
-        directory = os.path.dirname(paths[0])
+        print("Ignoring frames {}.".format(ignored))
 
-        final_video_path = os.path.join(directory, "final_video_temp.tif")
+        # remove memmaps left over from the last time ROIs were found
+        remove_plane_memmaps(paths)
 
-        with tifffile.TiffWriter(final_video_path, bigtiff=False) as tif:
-            for i in range(len(paths)):
-                video_path = paths[i]
-                new_video_path = os.path.join(directory, "video_temp.tif")
+        # create a lazy view of the concatenated videos in this group
+        group_video = GroupVideo(paths).transpose((0, 1, 3, 2))
 
-                shutil.copyfile(video_path, new_video_path)
+        if len(mask_points) > 0 and n in mask_points.keys():
+            mask = np.zeros(group_video.shape[1:]).astype(np.uint8)
+            for z in range(group_video.shape[1]):
+                if len(mask_points[n][z]) > 0:
+                    for p in mask_points[n][z]:
+                        # create mask image
+                        p = np.fliplr(np.array(p + [p[0]])).astype(int)
 
-                video = tifffile.memmap(new_video_path)
+                        cv2.fillConvexPoly(mask[z, :, :], p, 1)
 
-                if len(video.shape) == 3:
-                    # add a z dimension
-                    video = video[:, np.newaxis, :, :]
+                if np.sum(mask[z]) == 0:
+                    mask[z] = 1
 
-                video = video.transpose((0, 1, 3, 2))
+            mask = mask.astype(bool)
 
-                if len(mask_points) > 0 and n in mask_points.keys():
-                    mask = np.zeros(video.shape[1:]).astype(np.uint8)
-                    for z in range(video.shape[1]):
-                        if len(mask_points[n][z]) > 0:
-                            for p in mask_points[n][z]:
-                                # create mask image
-                                p = np.fliplr(np.array(p + [p[0]])).astype(int)
+            if not params['invert_masks']:
+                mask = mask == False
 
-                                cv2.fillConvexPoly(mask[z, :, :], p, 1)
-
-                        if np.sum(mask[z]) == 0:
-                            mask[z] = 1
-
-                    mask = mask.astype(bool)
-
-                    if not params['invert_masks']:
-                        mask = mask == False
-
-                    mask = np.repeat(mask[np.newaxis, :, :, :], video.shape[0], axis=0)
-
-                    video[mask] = 0
-
-                for k in range(video.shape[0]):
-                    tif.save(video[k])
-
-                del video
-
-                if os.path.exists(new_video_path):
-                    os.remove(new_video_path)
-
-        final_video = tifffile.memmap(final_video_path).astype(np.uint16)
-
-        if len(final_video.shape) == 5:
-            final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-            
-            tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-            if os.path.exists(final_video_path):
-                os.remove(final_video_path)
-        else:
-            final_video_path_2 = final_video_path
-
-        del final_video
+            # masked pixels are zeroed out as frames are read
+            group_video.set_masks(mask)
 
         if len(mc_borders.keys()) > 0:
             borders = mc_borders[group_num]
         else:
             borders = None
 
-        if method == "cnmf":
-            roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_cnmf(final_video_path_2, params, mc_borders=borders, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, ignored_frames=group_ignored_frames)
-        else:
-            roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_suite2p(final_video_path_2, params, mc_borders=borders, use_multiprocessing=use_multiprocessing)
+        group_videos.append(group_video)
+        group_ignored_frames.append(ignored)
+        group_mc_borders.append(borders)
 
-        new_roi_spatial_footprints[group_num]  = roi_spatial_footprints
-        new_roi_temporal_footprints[group_num] = roi_temporal_footprints
-        new_roi_temporal_residuals[group_num]  = roi_temporal_residuals
-        new_bg_spatial_footprints[group_num]   = bg_spatial_footprints
-        new_bg_temporal_footprints[group_num]  = bg_temporal_footprints
+    if parallel_planes:
+        results = find_rois_cnmf_parallel(group_nums, group_videos, group_ignored_frames, group_mc_borders, params, progress_signal=progress_signal, plane_progress_signal=plane_progress_signal)
 
-        if os.path.exists(final_video_path_2):
-            os.remove(final_video_path_2)
+        for n in range(len(group_nums)):
+            group_num = group_nums[n]
 
-        if progress_signal is not None:
-            progress_signal.emit(n)
+            new_roi_spatial_footprints[group_num]  = [ result[0] for result in results[group_num] ]
+            new_roi_temporal_footprints[group_num] = [ result[1] for result in results[group_num] ]
+            new_roi_temporal_residuals[group_num]  = [ result[2] for result in results[group_num] ]
+            new_bg_spatial_footprints[group_num]   = [ result[3] for result in results[group_num] ]
+            new_bg_temporal_footprints[group_num]  = [ result[4] for result in results[group_num] ]
+    else:
+        for n in range(len(group_nums)):
+            group_num = group_nums[n]
+
+            if method == "cnmf":
+                roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_cnmf(group_videos[n], params, mc_borders=group_mc_borders[n], use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, ignored_frames=group_ignored_frames[n])
+            else:
+                roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_suite2p(group_videos[n], params, mc_borders=group_mc_borders[n], use_multiprocessing=use_multiprocessing)
+
+            new_roi_spatial_footprints[group_num]  = roi_spatial_footprints
+            new_roi_temporal_footprints[group_num] = roi_temporal_footprints
+            new_roi_temporal_residuals[group_num]  = roi_temporal_residuals
+            new_bg_spatial_footprints[group_num]   = bg_spatial_footprints
+            new_bg_temporal_footprints[group_num]  = bg_temporal_footprints
 
-    if use_multiprocessing and method == "cnmf":
+            if progress_signal is not None:
+                progress_signal.emit(n)
+
+    del group_videos
+
+    if use_multiprocessing and method == "cnmf" and not parallel_planes:
         if backend == 'multiprocessing':
             dview.close()
         else:
@@ -436,24 +694,58 @@ def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params,
 
     return new_roi_spatial_footprints, new_roi_temporal_footprints, new_roi_temporal_residuals, new_bg_spatial_footprints, new_bg_temporal_footprints
 
-def find_rois_cnmf(video_path, params, mc_borders=None, use_multiprocessing=True, c=None, dview=None, n_processes=1, ignored_frames=[]):
-    full_video_path = video_path
+def find_rois_cnmf_parallel(group_nums, group_videos, group_ignored_frames, group_mc_borders, params, progress_signal=None, plane_progress_signal=None):
+    # create a job for every plane of every group
+    jobs       = []
+    job_groups = []
+    for n in range(len(group_nums)):
+        for z in range(group_videos[n].shape[1]):
+            jobs.append([group_videos[n], z, params, group_mc_borders[n], group_ignored_frames[n]])
+            job_groups.append(n)
 
-    directory = os.path.dirname(full_video_path)
-    filename  = os.path.basename(full_video_path)
+    # split the worker budget between the planes, making sure they fit in memory
+    job_memory = max([ plane_memory(group_video) for group_video in group_videos ])*CNMF_MEMORY_FACTOR
+    n_concurrent, n_processes = parallel.plan_jobs(len(jobs), job_memory, params['max_workers'])
 
-    new_video_path = os.path.join(directory, "cnmf_video_temp.tif")
+    print("Finding ROIs in {} planes using {} concurrent jobs with {} process(es) each.".format(len(jobs), n_concurrent, n_processes))
 
-    shutil.copyfile(video_path, new_video_path)
+    for job in jobs:
+        job.append(n_processes)
 
-    memmap_video = tifffile.memmap(video_path)
-    
-    kept_frames = [ i for i in range(memmap_video.shape[0]) if i not in ignored_frames ]
+    results = { group_num: [ None for z in range(group_videos[n].shape[1]) ] for n, group_num in enumerate(group_nums) }
 
-    if len(memmap_video.shape) == 5:
-        num_z = memmap_video.shape[2]
-    else:
-        num_z = memmap_video.shape[1]
+    planes_left = [ job_groups.count(n) for n in range(len(group_nums)) ]
+    planes_done = [ 0 ]
+
+    def job_finished(i, result):
+        n = job_groups[i]
+        z = jobs[i][1]
+
+        results[group_nums[n]][z] = result
+
+        planes_left[n] -= 1
+        planes_done[0] += 1
+
+        print("Found {} ROIs in plane z={} of group {}.".format(result[0].shape[1], z, group_nums[n]))
+
+        # report each plane as it's done, as (group number, z, planes done, total planes)
+        if plane_progress_signal is not None:
+            plane_progress_signal.emit(int(group_nums[n]), int(z), planes_done[0], len(jobs))
+
+        # groups can finish in any order -- like the serial loop, report the index of the group that is done
+        if planes_left[n] == 0 and progress_signal is not None:
+            progress_signal.emit(n)
+
+    parallel.run_jobs(find_rois_cnmf_plane_job, [ tuple(job) for job in jobs ], n_concurrent, callback=job_finished)
+
+    log_files = glob.glob('Yr*_LOG_*')
+    for log_file in log_files:
+        os.remove(log_file)
+
+    return results
+
+def find_rois_cnmf(video, params, mc_borders=None, use_multiprocessing=True, c=None, dview=None, n_processes=1, ignored_frames=[]):
+    num_z = video.shape[1]
 
     roi_spatial_footprints  = [ None for i in range(num_z) ]
     roi_temporal_footprints = [ None for i in range(num_z) ]
@@ -462,202 +754,244 @@ def find_rois_cnmf(video_path, params, mc_borders=None, use_multiprocessing=True
     bg_temporal_footprints  = [ None for i in range(num_z) ]
 
     for z in range(num_z):
-        fname = os.path.splitext(filename)[0] + "_masked_z_{}.tif".format(z)
+        roi_spatial_footprints[z], roi_temporal_footprints[z], roi_temporal_residuals[z], bg_spatial_footprints[z], bg_temporal_footprints[z] = find_rois_cnmf_plane(video, z, params, mc_borders=mc_borders, dview=dview, n_processes=n_processes, ignored_frames=ignored_frames)
 
-        z_video_path = os.path.join(directory, fname)
+    log_files = glob.glob('Yr*_LOG_*')
+    for log_file in log_files:
+        os.remove(log_file)
 
-        if len(memmap_video.shape) == 5:
-            z_video = memmap_video[kept_frames, :, z, :, :]
-            tifffile.imsave(z_video_path, z_video.reshape((-1, memmap_video.shape[3], memmap_video.shape[4])))
-        else:
-            z_video = memmap_video[kept_frames, z, :, :]
-            tifffile.imsave(z_video_path, z_video)
-
-        # dataset dependent parameters
-        fnames     = [z_video_path]        # filename to be processed
-        fr         = params['imaging_fps'] # imaging rate in frames per second
-        decay_time = params['decay_time']  # length of a typical transient in seconds
-        
-        # parameters for source extraction and deconvolution
-        p              = params['autoregressive_order'] # order of the autoregressive system
-        gnb            = params['num_bg_components']    # number of global background components
-        merge_thresh   = params['merge_threshold']      # merging threshold, max correlation allowed
-        if params['use_patches']:
-            rf     = params['cnmf_patch_size']   # half-size of the patches in pixels. e.g., if rf=25, patches are 50x50
-            stride = params['cnmf_patch_stride'] # amount of overlap between the patches in pixels
-        else:
-            rf     = None
-            stride = None
-        K              = params['num_components'] # number of components per patch
-        is_dendrites   = False                    # flag for analyzing dendritic data
-        alpha_snmf     = None                     # sparsity penalty for dendritic data analysis through sparse NMF
-        init_method    = params['init_method']    # initialization method (if analyzing dendritic data using 'sparse_nmf')
-
-        # parameters for component evaluation
-        min_SNR        = params['min_snr']          # signal to noise ratio for accepting a component
-        rval_thr       = params['min_spatial_corr'] # space correlation threshold for accepting a component
-        max_merge_area = params['max_merge_area']   # max area of components for merging
-
-        half_size  = [params['half_size'], params['half_size']] # standard deviation of Gaussian kernel along each axis
-        n_iter     = params['n_iter']                           # number of iterations when refining estimates
-
-        alpha_snmf         = params['alpha_snmf']
-        sigma_smooth_snmf  = params['sigma_smooth_snmf']
-        max_iter_snmf      = params['max_iter_snmf']
-        perc_baseline_snmf = params['perc_baseline_snmf']
-        SC_normalize       = params['sc_normalize']
-        SC_use_NN          = params['sc_use_nn']
-        SC_thr             = params['sc_threshold']
-        SC_sigma           = params['sc_sigma']
-        hals_iter          = params['hals_iter']
-
-        if mc_borders is not None:
-            border_pix = mc_borders[z]
-        else:
-            border_pix = 0
+    return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
 
-        fname_new = cm.save_memmap(fnames, base_name='memmap_z_{}'.format(z), order='C') # exclude borders
+def find_rois_cnmf_plane_job(video, z, params, mc_borders=None, ignored_frames=[], n_processes=1):
+    # start a cluster for this plane using its share of the worker budget
+    dview = parallel.start_local_cluster(n_processes)
 
-        # now load the file
-        Yr, dims, T = cm.load_memmap(fname_new)
-        d1, d2 = dims
-        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+    try:
+        result = find_rois_cnmf_plane(video, z, params, mc_borders=mc_borders, dview=dview, n_processes=n_processes, ignored_frames=ignored_frames)
+    finally:
+        parallel.stop_local_cluster(dview)
 
-        print("Using {} method for ROI initialization.".format(init_method))
+    return result
 
-        params_dict = {'fnames': fnames,
-                       'fr': fr,
-                       'decay_time': decay_time,
-                       'rf': rf,
-                       'stride': stride,
-                       'K': K,
-                       'gSig': half_size,
-                       'nIter': n_iter,
-                       'merge_thr': merge_thresh,
-                       'p': p,
-                       'nb': gnb,
-                       'init_method': init_method,
-                       'method_init': init_method,
-                       'dims': memmap_video.shape[-2:],
-                       'max_merge_area': max_merge_area,
-                       'alpha_snmf': alpha_snmf,
-                       'sigma_smooth_snmf': sigma_smooth_snmf,
-                       'max_iter_snmf': max_iter_snmf,
-                       'perc_baseline_snmf': perc_baseline_snmf,
-                       'SC_normalize': SC_normalize,
-                       'SC_use_NN': SC_use_NN,
-                       'SC_thr': SC_thr,
-                       'SC_sigma': SC_sigma,
-                       'maxIter': hals_iter,
-                       }
+def plane_memmap_base_name(video_paths, z):
+    '''
+    Returns the base name of the memmap of plane z of a group of videos.
 
-        opts = cnmf_params.CNMFParams(params_dict=params_dict)
+    Memmaps are named after the group & plane so that planes can be processed concurrently,
+    and so that ROI filtering can find the memmap that was written when finding ROIs.
+    '''
 
-        cnm = cnmf.CNMF(n_processes, params=opts, dview=dview)
-        cnm = cnm.fit_file()
+    directory = os.path.dirname(video_paths[0])
+    filename  = os.path.basename(video_paths[0])
 
-        Yr, dims, T = cm.load_memmap(cnm.mmap_file)
-        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+    return os.path.join(directory, os.path.splitext(filename)[0] + "_masked_z_{}".format(z))
 
-        # print(Yr.shape)
+def remove_plane_memmaps(video_paths):
+    '''Removes the memmaps of all planes of a group of videos that were kept after finding ROIs.'''
 
-        cnm2 = cnm.refit(images, dview=dview)
+    if len(video_paths) == 0:
+        return
 
-        fname_2 = os.path.splitext(filename)[0] + "_masked_z_{}_2.tif".format(z)
+    mmap_files = glob.glob(plane_memmap_base_name(video_paths, "*") + "_d1_*_.mmap")
+    for mmap_file in mmap_files:
+        try:
+            os.remove(mmap_file)
+        except:
+            pass
 
-        z_video_path_2 = os.path.join(directory, fname_2)
+def find_rois_cnmf_plane(video, z, params, mc_borders=None, dview=None, n_processes=1, ignored_frames=[]):
+    kept_frames = np.setdiff1d(np.arange(video.shape[0]), ignored_frames)
 
-        # print(memmap_video[:, z, :, :].shape)
+    base_name = plane_memmap_base_name(video.video_paths, z)
 
-        z_video_2 = memmap_video[:, z, :, :]
-        tifffile.imsave(z_video_path_2, z_video_2)
+    # write the kept frames of this plane straight to a CaImAn memmap
+    fname_new = save_plane_memmap(video, z, base_name, frames=kept_frames)
 
-        # z_video_2 = memmap_video[:, z, :, :].transpose((1, 2, 0)).reshape((memmap_video.shape[2]*memmap_video.shape[3], memmap_video.shape[0]))
-        # tifffile.imsave(z_video_path_2, z_video_2)
+    # dataset dependent parameters
+    fnames     = [fname_new]           # filename to be processed
+    fr         = params['imaging_fps'] # imaging rate in frames per second
+    decay_time = params['decay_time']  # length of a typical transient in seconds
+    
+    # parameters for source extraction and deconvolution
+    p              = params['autoregressive_order'] # order of the autoregressive system
+    gnb            = params['num_bg_components']    # number of global background components
+    merge_thresh   = params['merge_threshold']      # merging threshold, max correlation allowed
+    if params['use_patches']:
+        rf     = params['cnmf_patch_size']   # half-size of the patches in pixels. e.g., if rf=25, patches are 50x50
+        stride = params['cnmf_patch_stride'] # amount of overlap between the patches in pixels
+    else:
+        rf     = None
+        stride = None
+    K              = params['num_components'] # number of components per patch
+    is_dendrites   = False                    # flag for analyzing dendritic data
+    alpha_snmf     = None                     # sparsity penalty for dendritic data analysis through sparse NMF
+    init_method    = params['init_method']    # initialization method (if analyzing dendritic data using 'sparse_nmf')
 
-        # fname_new_2 = cm.save_memmap([z_video_path_2], base_name='memmap_z_{}_2'.format(z), order='C') # exclude borders
+    # parameters for component evaluation
+    min_SNR        = params['min_snr']          # signal to noise ratio for accepting a component
+    rval_thr       = params['min_spatial_corr'] # space correlation threshold for accepting a component
+    max_merge_area = params['max_merge_area']   # max area of components for merging
+
+    half_size  = [params['half_size'], params['half_size']] # standard deviation of Gaussian kernel along each axis
+    n_iter     = params['n_iter']                           # number of iterations when refining estimates
+
+    alpha_snmf         = params['alpha_snmf']
+    sigma_smooth_snmf  = params['sigma_smooth_snmf']
+    max_iter_snmf      = params['max_iter_snmf']
+    perc_baseline_snmf = params['perc_baseline_snmf']
+    SC_normalize       = params['sc_normalize']
+    SC_use_NN          = params['sc_use_nn']
+    SC_thr             = params['sc_threshold']
+    SC_sigma           = params['sc_sigma']
+    hals_iter          = params['hals_iter']
+
+    if mc_borders is not None:
+        border_pix = mc_borders[z]
+    else:
+        border_pix = 0
 
-        # Yr_2, dims, T = cm.load_memmap(fname_new_2)
+    # now load the file
+    Yr, dims, T = cm.load_memmap(fname_new)
+    d1, d2 = dims
+    images = np.reshape(Yr.T, [T] + list(dims), order='F')
 
-        fname_new_2 = cm.save_memmap([z_video_path_2], base_name='memmap_z_{}_2'.format(z), order='C') # exclude borders
+    print("Using {} method for ROI initialization.".format(init_method))
 
-        # now load the file
-        Yr_2, dims, T = cm.load_memmap(fname_new_2)
+    params_dict = {'fnames': fnames,
+                   'fr': fr,
+                   'decay_time': decay_time,
+                   'rf': rf,
+                   'stride': stride,
+                   'K': K,
+                   'gSig': half_size,
+                   'nIter': n_iter,
+                   'merge_thr': merge_thresh,
+                   'p': p,
+                   'nb': gnb,
+                   'init_method': init_method,
+                   'method_init': init_method,
+                   'dims': video.shape[-2:],
+                   'max_merge_area': max_merge_area,
+                   'alpha_snmf': alpha_snmf,
+                   'sigma_smooth_snmf': sigma_smooth_snmf,
+                   'max_iter_snmf': max_iter_snmf,
+                   'perc_baseline_snmf': perc_baseline_snmf,
+                   'SC_normalize': SC_normalize,
+                   'SC_use_NN': SC_use_NN,
+                   'SC_thr': SC_thr,
+                   'SC_sigma': SC_sigma,
+                   'maxIter': hals_iter,
+                   }
 
-        print(Yr_2.shape)
+    opts = cnmf_params.CNMFParams(params_dict=params_dict)
 
-        try:
-            Cin = np.zeros((cnm2.A.shape[1], memmap_video.shape[0]))
-            fin = np.zeros((cnm2.b.shape[1], memmap_video.shape[0]))
-        except:
-            Cin = np.zeros((cnm2.estimates.A.shape[1], memmap_video.shape[0]))
-            fin = np.zeros((cnm2.estimates.b.shape[1], memmap_video.shape[0])) 
+    cnm = cnmf.CNMF(n_processes, params=opts, dview=dview)
+    cnm = cnm.fit(images)
+    cnm.mmap_file = fname_new
 
-        if len(ignored_frames) > 0:
-            try:
-                C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.A, cnm2.b, Cin, fin, dview=dview, p=0, method='cvx')
+    cnm2 = cnm.refit(images, dview=dview)
 
-                roi_spatial_footprints[z]  = cnm2.A
-                roi_temporal_footprints[z] = C
-                roi_temporal_residuals[z]  = YrA
-                bg_spatial_footprints[z]   = cnm2.b
-                bg_temporal_footprints[z]  = f
-            except:
-                C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.estimates.A, cnm2.estimates.b, Cin, fin, dview=dview, p=0, method='cvx')
+    try:
+        roi_spatial_footprints  = cnm2.A
+        roi_temporal_footprints = cnm2.C
+        roi_temporal_residuals  = cnm2.YrA
+        bg_spatial_footprints   = cnm2.b
+        bg_temporal_footprints  = cnm2.f
+    except:
+        roi_spatial_footprints  = cnm2.estimates.A
+        roi_temporal_footprints = cnm2.estimates.C
+        roi_temporal_residuals  = cnm2.estimates.YrA
+        bg_spatial_footprints   = cnm2.estimates.b
+        bg_temporal_footprints  = cnm2.estimates.f
 
-                roi_spatial_footprints[z]  = cnm2.estimates.A
-                roi_temporal_footprints[z] = C
-                roi_temporal_residuals[z]  = YrA
-                bg_spatial_footprints[z]   = cnm2.estimates.b
-                bg_temporal_footprints[z]  = f
+    if len(kept_frames) < video.shape[0]:
+        # fill in the traces of the ignored frames by projecting them onto the fixed footprints,
+        # instead of writing a second memmap of the whole plane and re-running the temporal update
+        start_time = time.time()
 
-                print(roi_temporal_footprints[z].shape)
-        else:
-            try:
-                roi_spatial_footprints[z]  = cnm2.A
-                roi_temporal_footprints[z] = cnm2.C
-                roi_temporal_residuals[z]  = cnm2.YrA
-                bg_spatial_footprints[z]   = cnm2.b
-                bg_temporal_footprints[z]  = cnm2.f
-            except:
-                roi_spatial_footprints[z]  = cnm2.estimates.A
-                roi_temporal_footprints[z] = cnm2.estimates.C
-                roi_temporal_residuals[z]  = cnm2.estimates.YrA
-                bg_spatial_footprints[z]   = cnm2.estimates.b
-                bg_temporal_footprints[z]  = cnm2.estimates.f
+        ignored = np.setdiff1d(np.arange(video.shape[0]), kept_frames)
 
-        if os.path.exists(z_video_path):
-            os.remove(z_video_path)
+        C_ignored, f_ignored, YrA_ignored = back_project_frames(video, z, ignored, roi_spatial_footprints, bg_spatial_footprints)
 
-        if os.path.exists(z_video_path_2):
-            os.remove(z_video_path_2)
+        roi_temporal_footprints = insert_frames(roi_temporal_footprints, C_ignored, kept_frames, ignored)
+        roi_temporal_residuals  = insert_frames(roi_temporal_residuals, YrA_ignored, kept_frames, ignored)
+        bg_temporal_footprints  = insert_frames(bg_temporal_footprints, f_ignored, kept_frames, ignored)
 
-    del memmap_video
+        print("Back-projected {} ignored frames in {:.2f} s.".format(len(ignored), time.time() - start_time))
 
-    if os.path.exists(new_video_path):
-        os.remove(new_video_path)
+    del Yr, images
 
-    mmap_files = glob.glob(os.path.join(directory, "*.mmap"))
-    for mmap_file in mmap_files:
+    if len(kept_frames) < video.shape[0]:
+        # remove this plane's memmap, since it's missing the ignored frames
         try:
-            os.remove(mmap_file)
+            os.remove(fname_new)
         except:
             pass
-
-    log_files = glob.glob('Yr*_LOG_*')
-    for log_file in log_files:
-        os.remove(log_file)
+    else:
+        print("Keeping memmap {} for ROI filtering.".format(fname_new))
 
     return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
 
-def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=True):
-    if suite2p_enabled:
-        full_video_path = video_path
+def back_project_frames(video, z, frames, A, b, chunk_size=100):
+    '''
+    Estimates the temporal components of the given frames of plane z of a video, keeping
+    the spatial footprints A and background b fixed.
+
+    Each frame is fit by least squares to the columns of [A b], and residual traces are
+    computed the same way as in CaImAn's temporal update.
+    '''
+
+    A = scipy.sparse.csc_matrix(A)
+    b = np.asarray(b)
+
+    n_rois = A.shape[1]
+
+    # normal equations of the least squares fit, shared by every frame
+    AA = (A.T.dot(A)).toarray()
+    Ab = np.asarray(A.T.dot(b))
+    bb = b.T.dot(b)
+
+    gram = np.block([[AA, Ab], [Ab.T, bb]])
+
+    # squared norms of the footprints, used to normalize the residual traces
+    nA = np.maximum(np.ravel(A.power(2).sum(axis=0)), np.finfo(np.float32).eps)
+
+    C   = np.zeros((n_rois, len(frames)), dtype=np.float32)
+    f   = np.zeros((b.shape[1], len(frames)), dtype=np.float32)
+    YrA = np.zeros((n_rois, len(frames)), dtype=np.float32)
+
+    for start, chunk in video.iter_chunks(z, frames=frames, chunk_size=chunk_size):
+        # flatten pixels in Fortran order to match the footprints
+        Y = chunk.reshape((chunk.shape[0], -1), order='F').T.astype(np.float32)
+
+        AY = np.asarray(A.T.dot(Y))
+        bY = b.T.dot(Y)
+
+        solution = np.linalg.lstsq(gram, np.concatenate([AY, bY], axis=0), rcond=None)[0]
+
+        end = start + chunk.shape[0]
+
+        C[:, start:end] = np.maximum(solution[:n_rois], 0)
+        f[:, start:end] = solution[n_rois:]
+
+        YrA[:, start:end] = ((AY - Ab.dot(f[:, start:end])) - AA.dot(C[:, start:end]))/nA[:, np.newaxis]
 
-        video = tifffile.memmap(video_path)
+    return C, f, YrA
 
-        directory = os.path.dirname(full_video_path)
-        filename  = os.path.basename(full_video_path)
+def insert_frames(traces, new_traces, frames, new_frames):
+    '''Combines traces for two disjoint sets of frames into traces covering both.'''
+
+    combined = np.zeros((traces.shape[0], len(frames) + len(new_frames)), dtype=traces.dtype)
+
+    combined[:, frames]     = traces
+    combined[:, new_frames] = new_traces
+
+    return combined
+
+def find_rois_suite2p(video, params, mc_borders=None, use_multiprocessing=True):
+    if suite2p_enabled:
+        directory = os.path.dirname(video.video_paths[0])
+        filename  = os.path.basename(video.video_paths[0])
 
         roi_spatial_footprints  = [ None for i in range(video.shape[1]) ]
         roi_temporal_footprints = [ None for i in range(video.shape[1]) ]
@@ -674,7 +1008,9 @@ def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=T
             z_video_path = os.path.join(directory, fname)
 
             h5f = h5py.File(z_video_path, 'w')
-            h5f.create_dataset('data', data=video[:, z, :, :])
+            dataset = h5f.create_dataset('data', shape=(video.shape[0],) + video.shape[2:], dtype=video.dtype)
+            for start, chunk in video.iter_chunks(z):
+                dataset[start:start+chunk.shape[0]] = chunk
             h5f.close()
 
             ops = {
@@ -748,167 +1084,219 @@ def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=T
             bg_spatial_footprints[z]   = None
             bg_temporal_footprints[z]  = None
 
-            os.remove(fname)
+            os.remove(z_video_path)
             shutil.rmtree("suite2p")
 
         return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
 
+# parameters that the cached ROI quality metrics depend on
+ROI_METRIC_PARAMS = ['imaging_fps', 'decay_time', 'half_size']
+
+# parameters that are only used to threshold the cached ROI quality metrics
+ROI_FILTER_PARAMS = ['min_snr', 'min_spatial_corr', 'min_area', 'max_area', 'min_df_f', 'artifact_decay_speed', 'use_cnn', 'cnn_accept_threshold', 'cnn_reject_threshold']
+
+# CaImAn's default thresholds below which components are always rejected
+MIN_SNR_REJECT  = 0.5
+R_VALUES_LOWEST = -1
+
 def filter_rois(video_paths, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, mean_images, params):
-    directory = os.path.dirname(video_paths[0])
+    roi_metrics = compute_roi_metrics(video_paths, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, mean_images, params)
 
-    final_video_path = os.path.join(directory, "final_video_temp.tif")
+    return apply_roi_filters(roi_metrics, params)
 
-    with tifffile.TiffWriter(final_video_path, bigtiff=True) as tif:
-        for i in range(len(video_paths)):
-            video_path = video_paths[i]
+def compute_roi_metrics(video_paths, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, mean_images, params, roi_metrics=None):
+    '''
+    Computes the quality metrics used to filter the ROIs of each plane of a group.
+
+    Metrics in roi_metrics (the result of a previous call) are reused for planes whose
+    footprints and metric parameters haven't changed since they were computed.
+    '''
 
-            video = tifffile.memmap(video_path)
-                
-            if len(video.shape) == 3:
-                # add a z dimension
-                video = video[:, np.newaxis, :, :]
+    # create a lazy view of the concatenated videos, in the same orientation as when finding ROIs
+    group_video = GroupVideo(video_paths).transpose((0, 1, 3, 2))
 
-            for k in range(video.shape[0]):
-                tif.save(video[k])
+    num_z = group_video.shape[1]
 
-            del video
+    new_roi_metrics = [ None for z in range(num_z) ]
 
-    final_video = tifffile.memmap(final_video_path)
+    jobs        = []
+    jobs_planes = []
+    for z in range(num_z):
+        if roi_metrics is not None and z < len(roi_metrics) and roi_metrics_valid(roi_metrics[z], roi_spatial_footprints[z], params):
+            new_roi_metrics[z] = roi_metrics[z]
+        else:
+            jobs.append((group_video, z, roi_spatial_footprints[z], roi_temporal_footprints[z], roi_temporal_residuals[z], bg_spatial_footprints[z], bg_temporal_footprints[z], mean_images[z], params))
+            jobs_planes.append(z)
 
-    if len(final_video.shape) == 5:
-        final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-        tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
+    print("Computing ROI metrics for {} of {} planes.".format(len(jobs), num_z))
+
+    if params['parallel_planes'] and len(jobs) > 1:
+        # compute metrics of planes concurrently, making sure they fit in memory
+        n_concurrent, n_processes = parallel.plan_jobs(len(jobs), plane_memory(group_video)*FILTER_MEMORY_FACTOR, params['max_workers'])
     else:
-        final_video_path_2 = final_video_path
+        n_concurrent = 1
 
-    del final_video
+    results = parallel.run_jobs(compute_roi_metrics_plane, jobs, n_concurrent)
 
-    filtered_out_rois = []
+    for i in range(len(jobs)):
+        new_roi_metrics[jobs_planes[i]] = results[i]
 
-    memmap_video = tifffile.memmap(final_video_path_2)
+    del group_video
 
-    if len(memmap_video.shape) == 5:
-        n_frames = memmap_video.shape[1]
-        num_z = memmap_video.shape[2]
-        height = memmap_video.shape[3]
-        width = memmap_video.shape[4]
-    else:
-        n_frames = memmap_video.shape[0]
-        num_z = memmap_video.shape[1]
-        height = memmap_video.shape[2]
-        width = memmap_video.shape[3]
+    log_files = glob.glob('Yr*_LOG_*')
+    for log_file in log_files:
+        os.remove(log_file)
 
-    for z in range(num_z):
-        directory = os.path.dirname(final_video_path_2)
-        filename  = os.path.basename(final_video_path_2)
+    return new_roi_metrics
 
-        fname = os.path.splitext(filename)[0] + "_masked_z_{}_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap".format(z, height, width, n_frames)
+def compute_roi_metrics_plane(group_video, z, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, mean_image, params):
+    num_z = group_video.shape[1]
 
-        video_path = os.path.join(directory, fname)
+    base_name = plane_memmap_base_name(group_video.video_paths, z)
 
-        if len(memmap_video.shape) == 5:
-            tifffile.imsave(video_path, memmap_video[:, :, z, :, :].reshape((-1, memmap_video.shape[3], memmap_video.shape[4])).transpose([1, 2, 0]).astype(np.float32))
-        else:
-            tifffile.imsave(video_path, memmap_video[:, z, :, :].transpose([1, 2, 0]).astype(np.float32))
+    # reuse the memmap that was written when finding ROIs, if it covers all of the frames
+    fname = plane_memmap_name(base_name, group_video.shape[2:], group_video.shape[0])
 
-        video = tifffile.memmap(video_path)
+    if os.path.exists(fname):
+        print("Reusing memmap {}.".format(fname))
+    else:
+        # stream the plane into a memmap, which is kept for the next time ROIs are filtered
+        fname = save_plane_memmap(group_video, z, base_name)
 
-        dims = video.shape[:2]
+    Yr, dims, T = cm.load_memmap(fname)
+    Y = np.reshape(Yr, dims + (T,), order='F')
 
-        idx_components, idx_components_bad, SNR_comp, r_values, cnn_preds = \
-                estimate_components_quality_auto(video, roi_spatial_footprints[z], roi_temporal_footprints[z], bg_spatial_footprints[z], bg_temporal_footprints[z], 
-                                                 roi_temporal_residuals[z], params['imaging_fps']/num_z, params['decay_time'], [params['half_size'], params['half_size']], dims, 
-                                                 dview = None, min_SNR=params['min_snr'], 
-                                                 r_values_min = params['min_spatial_corr'], use_cnn = False, 
-                                                 thresh_cnn_min = params['cnn_accept_threshold'], thresh_cnn_lowest=params['cnn_reject_threshold'], gSig_range=[ (i, i) for i in range(max(1, params['half_size']-2), params['half_size']+2) ])
+    idx_components, idx_components_bad, SNR_comp, r_values, cnn_preds = \
+            estimate_components_quality_auto(Y, roi_spatial_footprints, roi_temporal_footprints, bg_spatial_footprints, bg_temporal_footprints, 
+                                             roi_temporal_residuals, params['imaging_fps']/num_z, params['decay_time'], [params['half_size'], params['half_size']], dims, 
+                                             dview = None, min_SNR=params['min_snr'], 
+                                             r_values_min = params['min_spatial_corr'], use_cnn = False, 
+                                             thresh_cnn_min = params['cnn_accept_threshold'], thresh_cnn_lowest=params['cnn_reject_threshold'], gSig_range=[ (i, i) for i in range(max(1, params['half_size']-2), params['half_size']+2) ])
 
-        if isinstance(roi_spatial_footprints[z], scipy.sparse.coo_matrix):
-            f = roi_spatial_footprints[z].toarray()
-        else:
-            f = roi_spatial_footprints[z]
+    del Yr, Y
 
-        size_neurons_gt = (f > 0).sum(0)
-        neurons_to_discard = np.where((size_neurons_gt < params['min_area']) | (size_neurons_gt > params['max_area']))[0]
+    if params['use_cnn']:
+        predictions, final_crops = test_cnn_on_data(roi_spatial_footprints, mean_image, params['half_size'])
+    else:
+        predictions = None
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    roi_metrics = {'footprints_hash' : hash_footprints(roi_spatial_footprints),
+                   'params'          : [ params[param] for param in ROI_METRIC_PARAMS ],
+                   'snr'             : np.asarray(SNR_comp),
+                   'r_values'        : np.asarray(r_values),
+                   'area'            : get_roi_areas(roi_spatial_footprints),
+                   'min_zscore_diffs': get_min_zscore_diffs(roi_temporal_footprints),
+                   'df_f'            : get_df_f(roi_temporal_footprints),
+                   'cnn_preds'       : predictions,
+                   }
 
-        zscores = (roi_temporal_footprints[z] - np.mean(roi_temporal_footprints[z], axis=1)[:, np.newaxis])/np.std(roi_temporal_footprints[z], axis=1)[:, np.newaxis]
-        zscore_diffs = np.diff(zscores, axis=0)
-        min_zscore_diffs = np.amin(zscore_diffs, axis=1)
+    return roi_metrics
 
-        neurons_to_discard = np.where(min_zscore_diffs < -params['artifact_decay_speed'])[0]
+def hash_footprints(roi_spatial_footprints):
+    '''Returns a hash that identifies a set of spatial footprints, used to tell when cached metrics are out of date.'''
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    if scipy.sparse.issparse(roi_spatial_footprints):
+        footprints = scipy.sparse.csc_matrix(roi_spatial_footprints)
 
-        abs_traces = np.abs(roi_temporal_footprints[z])
-        df_f = np.abs(np.amax(roi_temporal_footprints[z], axis=1) - np.amin(roi_temporal_footprints[z], axis=1))/np.mean(abs_traces[:, :10])
+        return hash_array(np.concatenate([np.asarray(footprints.shape), footprints.indptr, footprints.indices]).astype(np.int64)) + hash_array(footprints.data)
+    else:
+        return hash_array(np.asarray(roi_spatial_footprints.shape)) + hash_array(roi_spatial_footprints)
 
-        neurons_to_discard = np.where(df_f < params['min_df_f'])[0]
+def roi_metrics_valid(roi_metrics, roi_spatial_footprints, params):
+    '''Returns whether cached metrics of a plane can be used with its current footprints & parameters.'''
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    if roi_metrics is None:
+        return False
 
-        if params['use_cnn']:
-            predictions, final_crops = test_cnn_on_data(roi_spatial_footprints[z], mean_images[z], params['half_size'])
+    if params['use_cnn'] and roi_metrics['cnn_preds'] is None:
+        return False
 
-            neurons_to_discard = [ i for i in range(predictions.shape[0]) if predictions[i, 1] > params['cnn_reject_threshold'] ]
+    return roi_metrics['params'] == [ params[param] for param in ROI_METRIC_PARAMS ] and roi_metrics['footprints_hash'] == hash_footprints(roi_spatial_footprints)
 
-            neurons_to_keep = [ i for i in range(predictions.shape[0]) if predictions[i, 0] > params['cnn_accept_threshold'] ]
+def apply_roi_filters(roi_metrics, params):
+    '''Returns the indices of the ROIs in each plane that don't pass the filtering thresholds, given their cached metrics.'''
 
-            idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    filtered_out_rois = []
 
-            idx_components_bad = [ i for i in idx_components_bad if i not in neurons_to_keep ]
+    for metrics in roi_metrics:
+        snr      = metrics['snr']
+        r_values = metrics['r_values']
+        area     = metrics['area']
 
-        filtered_out_rois.append(list(idx_components_bad))
+        # same selection as CaImAn's component evaluation -- ROIs are rejected outright only if their metrics are at or below
+        # the lowest thresholds, so an ROI with a NaN r-value is kept as long as its SNR passes, as it is in CaImAn
+        good = ((r_values >= params['min_spatial_corr']) | (snr > params['min_snr'])) & ~(r_values <= R_VALUES_LOWEST) & ~(snr <= MIN_SNR_REJECT)
 
-        if os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-            except:
-                pass
+        good &= ~((area < params['min_area']) | (area > params['max_area']))
 
-        del video
+        good &= ~(metrics['df_f'] < params['min_df_f'])
 
-    del memmap_video
+        # remove ROIs whose traces drop faster than the artifact decay speed
+        good &= ~(metrics['min_zscore_diffs'] < -params['artifact_decay_speed'])
 
-    if os.path.exists(final_video_path_2):
-        os.remove(final_video_path_2)
+        if params['use_cnn'] and metrics['cnn_preds'] is not None:
+            predictions = metrics['cnn_preds']
 
-    mmap_files = glob.glob(os.path.join(directory, "*.mmap"))
-    for mmap_file in mmap_files:
-        try:
-            os.remove(mmap_file)
-        except:
-            pass
+            good &= predictions[:, 1] <= params['cnn_reject_threshold']
 
-    log_files = glob.glob('Yr*_LOG_*')
-    for log_file in log_files:
-        os.remove(log_file)
+            # the CNN can also rescue ROIs that failed the other checks
+            good |= predictions[:, 0] > params['cnn_accept_threshold']
+
+        filtered_out_rois.append(list(np.nonzero(~good)[0]))
 
     return filtered_out_rois
 
-def get_roi_containing_point(spatial_footprints, roi_point, video_shape):
-    flattened_point = roi_point[0]*video_shape[0] + roi_point[1]
+def get_roi_areas(roi_spatial_footprints):
+    '''Returns the number of pixels in each ROI, counted from the sparse footprints without making them dense.'''
 
-    if flattened_point >= video_shape[0]*video_shape[1]:
-        return None
+    if scipy.sparse.issparse(roi_spatial_footprints):
+        return np.ravel((scipy.sparse.csc_matrix(roi_spatial_footprints) > 0).sum(axis=0))
+    else:
+        return (roi_spatial_footprints > 0).sum(0)
 
-    try:
-        spatial_footprints = spatial_footprints.toarray()
-    except:
-        pass
+def get_min_zscore_diffs(roi_temporal_footprints, chunk_size=500):
+    '''
+    Returns the largest frame-to-frame drop of each ROI's z-scored trace, as the minimum of its
+    differences over time. Artifacts decay faster than calcium transients, so ROIs whose traces
+    drop by more than the artifact decay speed in a single frame are filtered out.
 
-    if spatial_footprints is not None:
-        roi = np.argmax(spatial_footprints[flattened_point, :])
-        
-        if spatial_footprints[flattened_point, roi] != 0:
+    Traces are z-scored as float32 in chunks of ROIs, so that only a chunk of the z-scores and
+    their differences is held in memory at a time.
+    '''
 
-            print(np.sum(spatial_footprints[:, roi] > 0))
-            return roi
-    else:
+    n_rois, n_frames = roi_temporal_footprints.shape
+
+    min_zscore_diffs = np.zeros(n_rois, dtype=np.float32)
+
+    if n_frames < 2:
+        return min_zscore_diffs
+
+    for start in range(0, n_rois, chunk_size):
+        traces = np.asarray(roi_temporal_footprints[start:start+chunk_size], dtype=np.float32)
+
+        # flat traces have no z-scores, and are never treated as artifacts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zscores = (traces - np.mean(traces, axis=1)[:, np.newaxis])/np.std(traces, axis=1)[:, np.newaxis]
+
+        min_zscore_diffs[start:start+chunk_size] = np.amin(np.diff(zscores, axis=1), axis=1)
+
+    return min_zscore_diffs
+
+def get_df_f(roi_temporal_footprints):
+    '''Returns the dF/F of each ROI, relative to the mean absolute value of the first 10 frames of all traces.'''
+
+    baseline = np.mean(np.abs(roi_temporal_footprints[:, :10]))
+
+    return np.abs(np.ptp(roi_temporal_footprints, axis=1))/baseline
+
+def get_roi_containing_point(spatial_footprints, roi_point, video_shape):
+    if spatial_footprints is None:
         return None
 
+    # look up the row of the clicked pixel, instead of densifying the footprints --
+    # the first axis of the displayed image is the second axis of the footprint images
+    return ROISpatialIndex(spatial_footprints, (video_shape[1], video_shape[0])).roi_at(roi_point)
+
 def blend_transparent(face_img, overlay_t_img):
     # Split out the transparency mask from the colour info
     overlay_img = overlay_t_img[:,:,:3] # Grab the BRG planes
@@ -1242,53 +1630,16 @@ def create_dataset_subset(images, labels, kept_rois):
     return final_images, labels
 
 def merge_rois(rois, roi_spatial_footprints, roi_temporal_footprints, bg_spatial_footprints, bg_temporal_footprints, roi_temporal_residuals, video_paths, z, params):
-    directory = os.path.dirname(video_paths[0])
-
-    final_video_path = os.path.join(directory, "final_video_temp.tif")
-
-    with tifffile.TiffWriter(final_video_path, bigtiff=False) as tif:
-        for i in range(len(video_paths)):
-            video_path = video_paths[i]
-            new_video_path = os.path.join(directory, "video_temp.tif")
-
-            shutil.copyfile(video_path, new_video_path)
-
-            video = tifffile.memmap(new_video_path)
-
-            if len(video.shape) == 3:
-                # add a z dimension
-                video = video[:, np.newaxis, :, :]
-
-            video = video.transpose((0, 1, 3, 2))[:, z, :, :]
-
-            dims = video.shape[-2:]
-
-            for k in range(video.shape[0]):
-                tif.save(video[k])
-
-            del video
-
-            if os.path.exists(new_video_path):
-                os.remove(new_video_path)
-
-    final_video = tifffile.memmap(final_video_path).astype(np.uint16)
-
-    if len(final_video.shape) == 5:
-        final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-        tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
-    else:
-        final_video_path_2 = final_video_path
-
-    del final_video
+    # get the frame size from a lazy view of the videos -- merging only needs the
+    # footprints and traces, so the video itself is never read
+    dims = GroupVideo(video_paths).transpose((0, 1, 3, 2)).shape[-2:]
 
     est = estimates.Estimates(roi_spatial_footprints, bg_spatial_footprints, roi_temporal_footprints, bg_temporal_footprints, roi_temporal_residuals)
 
     est.YrA = est.R
 
     # dataset dependent parameters
-    fnames     = [final_video_path_2]  # filename to be processed
+    fnames     = None                  # no file needs to be processed
     fr         = params['imaging_fps'] # imaging rate in frames per second
     decay_time = params['decay_time']  # length of a typical transient in seconds
     
@@ -1334,7 +1685,4 @@ def merge_rois(rois, roi_spatial_footprints, roi_temporal_footprints, bg_spatial
     roi_spatial_footprints = est.A
     roi_temporal_footprints = est.C
 
-    if os.path.exists(final_video_path_2):
-        os.remove(final_video_path_2)
-
     return roi_spatial_footprints, roi_temporal_footprints
\ No newline at end of file
@@ -0,0 +1,283 @@
+import os
+import numpy as np
+
+from .lazy_video import open_video_or_pages
+
+# approximate number of bytes of a video to read at a time
+STATS_CHUNK_BYTES = 64*1024*1024
+
+# suffix of the files that cache the statistics of a video
+STATS_SUFFIX = "_stats.npz"
+
+# percentile of pixel values that is computed for each plane
+STATS_PERCENTILE = 99.5
+
+# number of pixels of each plane of a float video that are kept to estimate its percentiles
+STATS_SAMPLE_SIZE = 100000
+
+# statistics computed by compute_video_stats
+VIDEO_STATS_KEYS = ['mean', 'max', 'min', 'percentile']
+
+def frame_chunks(video, chunk_bytes=STATS_CHUNK_BYTES):
+    '''Yields consecutive chunks of frames (frames, z planes, height, width) of a video, each roughly chunk_bytes in size.'''
+
+    frame_bytes = int(np.prod(video.shape[1:]))*np.dtype(video.dtype).itemsize
+    chunk_size  = max(1, chunk_bytes // max(1, frame_bytes))
+
+    for start in range(0, video.shape[0], chunk_size):
+        yield video[start:start+chunk_size]
+
+def compute_plane_means(video, chunk_bytes=STATS_CHUNK_BYTES):
+    '''Returns the (z planes, height, width) mean images of a video, reading it in a single chunked pass.'''
+
+    total = np.zeros(video.shape[1:])
+
+    for chunk in frame_chunks(video, chunk_bytes=chunk_bytes):
+        total += np.sum(chunk, axis=0, dtype=np.float64)
+
+    return total/max(1, video.shape[0])
+
+def dynamic_range(max_value):
+    # the dynamic range of a video, from the largest value in it
+    if max_value > 2047:
+        return 4095
+    elif max_value > 1023:
+        return 2047
+    elif max_value > 511:
+        return 1023
+    elif max_value > 255:
+        return 511
+    elif max_value > 1:
+        return 255
+    else:
+        return 1
+
+class VideoStatsAccumulator():
+    '''
+    Accumulates the per-plane mean image, minimum, maximum and a percentile of a video as
+    chunks of frames (frames, z planes, height, width) are added, so they can all be computed
+    in a single pass and shown before the whole video has been read.
+
+    Percentiles of 8- and 16-bit videos are exact (from a histogram of each plane's values),
+    while those of other videos are estimated from a fixed-size random sample of each plane's
+    pixels, so memory use doesn't grow with the length of the video.
+    '''
+
+    def __init__(self, frame_shape, dtype, percentile=STATS_PERCENTILE):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype       = np.dtype(dtype)
+        self.percentile  = percentile
+        self.n_frames    = 0
+
+        n_planes = self.frame_shape[0]
+
+        self.total   = np.zeros(self.frame_shape)
+        self.minimum = np.full(n_planes, np.inf)
+        self.maximum = np.full(n_planes, -np.inf)
+
+        # larger integer types would need too many histogram bins
+        self.integer = self.dtype.kind in 'ui' and self.dtype.itemsize <= 2
+
+        if self.integer:
+            self.histograms = [ np.zeros(0, dtype=np.int64) for z in range(n_planes) ]
+        else:
+            # each plane keeps the sampled pixels with the smallest random keys, which is a uniform sample of all its pixels
+            self.random      = np.random.RandomState(0)
+            self.step        = None
+            self.samples     = [ np.zeros(0) for z in range(n_planes) ]
+            self.sample_keys = [ np.zeros(0) for z in range(n_planes) ]
+
+    def add(self, chunk):
+        chunk = np.asarray(chunk)
+
+        self.total   += np.sum(chunk, axis=0, dtype=np.float64)
+        self.minimum  = np.minimum(self.minimum, np.amin(chunk, axis=(0, 2, 3)))
+        self.maximum  = np.maximum(self.maximum, np.amax(chunk, axis=(0, 2, 3)))
+
+        for z in range(chunk.shape[1]):
+            values = chunk[:, z].ravel()
+
+            if self.integer:
+                # values are offset so that signed videos can be binned
+                counts = np.bincount((values.astype(np.int64) - int(np.iinfo(self.dtype).min)))
+
+                if len(counts) > len(self.histograms[z]):
+                    counts[:len(self.histograms[z])] += self.histograms[z]
+                    self.histograms[z] = counts
+                else:
+                    self.histograms[z][:len(counts)] += counts
+            else:
+                # thin out every chunk by the same amount, so that each pixel is equally likely to be sampled
+                if self.step is None:
+                    self.step = max(1, len(values) // STATS_SAMPLE_SIZE)
+
+                values = np.concatenate([self.samples[z], values[::self.step].astype(np.float64)])
+                keys   = np.concatenate([self.sample_keys[z], self.random.random_sample(len(values) - len(self.samples[z]))])
+
+                if len(values) > STATS_SAMPLE_SIZE:
+                    kept   = np.argpartition(keys, STATS_SAMPLE_SIZE)[:STATS_SAMPLE_SIZE]
+                    values = values[kept]
+                    keys   = keys[kept]
+
+                self.samples[z]     = values
+                self.sample_keys[z] = keys
+
+        self.n_frames += chunk.shape[0]
+
+    def plane_percentile(self, z):
+        if self.integer:
+            cumulative = np.cumsum(self.histograms[z])
+
+            if len(cumulative) == 0 or cumulative[-1] == 0:
+                return 0
+
+            index = np.searchsorted(cumulative, self.percentile/100.0*cumulative[-1])
+
+            return index + int(np.iinfo(self.dtype).min)
+        else:
+            if len(self.samples[z]) == 0:
+                return 0
+
+            return np.percentile(self.samples[z], self.percentile)
+
+    def result(self, percentile=True):
+        '''
+        Returns a dictionary of the statistics of the frames that have been added so far.
+        Percentiles are left out if percentile is False, since they are the slowest to find.
+        '''
+
+        result = {'mean'    : self.total/max(1, self.n_frames),
+                  'max'     : self.maximum,
+                  'min'     : self.minimum,
+                  'n_frames': np.array(self.n_frames)}
+
+        if percentile:
+            result['percentile'] = np.array([ self.plane_percentile(z) for z in range(self.frame_shape[0]) ], dtype=np.float64)
+
+        return result
+
+def compute_video_stats(video, chunk_bytes=STATS_CHUNK_BYTES, percentile=STATS_PERCENTILE, progress=None, thread=None):
+    '''
+    Computes the per-plane mean image, maximum, minimum and percentile of a video in a single
+    chunked pass. progress (if given) is called with the statistics so far (without percentiles)
+    after each chunk. Returns None if the given thread stops running before the whole video is read.
+    '''
+
+    accumulator = VideoStatsAccumulator(video.shape[1:], video.dtype, percentile=percentile)
+
+    for chunk in frame_chunks(video, chunk_bytes=chunk_bytes):
+        if thread is not None and not thread.running:
+            return None
+
+        accumulator.add(chunk)
+
+        if progress is not None:
+            progress(accumulator.result(percentile=False))
+
+    return accumulator.result()
+
+def stats_cache_path(video_path, directory=None):
+    # cache files are saved next to the video, unless another directory is given
+    if directory is None:
+        directory = os.path.dirname(video_path)
+
+    name = os.path.splitext(os.path.basename(video_path))[0]
+
+    return os.path.join(directory, name + STATS_SUFFIX)
+
+def video_file_key(video_path):
+    # a video is assumed to be unchanged if its size & modification time are the same
+    stat = os.stat(video_path)
+
+    return np.array([stat.st_size, stat.st_mtime])
+
+def load_cached_stats(cache_path, video_path):
+    '''Returns a dictionary of cached statistics of a video, or None if there are none or the video has changed.'''
+
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        data = np.load(cache_path)
+
+        if not np.array_equal(data['file_key'], video_file_key(video_path)):
+            return None
+
+        return { key: data[key] for key in data.files if key != 'file_key' }
+    except:
+        return None
+
+def save_cached_stats(cache_path, video_path, stats):
+    try:
+        np.savez(cache_path, file_key=video_file_key(video_path), **stats)
+    except:
+        print("Could not save video statistics to {}.".format(cache_path))
+
+def get_plane_means(video_path, cache_directory=None, video=None):
+    '''
+    Returns the mean images of each plane of a video. Means are cached in a file next to the
+    video (or in cache_directory), so they are only computed once.
+    '''
+
+    cache_path = stats_cache_path(video_path, directory=cache_directory)
+
+    stats = load_cached_stats(cache_path, video_path)
+
+    if stats is not None and 'mean' in stats.keys():
+        return stats['mean']
+
+    if video is None:
+        video = open_video_or_pages(video_path)
+
+    plane_means = compute_plane_means(video)
+
+    if stats is None:
+        stats = {}
+    stats['mean'] = plane_means
+
+    save_cached_stats(cache_path, video_path, stats)
+
+    return plane_means
+
+def get_cached_video_stats(video_path, cache_directory=None):
+    '''Returns the cached statistics of a video, or None if they haven't all been computed yet.'''
+
+    stats = load_cached_stats(stats_cache_path(video_path, directory=cache_directory), video_path)
+
+    if stats is None or not all([ key in stats.keys() for key in VIDEO_STATS_KEYS ]):
+        return None
+
+    return stats
+
+def get_video_stats(video_path, cache_directory=None, video=None, progress=None, thread=None):
+    '''
+    Returns the per-plane mean images, maxima, minima and percentiles of a video (as stored on
+    disk). Statistics are cached in a file next to the video (or in cache_directory), so revisiting
+    a video doesn't read it again.
+    '''
+
+    stats = get_cached_video_stats(video_path, cache_directory=cache_directory)
+
+    if stats is not None:
+        return stats
+
+    if video is None:
+        video = open_video_or_pages(video_path)
+
+    video_stats = compute_video_stats(video, progress=progress, thread=thread)
+
+    if video_stats is None:
+        return None
+
+    cache_path = stats_cache_path(video_path, directory=cache_directory)
+
+    # keep any other cached statistics
+    stats = load_cached_stats(cache_path, video_path)
+
+    if stats is None:
+        stats = {}
+    stats.update(video_stats)
+
+    save_cached_stats(cache_path, video_path, stats)
+
+    return stats
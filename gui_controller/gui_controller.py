@@ -1,12 +1,16 @@
 import platform
-from PIL import Image
+import tifffile
+import cv2
 
 from controller import utilities
+from controller.lazy_video import PlaneVideo, ShiftCorrectedVideo, MC_SHIFTS_SUFFIX
+from controller.video_stats import get_video_stats, get_cached_video_stats, dynamic_range
 from windows.param_window.param_window import ParamWindow
 from windows.preview_window import PreviewWindow
 from windows.cnn_training_window import CNNTrainingWindow
 from windows.dataset_editing_window import DatasetEditingWindow
 from .tail_trace_parameters_dialog import TailTraceParametersDialog
+from .roi_overlays import ROIOverlays, roi_colors
 from .cnn_training_parameters_dialog import CNNTrainingParametersDialog
 from windows.regression_plot_window import RegressionPlotWindow
 from windows.secondary_image_window import SecondaryImageWindow
@@ -47,6 +51,7 @@ class GUIController():
         self.motion_correction_thread = None
         self.roi_finding_thread = None
         self.video_processing_thread = None
+        self.video_stats_thread = None
 
         # set the mode -- "loading" / "motion_correcting" / "roi_finding" / "roi_filtering"
         self.mode = "loading"
@@ -82,13 +87,14 @@ class GUIController():
 
     def reset_variables(self):
         self.video = None  # currently loaded video
-        self.adjusted_video = None  # gamma- and contrast-adjusted video (for the current z plane)
+        self.contrast_lut = None  # lookup table used to contrast- and gamma-adjust frames as they are shown
         self.mean_images = []  # mean images for all z planes
         self.adjusted_mean_image = None  # gamma- and contrast-adjusted mean image (for the current z plane)
         self.selected_rois = []  # ROIs currently selected by the user
         self.video_num = None  # which video is currently loaded
         self.group_num = None  # group number of currently loaded video
         self.video_max = 1  # dynamic range of currently loaded video
+        self.stats_video_path = None  # path of the video whose mean images & dynamic range are shown
         self.mask_images = None  # list of mask images for each z plane in the currently loaded video
         self.selected_mask = None  # which mask, if any, is selected
         self.roi_contours = []  # list of contours for each ROI in the current z plane
@@ -106,6 +112,8 @@ class GUIController():
 
         self.regression_z = 0
         self.max_p = 0.05
+        self.n_shuffles = 0  # number of shuffled regressors used to find empirical p-values (0 = use analytic p-values)
+        self.use_fdr = False  # whether max_p is a false discovery rate over the ROIs of a plane
         self.regressor_index = 0
         self.n_regressors = 0
         self.selected_regressors = []
@@ -113,6 +121,7 @@ class GUIController():
         self.correlation_results = None
         self.regression_coefficients = None
         self.regression_intercepts = None
+        self.regression_cache = None
         self.regressors = None
         self.spatial_footprints = None
         self.temporal_footprints = None
@@ -136,7 +145,9 @@ class GUIController():
          self.regressors, self.spatial_footprints, self.temporal_footprints, self.calcium_video,
          self.regressor_mean_images, self.n_frames, self.roi_centers) = regressor_analysis(
             self.calcium_video_fnames[self.selected_video], self.roi_data_fnames[self.selected_video], bout_fnames,
-            frame_timestamp_fnames, self.tail_calcium_offset)
+            frame_timestamp_fnames, self.tail_calcium_offset, n_shuffles=self.n_shuffles)
+
+        self.regression_cache = None
 
         self.regression_plot_window.update_plots()
 
@@ -146,8 +157,11 @@ class GUIController():
         selected_keys = [keys[i] for i in range(len(keys)) if self.checkboxes[i].isChecked()]
         selected_regressors = {k: self.regressors[k] for k in selected_keys if k in self.regressors}
 
-        self.regression_coefficients, self.regression_intercepts, self.regression_scores = multilinear_regression(
-            selected_regressors, self.temporal_footprints)
+        # refit from the cached cross products of the regressors & traces
+        if self.regression_cache is None:
+            self.regression_cache = RegressionCache(self.regressors, self.temporal_footprints)
+
+        self.regression_coefficients, self.regression_intercepts, self.regression_scores = self.regression_cache.fit(selected_keys)
 
         self.regression_plot_window.update_plots(selected_regressors=selected_regressors)
 
@@ -204,15 +218,21 @@ class GUIController():
         else:
             return None
 
+    def roi_state(self):
+        if self.group_num in self.controller.roi_states.keys():
+            return self.controller.roi_state(self.group_num, self.z)
+        else:
+            return None
+
     def filtered_out_rois(self):
-        if self.group_num in self.controller.filtered_out_rois.keys():
-            return self.controller.filtered_out_rois[self.group_num][self.z]
+        if self.roi_state() is not None:
+            return self.roi_state().filtered_out_rois
         else:
             return []
 
     def removed_rois(self):
-        if self.group_num in self.controller.all_removed_rois.keys():
-            return self.controller.all_removed_rois[self.group_num][self.z]
+        if self.roi_state() is not None:
+            return self.roi_state().all_removed_rois
         else:
             return []
 
@@ -342,7 +362,11 @@ class GUIController():
         # load the video
         base_name = os.path.basename(video_path)
         if base_name.endswith('.tif') or base_name.endswith('.tiff'):
-            self.video = tifffile.memmap(video_path)
+            # only the pages of the planes that are viewed are read
+            self.video = PlaneVideo(video_path)
+        elif base_name.endswith(MC_SHIFTS_SUFFIX):
+            # motion-corrected frames are created from the original video as they are read
+            self.video = ShiftCorrectedVideo(video_path)
         else:
             print("Error: Attempted to open a non-TIFF file. Only TIFF files are currently supported.")
             return
@@ -354,24 +378,6 @@ class GUIController():
         if self.z >= self.video.shape[1]:
             self.z = 0
 
-        # figure out the dynamic range of the video
-        max_value = np.amax(self.video)
-
-        if max_value > 2047:
-            self.video_max = 4095
-        elif max_value > 1023:
-            self.video_max = 2047
-        elif max_value > 511:
-            self.video_max = 1023
-        elif max_value > 255:
-            self.video_max = 511
-        elif max_value > 1:
-            self.video_max = 255
-        else:
-            self.video_max = 1
-
-        print("Video max: {}.".format(self.video_max))
-
         if len(self.video.shape) == 3:
             # add a z dimension
             self.video = self.video[:, np.newaxis, :, :]
@@ -381,10 +387,10 @@ class GUIController():
 
         print("Opened video with shape {}.".format(self.video.shape))
 
-        self.update_adjusted_video()
+        # get the mean images & dynamic range of the video
+        self.update_mean_images(video_path)
 
-        # calculate mean images
-        self.update_mean_images()
+        print("Video max: {}.".format(self.video_max))
 
         group_changed = self.group_num != old_group_num
         z_changed = self.z != old_z
@@ -416,11 +422,68 @@ class GUIController():
         string = ",".join([str(f) for f in self.controller.ignored_frames[self.video_num]])
         self.param_window.update_ignored_frames_textbox(string)
 
-    def update_mean_images(self):
-        self.mean_images = np.mean(self.video, axis=0)
+    def update_mean_images(self, video_path):
+        # stop computing the statistics of the previously loaded video
+        if self.video_stats_thread is not None:
+            self.video_stats_thread.running = False
+
+        self.stats_video_path = video_path
+
+        stats = get_cached_video_stats(video_path)
+
+        if stats is not None:
+            self.update_video_stats(stats)
+        else:
+            # show the first frame until the statistics of the video have been computed in the background
+            first_frame = np.asarray(self.video[0]).astype(np.float64)
+
+            self.video_max   = dynamic_range(np.amax(first_frame))
+            self.mean_images = first_frame
+
+            self.update_contrast_lut()
+            self.update_adjusted_mean_image()
+
+            self.video_stats_thread = VideoStatsThread(self.param_window)
+            self.video_stats_thread.progress.connect(self.video_stats_progress)
+            self.video_stats_thread.finished.connect(self.video_stats_progress)
+            self.video_stats_thread.set_parameters(video_path)
+            self.video_stats_thread.start()
+
+    def update_video_stats(self, stats):
+        # statistics are computed on the video as it's stored on disk, so the mean images are only
+        # flipped if the frames that are shown are flipped
+        mean_images = stats['mean']
 
+        if self.video.flipped:
+            mean_images = mean_images.transpose((0, 2, 1))
+
+        if mean_images.shape != tuple(self.video.shape[1:]):
+            print("Error: Mean images have shape {}, but frames have shape {}.".format(mean_images.shape, self.video.shape[1:]))
+            return
+
+        # get the dynamic range of the video from the maximum of all of its planes
+        self.video_max   = dynamic_range(np.amax(stats['max']))
+        self.mean_images = mean_images
+
+        self.update_contrast_lut()
         self.update_adjusted_mean_image()
 
+    def video_stats_progress(self, video_path, stats):
+        # ignore statistics of a video that is no longer loaded
+        if self.video is None or video_path != self.stats_video_path:
+            return
+
+        old_video_max = self.video_max
+
+        # show the statistics of the frames that have been read so far
+        self.update_video_stats(stats)
+
+        if self.video_playing:
+            if self.video_max != old_video_max:
+                self.preview_window.refresh_frames()
+        else:
+            self.show_mean_image()
+
     def update_mask_images(self):
         self.mask_images = [[] for z in range(self.video.shape[1])]
 
@@ -432,15 +495,16 @@ class GUIController():
                     mask = self.create_mask_image(z, mask_points)
                     self.mask_images[z].append(mask)
 
-    def update_adjusted_video(self):
-        self.adjusted_video = utilities.adjust_gamma(
-            utilities.adjust_contrast(self.video[:, self.z, :, :], self.gui_params['contrast']),
-            self.gui_params['gamma'])
+    def update_contrast_lut(self):
+        # only rebuild the lookup table when the contrast, gamma or dynamic range changes
+        if self.contrast_lut is None or not self.contrast_lut.matches(self.gui_params['contrast'], self.gui_params['gamma'], self.video_max):
+            self.contrast_lut = utilities.ContrastLUT(self.gui_params['contrast'], self.gui_params['gamma'], self.video_max)
 
     def adjusted_frame(self, frame):
-        return utilities.adjust_gamma(
-            utilities.adjust_contrast(self.video[frame, self.z, :, :], self.gui_params['contrast']),
-            self.gui_params['gamma'])
+        # contrast- and gamma-adjusted frame of the current z plane, as the uint8 image that is displayed
+        self.update_contrast_lut()
+
+        return self.contrast_lut(self.video[frame, self.z, :, :])
 
     def update_adjusted_mean_image(self):
         self.adjusted_mean_image = utilities.adjust_gamma(
@@ -448,32 +512,11 @@ class GUIController():
 
     def update_roi_contours_and_overlays(self):
         if self.roi_spatial_footprints() is not None:
-            roi_spatial_footprints = self.roi_spatial_footprints().toarray()
-
-            roi_spatial_footprints = roi_spatial_footprints.reshape(
-                (self.video.shape[2], self.video.shape[3], roi_spatial_footprints.shape[-1])).transpose((1, 0, 2))
-
-            self.roi_contours = [None for i in range(roi_spatial_footprints.shape[-1])]
-
-            self.roi_overlays = np.zeros(
-                (roi_spatial_footprints.shape[-1], self.video.shape[2], self.video.shape[3], 4)).astype(np.uint8)
-
-            for i in range(roi_spatial_footprints.shape[-1]):
-                maximum = np.amax(roi_spatial_footprints[:, :, i])
-
-                mask = (roi_spatial_footprints[:, :, i] > 0).copy()
+            colors = roi_colors(self.roi_spatial_footprints().shape[-1], cmap, n_colors)
 
-                contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                color = cmap(i % n_colors)[:3]
-                color = [255 * color[0], 255 * color[1], 255 * color[2]]
-
-                overlay = np.zeros((self.video.shape[2], self.video.shape[3], 4)).astype(np.uint8)
-                overlay[mask, :-1] = color
-                overlay[mask, -1] = 255.0 * roi_spatial_footprints[mask, i] / maximum
-                self.roi_overlays[i] = overlay
-
-                self.roi_contours[i] = contours
+            # build overlays straight from the sparse footprints -- contours are found when ROIs are drawn
+            self.roi_overlays = ROIOverlays(self.roi_spatial_footprints(), self.video.shape[2:], colors)
+            self.roi_contours = self.roi_overlays.contours
         else:
             self.roi_overlays = []
             self.roi_contours = []
@@ -482,25 +525,16 @@ class GUIController():
         roi_spatial_footprints = self.roi_spatial_footprints()
 
         if roi_spatial_footprints is not None:
-            kept_rois = [roi for roi in range(roi_spatial_footprints.shape[-1]) if roi not in self.removed_rois()]
+            # only the pixels of ROIs that were kept or removed since the last update are re-composited
+            self.roi_overlays.set_removed_rois(self.removed_rois())
 
-            if len(kept_rois) > 0:
-                a = Image.fromarray(self.roi_overlays[kept_rois[0]])
-                for roi in kept_rois[1:]:
-                    b = Image.fromarray(self.roi_overlays[roi])
-                    a.alpha_composite(b)
-                self.kept_rois_overlay = np.asarray(a)
+            if self.roi_overlays.n_kept > 0:
+                self.kept_rois_overlay = self.roi_overlays.kept_overlay
             else:
                 self.kept_rois_overlay = None
 
-            removed_rois = [roi for roi in range(roi_spatial_footprints.shape[-1]) if roi in self.removed_rois()]
-
-            if len(removed_rois) > 0:
-                a = Image.fromarray(self.roi_overlays[removed_rois[0]])
-                for roi in removed_rois[1:]:
-                    b = Image.fromarray(self.roi_overlays[roi])
-                    a.alpha_composite(b)
-                self.removed_rois_overlay = np.asarray(a)
+            if self.roi_overlays.n_removed > 0:
+                self.removed_rois_overlay = self.roi_overlays.removed_overlay
             else:
                 self.removed_rois_overlay = None
         else:
@@ -625,7 +659,7 @@ class GUIController():
 
     def load_rois(self):
         # let the user pick saved ROIs
-        load_path = QFileDialog.getOpenFileName(self.param_window, 'Select saved ROI data.', '', 'Numpy (*.npy)')[0]
+        load_path = QFileDialog.getOpenFileName(self.param_window, 'Select saved ROI data.', '', 'ROI data (*.h5 *.hdf5 *.npy)')[0]
 
         if load_path is not None and len(load_path) > 0:
             self.controller.load_rois(load_path, group_num=self.group_num, video_path=self.loaded_video_path())
@@ -707,110 +741,8 @@ class GUIController():
     def save_all_rois(self):
         save_directory = str(QFileDialog.getExistingDirectory(self.param_window, "Select Directory"))
 
-        video_paths = self.video_paths()
-
-        for i in range(len(video_paths)):
-            video_path = self.controller.video_paths[i]
-
-            base_name = os.path.basename(video_path)
-            name = os.path.splitext(base_name)[0]
-            directory = os.path.dirname(video_path)
-            video_dir_path = os.path.join(save_directory, name)
-
-            # make a folder to hold the results
-            if not os.path.exists(video_dir_path):
-                os.makedirs(video_dir_path)
-
-            video = tifffile.memmap(video_path)
-
-            if len(video.shape) == 3:
-                # add z dimension
-                video = video[:, np.newaxis, :, :]
-
-            group_num = self.controller.video_groups[i]
-
-            roi_spatial_footprints = self.controller.roi_spatial_footprints[group_num]
-            roi_temporal_footprints = self.controller.roi_temporal_footprints[group_num]
-            roi_temporal_residuals = self.controller.roi_temporal_residuals[group_num]
-            bg_spatial_footprints = self.controller.bg_spatial_footprints[group_num]
-            bg_temporal_footprints = self.controller.bg_temporal_footprints[group_num]
-
-            manually_removed_rois = self.controller.manually_removed_rois[group_num]
-            all_removed_rois = self.controller.all_removed_rois[group_num]
-            locked_rois = self.controller.locked_rois[group_num]
-
-            # save centroids & traces
-            for z in range(video.shape[1]):
-                print("Calculating ROI activities for z={}...".format(z))
-
-                centroids = np.zeros((roi_spatial_footprints[z].shape[-1], 2))
-                kept_rois = [roi for roi in range(roi_spatial_footprints[z].shape[-1]) if
-                             (roi not in all_removed_rois[z]) or (roi in locked_rois[z])]
-
-                footprints_2d = roi_spatial_footprints[z].toarray().reshape(
-                    (video.shape[2], video.shape[3], roi_spatial_footprints[z].shape[-1]))
-
-                for roi in kept_rois:
-                    footprint_2d = footprints_2d[:, :, roi]
-
-                    mask = footprint_2d > 0
-
-                    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                    if len(contours) > 0:
-                        contour = contours[0]
-
-                        M = cv2.moments(contour)
-                        if M["m00"] > 0:
-                            center_x = int(M["m10"] / M["m00"])
-                            center_y = int(M["m01"] / M["m00"])
-                        else:
-                            center_x = 0
-                            center_y = 0
-
-                        centroids[roi] = [center_x, center_y]
-
-                temporal_footprints = roi_temporal_footprints[z]
-
-                group_indices = [i for i in range(len(self.controller.video_paths)) if
-                                 self.controller.video_groups[i] == group_num]
-                group_paths = [self.controller.video_paths[i] for i in group_indices]
-                group_lengths = [self.controller.video_lengths[i] for i in group_indices]
-
-                index = group_paths.index(video_path)
-
-                if index == 0:
-                    temporal_footprints = temporal_footprints[:, :group_lengths[0]]
-                else:
-                    temporal_footprints = temporal_footprints[:,
-                                          np.sum(group_lengths[:index]):np.sum(group_lengths[:index + 1])]
-
-                traces = temporal_footprints[kept_rois]
-                centroids = centroids[kept_rois]
-
-                print("Saving CSV for z={}...".format(z))
-
-                with open(os.path.join(video_dir_path, 'z_{}_traces.csv'.format(z)), 'w') as file:
-                    writer = csv.writer(file)
-
-                    writer.writerow(['ROI #'] + ["Frame {}".format(frame) for frame in range(traces.shape[1])])
-
-                    for j in range(traces.shape[0]):
-                        writer.writerow(['{}'.format(kept_rois[j])] + traces[j].tolist())
-
-                with open(os.path.join(video_dir_path, 'z_{}_centroids.csv'.format(z)), 'w') as file:
-                    writer = csv.writer(file)
-
-                    writer.writerow(['Label', 'X', 'Y'])
-
-                    for j in range(centroids.shape[0]):
-                        writer.writerow(["ROI #{}".format(kept_rois[j] + 1)] + centroids[j].tolist())
-
-                # save ROIs
-                self.controller.save_rois(os.path.join(video_dir_path, 'roi_data.npy'), group_num=group_num,
-                                          video_path=video_path)
-
-                print("Done.")
+        if save_directory is not None and len(save_directory) > 0:
+            self.controller.save_all_rois(save_directory)
 
     def motion_correct_and_find_rois(self):
         self.roi_finding_queued = True
@@ -839,7 +771,11 @@ class GUIController():
                                                                               int(self.controller.params[
                                                                                       "patch_stride"]), int(
                 self.controller.params["patch_overlap"]), progress_signal=None, thread=None,
-                                                                              use_multiprocessing=self.controller.use_multiprocessing)
+                                                                              use_multiprocessing=self.controller.use_multiprocessing,
+                                                                              parallel_planes=self.controller.params["parallel_planes"],
+                                                                              max_workers=int(self.controller.params["max_workers"]),
+                                                                              mc_cache=self.controller.get_mc_cache(),
+                                                                              shifts_only=self.controller.params["mc_shifts_only"])
 
         self.motion_correction_ended(mc_video_paths, mc_borders)
 
@@ -869,7 +805,7 @@ class GUIController():
 
         self.load_video(self.video_num)
 
-        self.update_adjusted_video()
+        self.update_contrast_lut()
         self.update_adjusted_mean_image()
 
         if self.mode in ("loading", "motion_correcting"):
@@ -890,6 +826,7 @@ class GUIController():
         # self.roi_finding_thread.set_parameters(video_paths, self.controller.video_groups, self.controller.params, self.controller.mc_borders, self.controller.use_multiprocessing, method=self.controller.roi_finding_mode, mask_points=self.controller.mask_points)
 
         # self.roi_finding_thread.progress.connect(self.roi_finding_progress)
+        # self.roi_finding_thread.plane_progress.connect(self.roi_finding_plane_progress)
         # self.roi_finding_thread.finished.connect(self.roi_finding_ended)
 
         # # start the thread
@@ -911,6 +848,10 @@ class GUIController():
         # notify the param window
         self.param_window.update_roi_finding_progress(group_num)
 
+    def roi_finding_plane_progress(self, group_num, z, n_done, n_planes):
+        # notify the param window
+        self.param_window.update_roi_finding_plane_progress(group_num, z, n_done, n_planes)
+
     def roi_finding_ended(self, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals,
                           bg_spatial_footprints, bg_temporal_footprints):
         self.controller.roi_spatial_footprints = roi_spatial_footprints
@@ -919,14 +860,8 @@ class GUIController():
         self.controller.bg_spatial_footprints = bg_spatial_footprints
         self.controller.bg_temporal_footprints = bg_temporal_footprints
 
-        self.controller.filtered_out_rois = {group_num: [[] for z in range(len(roi_spatial_footprints[group_num]))] for
-                                             group_num in np.unique(self.controller.video_groups)}
-        self.controller.manually_removed_rois = {group_num: [[] for z in range(len(roi_spatial_footprints[group_num]))]
-                                                 for group_num in np.unique(self.controller.video_groups)}
-        self.controller.all_removed_rois = {group_num: [[] for z in range(len(roi_spatial_footprints[group_num]))] for
-                                            group_num in np.unique(self.controller.video_groups)}
-        self.controller.locked_rois = {group_num: [[] for z in range(len(roi_spatial_footprints[group_num]))] for
-                                       group_num in np.unique(self.controller.video_groups)}
+        self.controller.update_footprint_dims()
+        self.controller.reset_roi_states()
 
         # notify the param window
         self.param_window.roi_finding_ended()
@@ -990,14 +925,12 @@ class GUIController():
     def preview_contrast(self, contrast):
         self.gui_params['contrast'] = contrast
 
-        if self.video_playing:
-            self.preview_window.timer.stop()
-
-            # calculate a contrast- and gamma-adjusted version of the current frame
-            adjusted_frame = self.adjusted_frame(self.preview_window.frame_num)
+        self.update_contrast_lut()
 
-            # show the adjusted frame
-            self.preview_window.show_frame(adjusted_frame)
+        if self.video_playing:
+            # discard prefetched frames, so playback continues with the new lookup table
+            self.preview_window.refresh_frames()
+            self.preview_window.show_frame(self.adjusted_frame(self.preview_window.frame_num))
         else:
             # calculate a contrast- and gamma-adjusted version of the current mean image
             self.update_adjusted_mean_image()
@@ -1008,14 +941,12 @@ class GUIController():
     def preview_gamma(self, gamma):
         self.gui_params['gamma'] = gamma
 
-        if self.video_playing:
-            self.preview_window.timer.stop()
-
-            # calculate a contrast- and gamma-adjusted version of the current frame
-            adjusted_frame = self.adjusted_frame(self.preview_window.frame_num)
+        self.update_contrast_lut()
 
-            # show the adjusted frame
-            self.preview_window.show_frame(adjusted_frame)
+        if self.video_playing:
+            # discard prefetched frames, so playback continues with the new lookup table
+            self.preview_window.refresh_frames()
+            self.preview_window.show_frame(self.adjusted_frame(self.preview_window.frame_num))
         else:
             # calculate a contrast- and gamma-adjusted version of the current mean image
             self.update_adjusted_mean_image()
@@ -1045,12 +976,15 @@ class GUIController():
         elif param in self.gui_params.keys():
             self.gui_params[param] = value
 
-        if param in ("contrast, gamma"):
-            self.update_adjusted_video()
+        if param in utilities.ROI_FILTER_PARAMS and self.controller.has_roi_metrics(self.group_num):
+            # update which ROIs are filtered out, without recomputing their metrics
+            self.refilter_rois()
+        elif param in ("contrast, gamma"):
+            self.update_contrast_lut()
             self.update_adjusted_mean_image()
 
             if self.video_playing:
-                self.play_video()
+                self.preview_window.refresh_frames()
             else:
                 self.show_mean_image()
         elif param == "fps":
@@ -1064,7 +998,6 @@ class GUIController():
         if param == "z":
             self.z = value
 
-            self.update_adjusted_video()
             self.update_adjusted_mean_image()
 
             self.update_roi_contours_and_overlays()
@@ -1131,6 +1064,15 @@ class GUIController():
 
         self.controller.filter_rois(mean_images, self.group_num)
 
+        self.update_filtered_rois()
+
+    def refilter_rois(self):
+        # re-apply the filtering thresholds to the cached ROI metrics
+        self.controller.apply_roi_filters(self.group_num)
+
+        self.update_filtered_rois()
+
+    def update_filtered_rois(self):
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
 
@@ -1158,11 +1100,9 @@ class GUIController():
             return
 
         if roi_point is not None:
-            if len(self.controller.roi_spatial_footprints) > 0:
-                # find out which ROI to select
-                selected_roi = utilities.get_roi_containing_point(
-                    self.controller.roi_spatial_footprints[self.group_num][self.z], roi_point,
-                    self.mean_images[self.z].shape)
+            if len(self.controller.roi_spatial_footprints) > 0 and self.roi_overlays is not None and len(self.roi_overlays) > 0:
+                # find out which ROI to select, using the index of the ROIs covering each pixel
+                selected_roi = self.roi_overlays.index.roi_at(roi_point)
 
                 print("Selected ROI: {}".format(selected_roi))
 
@@ -1190,6 +1130,44 @@ class GUIController():
 
                     self.preview_window.no_rois_selected()
 
+    def select_rois_in_region(self, points, ctrl_held=False, removed=None):
+        # select all of the ROIs inside of a rectangle (given by two corners) or a lasso (given by a list of points),
+        # only keeping discarded ROIs (if removed is True) or kept ROIs (if removed is False)
+        if self.mode == "loading" or self.mode == "motion_correcting":
+            return
+
+        if self.roi_overlays is None or len(self.roi_overlays) == 0:
+            return
+
+        if len(points) == 2:
+            rois = self.roi_overlays.index.rois_in_rectangle(points[0], points[1])
+        else:
+            rois = self.roi_overlays.index.rois_in_polygon(points)
+
+        if removed is not None:
+            removed_rois = self.removed_rois()
+            rois = np.array([ roi for roi in rois.tolist() if (roi in removed_rois) == removed ], dtype=int)
+
+        if ctrl_held:
+            self.selected_rois += [ roi for roi in rois.tolist() if roi not in self.selected_rois ]
+        else:
+            self.selected_rois = rois.tolist()
+
+        if len(self.selected_rois) == 1:
+            self.param_window.single_roi_selected(discarded=self.selected_rois[0] in self.removed_rois())
+        elif len(self.selected_rois) > 1:
+            self.param_window.multiple_rois_selected(
+                discarded=any(x in self.selected_rois for x in self.removed_rois()),
+                merge_enabled=self.bg_temporal_footprints() is not None)
+        else:
+            self.preview_window.clear_outline_items()
+
+            self.param_window.no_rois_selected()
+
+            self.preview_window.no_rois_selected()
+
+        self.update_selected_rois_plot()
+
     def load_tail_angles(self):
         load_path = QFileDialog.getOpenFileName(self.param_window, 'Select saved tail angle data.', '', 'CSV (*.csv)')[
             0]
@@ -1239,30 +1217,10 @@ class GUIController():
         self.controller.roi_temporal_residuals[self.group_num][self.z] = \
             self.controller.roi_temporal_residuals[self.group_num][self.z][nonerased_rois]
 
-        self.roi_contours = [self.roi_contours[i] for i in nonerased_rois]
-        self.roi_overlays = [self.roi_overlays[i] for i in nonerased_rois]
-
-        for roi in sorted(self.selected_rois, reverse=True):
-            if roi in self.controller.all_removed_rois[self.group_num][self.z]:
-                i = self.controller.all_removed_rois[self.group_num][self.z].index(roi)
-                del self.controller.all_removed_rois[self.group_num][self.z][i]
+        self.roi_overlays = self.roi_overlays.subset(nonerased_rois)
+        self.roi_contours = self.roi_overlays.contours
 
-            if roi in self.controller.manually_removed_rois[self.group_num][self.z]:
-                i = self.controller.manually_removed_rois[self.group_num][self.z].index(roi)
-                del self.controller.manually_removed_rois[self.group_num][self.z][i]
-
-            if roi in self.controller.locked_rois[self.group_num][self.z]:
-                i = self.controller.locked_rois[self.group_num][self.z].index(roi)
-                del self.controller.locked_rois[self.group_num][self.z][i]
-
-            self.controller.all_removed_rois[self.group_num][self.z] = [(a if a < roi else a - 1) for a in
-                                                                        self.controller.all_removed_rois[
-                                                                            self.group_num][self.z]]
-            self.controller.manually_removed_rois[self.group_num][self.z] = [(a if a < roi else a - 1) for a in
-                                                                             self.controller.manually_removed_rois[
-                                                                                 self.group_num][self.z]]
-            self.controller.locked_rois[self.group_num][self.z] = [(a if a < roi else a - 1) for a in
-                                                                   self.controller.locked_rois[self.group_num][self.z]]
+        self.roi_state().remove(self.selected_rois)
 
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
@@ -1295,11 +1253,7 @@ class GUIController():
             self.preview_window.create_text_items()
 
     def discard_all_rois(self):
-        self.controller.manually_removed_rois[self.group_num][self.z] = np.arange(
-            self.controller.roi_spatial_footprints[self.group_num][self.z].shape[1]).tolist()
-        self.controller.filtered_out_rois[self.group_num][self.z] = []
-        self.controller.all_removed_rois[self.group_num][self.z] = \
-            self.controller.manually_removed_rois[self.group_num][self.z][:]
+        self.roi_state().discard_all()
 
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
@@ -1332,9 +1286,7 @@ class GUIController():
             self.preview_window.create_text_items()
 
     def keep_all_rois(self):
-        self.controller.manually_removed_rois[self.group_num][self.z] = []
-        self.controller.filtered_out_rois[self.group_num][self.z] = []
-        self.controller.all_removed_rois[self.group_num][self.z] = []
+        self.roi_state().keep_all()
 
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
@@ -1387,8 +1339,6 @@ class GUIController():
     def merge_selected_rois(self):
         if len(self.selected_rois) > 1:
             print(self.controller.roi_temporal_footprints[self.group_num][self.z].shape)
-            all_rois_pre = np.arange(self.controller.roi_temporal_footprints[self.group_num][self.z].shape[0])
-
             video_paths = self.controller.video_paths_in_group(self.video_paths(), self.group_num)
 
             roi_spatial_footprints, roi_temporal_footprints = utilities.merge_rois(self.selected_rois,
@@ -1403,55 +1353,8 @@ class GUIController():
             self.controller.roi_spatial_footprints[self.group_num][self.z] = roi_spatial_footprints
             self.controller.roi_temporal_footprints[self.group_num][self.z] = roi_temporal_footprints
 
-            all_removed_rois = self.controller.all_removed_rois[self.group_num][self.z]
-            locked_rois = self.controller.locked_rois[self.group_num][self.z]
-            manually_removed_rois = self.controller.manually_removed_rois[self.group_num][self.z]
-            filtered_out_rois = self.controller.filtered_out_rois[self.group_num][self.z]
-
-            mapping = {}
-
-            for i in sorted(self.selected_rois, reverse=True):
-                all_rois_pre = np.delete(all_rois_pre, i)
-
-                if i in all_removed_rois:
-                    index = all_removed_rois.index(i)
-
-                    del all_removed_rois[index]
-
-                if i in locked_rois:
-                    index = locked_rois.index(i)
-
-                    del locked_rois[index]
-
-                if i in manually_removed_rois:
-                    index = manually_removed_rois.index(i)
-
-                    del manually_removed_rois[index]
-
-                if i in filtered_out_rois:
-                    index = filtered_out_rois.index(i)
-
-                    del filtered_out_rois[index]
-
-            for i in range(len(all_rois_pre)):
-                mapping[all_rois_pre[i]] = i
-
-            for i in range(len(all_removed_rois)):
-                all_removed_rois[i] = mapping[all_removed_rois[i]]
-
-            for i in range(len(locked_rois)):
-                locked_rois[i] = mapping[locked_rois[i]]
-
-            for i in range(len(manually_removed_rois)):
-                manually_removed_rois[i] = mapping[manually_removed_rois[i]]
-
-            for i in range(len(filtered_out_rois)):
-                filtered_out_rois[i] = mapping[filtered_out_rois[i]]
-
-            self.controller.all_removed_rois[self.group_num][self.z] = all_removed_rois
-            self.controller.locked_rois[self.group_num][self.z] = locked_rois
-            self.controller.manually_removed_rois[self.group_num][self.z] = manually_removed_rois
-            self.controller.filtered_out_rois[self.group_num][self.z] = filtered_out_rois
+            # remove the merged ROIs and add the new ROIs to the end
+            self.roi_state().merge(self.selected_rois, roi_spatial_footprints.shape[-1])
 
             self.update_roi_contours_and_overlays()
             self.update_merged_roi_overlays()
@@ -1539,11 +1442,7 @@ class GUIController():
         filtered_out_rois = [i for i in range(predictions.shape[0]) if
                              predictions[i, 0] < self.controller.params['cnn_accept_threshold']]
 
-        self.controller.filtered_out_rois[self.group_num][self.z] = filtered_out_rois
-
-        self.controller.all_removed_rois[self.group_num][self.z] = self.controller.filtered_out_rois[self.group_num][
-                                                                       self.z] + self.controller.manually_removed_rois[
-                                                                       self.group_num][self.z]
+        self.roi_state().set_filtered_out(filtered_out_rois)
 
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
@@ -1613,13 +1512,17 @@ class MotionCorrectThread(QThread):
 
         self.running = False
 
-    def set_parameters(self, video_paths, groups, max_shift, patch_stride, patch_overlap, use_multiprocessing=True):
+    def set_parameters(self, video_paths, groups, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, parallel_planes=False, max_workers=0, mc_cache=None, shifts_only=False):
         self.video_paths = video_paths
         self.groups = groups
         self.max_shift = max_shift
         self.patch_stride = patch_stride
         self.patch_overlap = patch_overlap
         self.use_multiprocessing = use_multiprocessing
+        self.parallel_planes = parallel_planes
+        self.max_workers = max_workers
+        self.mc_cache = mc_cache
+        self.shifts_only = shifts_only
 
     def run(self):
         self.running = True
@@ -1629,7 +1532,11 @@ class MotionCorrectThread(QThread):
                                                                               self.patch_overlap,
                                                                               progress_signal=self.progress,
                                                                               thread=self,
-                                                                              use_multiprocessing=self.use_multiprocessing)
+                                                                              use_multiprocessing=self.use_multiprocessing,
+                                                                              parallel_planes=self.parallel_planes,
+                                                                              max_workers=self.max_workers,
+                                                                              mc_cache=self.mc_cache,
+                                                                              shifts_only=self.shifts_only)
 
         self.finished.emit(mc_video_paths, mc_borders)
 
@@ -1637,8 +1544,9 @@ class MotionCorrectThread(QThread):
 
 
 class ROIFindingThread(QThread):
-    finished = pyqtSignal(dict, dict, dict, dict, dict)
-    progress = pyqtSignal(int)
+    finished       = pyqtSignal(dict, dict, dict, dict, dict)
+    progress       = pyqtSignal(int)
+    plane_progress = pyqtSignal(int, int, int, int)
 
     def __init__(self, parent):
         QThread.__init__(self, parent)
@@ -1662,9 +1570,39 @@ class ROIFindingThread(QThread):
         roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(
             self.video_paths, self.video_lengths, self.groups, self.gui_params, mc_borders=self.mc_borders,
             progress_signal=self.progress, thread=self, use_multiprocessing=self.use_multiprocessing,
-            method=self.method, mask_points=self.mask_points)
+            method=self.method, mask_points=self.mask_points, plane_progress_signal=self.plane_progress)
 
         self.finished.emit(roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals,
                            bg_spatial_footprints, bg_temporal_footprints)
 
         self.running = False
+
+
+class VideoStatsThread(QThread):
+    finished = pyqtSignal(str, object)
+    progress = pyqtSignal(str, object)
+
+    def __init__(self, parent):
+        QThread.__init__(self, parent)
+
+        self.running = False
+
+    def set_parameters(self, video_path):
+        self.video_path = video_path
+
+        # set here rather than in run(), so the thread can be stopped before it has started
+        self.running = True
+
+    def run(self):
+        try:
+            stats = get_video_stats(self.video_path, progress=lambda stats: self.progress.emit(self.video_path, stats), thread=self)
+        except Exception as e:
+            # keep showing the statistics of the first frame
+            print("Could not compute statistics of {}: {}".format(self.video_path, e))
+
+            stats = None
+
+        if stats is not None:
+            self.finished.emit(self.video_path, stats)
+
+        self.running = False
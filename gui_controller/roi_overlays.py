@@ -0,0 +1,218 @@
+import numpy as np
+import scipy.sparse
+import cv2
+
+from controller.roi_geometry import get_roi_bounding_boxes, ROISpatialIndex
+
+class ROIOverlays():
+    '''
+    Colored overlays of the ROIs in one z plane, built from their sparse spatial footprints.
+
+    Instead of a (ROIs, height, width, 4) stack of overlays, only the pixels & alpha values of
+    each ROI are kept, along with a label image that holds the top-most ROI at each pixel
+    and a weight image that holds its alpha. The overlay of a single ROI is rendered when it
+    is indexed, and contours are only found for ROIs that are drawn.
+    '''
+
+    def __init__(self, roi_spatial_footprints, video_shape, colors):
+        height, width = video_shape
+
+        # footprints are reshaped to (height, width) and transposed, so overlays are (width, height)
+        self.video_shape = tuple(video_shape)
+        self.image_shape = (width, height)
+        self.colors      = np.asarray(colors).astype(np.uint8)
+
+        self.roi_spatial_footprints = roi_spatial_footprints
+
+        # only keep the positive pixels of each footprint
+        footprints = scipy.sparse.csc_matrix(roi_spatial_footprints, copy=True)
+        footprints.data[footprints.data < 0] = 0
+        footprints.eliminate_zeros()
+        footprints.sort_indices()
+
+        self.n_rois = footprints.shape[-1]
+        self.indptr = footprints.indptr
+
+        # ROI that each stored pixel belongs to
+        self.entry_rois = np.repeat(np.arange(self.n_rois), np.diff(footprints.indptr))
+
+        # position of each stored pixel in the flattened overlay image
+        self.entry_pixels = (footprints.indices % width)*height + footprints.indices // width
+
+        # alpha of each stored pixel, relative to the maximum of its ROI
+        maxima = np.zeros(self.n_rois)
+        np.maximum.at(maxima, self.entry_rois, footprints.data)
+        self.entry_alphas = (255.0*footprints.data/maxima[self.entry_rois]).astype(np.uint8)
+
+        # label image of the top-most (last) ROI at each pixel, & weight image of its alpha
+        labels = np.zeros(height*width, dtype=np.int32) - 1
+        np.maximum.at(labels, self.entry_pixels, self.entry_rois)
+
+        top = labels[self.entry_pixels] == self.entry_rois
+
+        weights = np.zeros(height*width, dtype=np.uint8)
+        weights[self.entry_pixels[top]] = self.entry_alphas[top]
+
+        self.labels  = labels.reshape(self.image_shape)
+        self.weights = weights.reshape(self.image_shape)
+
+        # stored pixels sorted by their position in the image, so the ROIs covering any pixel can be looked up
+        self.pixel_entries = np.argsort(self.entry_pixels, kind='stable')
+        self.pixel_indptr  = np.searchsorted(self.entry_pixels[self.pixel_entries], np.arange(height*width + 1))
+
+        # whether each ROI is removed, & composited overlays of the kept & removed ROIs
+        self.removed         = None
+        self.kept_labels     = np.zeros(height*width, dtype=np.int32) - 1
+        self.removed_labels  = np.zeros(height*width, dtype=np.int32) - 1
+        self.kept_overlay    = np.zeros(self.image_shape + (4,), dtype=np.uint8)
+        self.removed_overlay = np.zeros(self.image_shape + (4,), dtype=np.uint8)
+
+        self.contours = ROIContours(self)
+
+        # (x_min, y_min, x_max, y_max) of each ROI, in footprint coordinates (transposed in the overlay images)
+        self.bounding_boxes = get_roi_bounding_boxes(footprints, video_shape)
+
+        # index of the ROIs covering each pixel, used to find which ROIs are clicked or selected
+        self.index = ROISpatialIndex(footprints, video_shape)
+
+    def __len__(self):
+        return self.n_rois
+
+    def __getitem__(self, key):
+        # overlays[i] gives the (width, height, 4) overlay of ROI i, and overlays[i, ...] indexes into it
+        if isinstance(key, tuple):
+            return self.roi_overlay(key[0])[key[1:]]
+        else:
+            return self.roi_overlay(key)
+
+    def roi_entries(self, roi):
+        return slice(self.indptr[roi], self.indptr[roi+1])
+
+    def roi_pixels(self, roi):
+        return self.entry_pixels[self.roi_entries(roi)]
+
+    def roi_overlay(self, roi):
+        entries = self.roi_entries(roi)
+
+        overlay = np.zeros((self.image_shape[0]*self.image_shape[1], 4), dtype=np.uint8)
+        overlay[self.entry_pixels[entries], :-1] = self.colors[roi]
+        overlay[self.entry_pixels[entries], -1]  = self.entry_alphas[entries]
+
+        return overlay.reshape(self.image_shape + (4,))
+
+    def render(self):
+        '''Renders the overlay of all of the ROIs, with the top-most ROI shown at each pixel.'''
+
+        overlay = np.zeros(self.image_shape + (4,), dtype=np.uint8)
+
+        mask = self.labels >= 0
+
+        overlay[mask, :-1] = self.colors[self.labels[mask]]
+        overlay[mask, -1]  = self.weights[mask]
+
+        return overlay
+
+    def set_removed_rois(self, removed_rois):
+        '''
+        Updates the composited overlays of the kept & removed ROIs.
+
+        Only the pixels of ROIs whose kept/removed status changed since the last update are
+        re-composited, so toggling a single ROI costs time proportional to its footprint.
+        '''
+
+        removed = np.zeros(self.n_rois, dtype=bool)
+        removed[np.asarray(removed_rois, dtype=int)] = True
+
+        if self.removed is None:
+            changed_rois = np.arange(self.n_rois)
+        else:
+            changed_rois = np.nonzero(removed != self.removed)[0]
+
+        self.removed = removed
+
+        if len(changed_rois) > 0:
+            pixels = np.unique(np.concatenate([ self.roi_pixels(roi) for roi in changed_rois ]))
+
+            self.update_pixels(pixels)
+
+    @property
+    def n_kept(self):
+        return 0 if self.removed is None else int(self.n_rois - np.sum(self.removed))
+
+    @property
+    def n_removed(self):
+        return 0 if self.removed is None else int(np.sum(self.removed))
+
+    def update_pixels(self, pixels):
+        # find all of the stored pixels of ROIs that cover these pixels
+        counts  = self.pixel_indptr[pixels + 1] - self.pixel_indptr[pixels]
+        starts  = np.repeat(self.pixel_indptr[pixels] - np.cumsum(counts) + counts, counts)
+        entries = self.pixel_entries[starts + np.arange(np.sum(counts))]
+
+        entry_pixels  = self.entry_pixels[entries]
+        entry_rois    = self.entry_rois[entries]
+        entry_removed = self.removed[entry_rois]
+
+        for labels, overlay, selected in ((self.kept_labels, self.kept_overlay, ~entry_removed), (self.removed_labels, self.removed_overlay, entry_removed)):
+            overlay = overlay.reshape((-1, 4))
+
+            # find the top-most ROI at each pixel
+            labels[pixels] = -1
+            np.maximum.at(labels, entry_pixels[selected], entry_rois[selected])
+
+            # re-draw the pixels using the color & alpha of their top-most ROI
+            top = selected & (labels[entry_pixels] == entry_rois)
+
+            overlay[pixels] = 0
+            overlay[entry_pixels[top], :-1] = self.colors[entry_rois[top]]
+            overlay[entry_pixels[top], -1]  = self.entry_alphas[entries[top]]
+
+    def roi_contours(self, roi):
+        pixels = self.roi_pixels(roi)
+
+        if len(pixels) == 0:
+            return []
+
+        rows = pixels // self.image_shape[1]
+        cols = pixels % self.image_shape[1]
+
+        # find contours in a padded crop around the ROI, offset back to image coordinates
+        top, left = np.amin(rows) - 1, np.amin(cols) - 1
+
+        mask = np.zeros((np.amax(rows) - top + 2, np.amax(cols) - left + 2), dtype=np.uint8)
+        mask[rows - top, cols - left] = 1
+
+        return list(cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(int(left), int(top)))[-2])
+
+    def subset(self, rois):
+        '''Returns the overlays of the given ROIs, keeping their colors and any contours that were already found.'''
+
+        footprints = scipy.sparse.csc_matrix(self.roi_spatial_footprints)[:, rois]
+
+        overlays = ROIOverlays(footprints, self.video_shape, self.colors[rois])
+
+        for i in range(len(rois)):
+            if rois[i] in self.contours.cache.keys():
+                overlays.contours.cache[i] = self.contours.cache[rois[i]]
+
+        return overlays
+
+class ROIContours():
+    '''A list-like view of the contours of each ROI, which are found the first time they are needed.'''
+
+    def __init__(self, overlays):
+        self.overlays = overlays
+        self.cache    = {}
+
+    def __len__(self):
+        return len(self.overlays)
+
+    def __getitem__(self, roi):
+        if roi not in self.cache.keys():
+            self.cache[roi] = self.overlays.roi_contours(roi)
+
+        return self.cache[roi]
+
+def roi_colors(n_rois, cmap, n_colors):
+    '''Returns the (RGB, 0-255) color of each ROI, cycling through the colors of a colormap.'''
+    return np.array([ [ 255*c for c in cmap(i % n_colors)[:3] ] for i in range(n_rois) ])
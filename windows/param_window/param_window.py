@@ -666,6 +666,9 @@ class ParamWindow(QMainWindow):
     def update_roi_finding_progress(self, group_num):
         self.roi_finding_widget.update_roi_finding_progress(group_num)
 
+    def update_roi_finding_plane_progress(self, group_num, z, n_done, n_planes):
+        self.roi_finding_widget.update_roi_finding_plane_progress(group_num, z, n_done, n_planes)
+
     def closeEvent(self, event):
         self.controller.close_all()
 
@@ -148,6 +148,20 @@ class RegressorAnalysisWidget(ParamWidget):
         self.max_p_label = QLabel(str(0.05))
         self.p_slider_layout.addWidget(self.max_p_label)
 
+        self.use_fdr_checkbox = QCheckBox("Control FDR")
+        self.use_fdr_checkbox.setChecked(self.controller.use_fdr)
+        self.use_fdr_checkbox.clicked.connect(self.set_use_fdr)
+        self.p_slider_layout.addWidget(self.use_fdr_checkbox)
+
+        label = QLabel("Shuffles: ")
+        self.p_slider_layout.addWidget(label)
+
+        self.n_shuffles_textbox = QLineEdit()
+        self.n_shuffles_textbox.setText(str(self.controller.n_shuffles))
+        self.n_shuffles_textbox.setFixedWidth(50)
+        self.n_shuffles_textbox.editingFinished.connect(self.set_n_shuffles)
+        self.p_slider_layout.addWidget(self.n_shuffles_textbox)
+
         widget = QWidget()
         self.regressor_correlation_params = QVBoxLayout(widget)
         label = QLabel("Multi-Regressor Params")
@@ -237,7 +251,7 @@ class RegressorAnalysisWidget(ParamWidget):
         self.update_gui()
 
     def load_roi_data(self):
-        roi_data_fnames = QFileDialog.getOpenFileNames(self, 'Select ROI data file(s).', '', 'Numpy files (*.npy)')[0]
+        roi_data_fnames = QFileDialog.getOpenFileNames(self, 'Select ROI data file(s).', '', 'ROI data (*.h5 *.hdf5 *.npy)')[0]
 
         if roi_data_fnames is not None and len(roi_data_fnames) == len(self.controller.calcium_video_fnames):
             self.set_fnames(roi_data_fnames=roi_data_fnames)
@@ -341,6 +355,30 @@ class RegressorAnalysisWidget(ParamWidget):
 
         self.controller.regression_plot_window.update_plots()
 
+    def set_use_fdr(self):
+        self.controller.use_fdr = self.use_fdr_checkbox.isChecked()
+
+        self.controller.regression_plot_window.update_plots()
+
+    def set_n_shuffles(self):
+        try:
+            n_shuffles = max(0, int(self.n_shuffles_textbox.text()))
+        except ValueError:
+            n_shuffles = self.controller.n_shuffles
+
+        self.n_shuffles_textbox.setText(str(n_shuffles))
+
+        if n_shuffles == self.controller.n_shuffles:
+            return
+
+        self.controller.n_shuffles = n_shuffles
+
+        if len(self.controller.calcium_video_fnames) > 0 and len(self.controller.roi_data_fnames) == len(
+                self.controller.calcium_video_fnames) and (
+                len(self.controller.bout_fnames) == len(self.controller.calcium_video_fnames) or len(
+            self.controller.frame_timestamp_fnames) == len(self.controller.calcium_video_fnames)):
+            self.do_regressor_analysis()
+
     def set_z(self, i):
         self.controller.regression_z = int(i)
 
@@ -109,6 +109,11 @@ class ROIFindingWidget(ParamWidget):
             self.parent_widget.set_default_statusbar_message(
                 "Finding ROIs for group {}/{}...".format(group_num + 2, n_groups))
 
+    def update_roi_finding_plane_progress(self, group_num, z, n_done, n_planes):
+        if n_done != n_planes:
+            self.parent_widget.set_default_statusbar_message(
+                "Finding ROIs... found ROIs in plane {} of group {} ({}/{} planes done).".format(z, group_num + 1, n_done, n_planes))
+
     def roi_finding_ended(self):
         self.find_rois_button.setEnabled(True)
         self.draw_mask_button.setEnabled(True)
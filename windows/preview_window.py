@@ -4,6 +4,7 @@ import pyqtgraph as pg
 from matplotlib import cm
 
 from controller import utilities
+from controller.frame_buffer import FrameRingBuffer, PlaybackClock
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -79,8 +80,13 @@ class PreviewWindow(QMainWindow):
         self.main_layout.addWidget(self.pg_widget)
 
         # create left and right image viewboxes
-        self.left_image_viewbox  = self.pg_widget.addViewBox(lockAspect=True, name='left_image', border=None, row=0,col=0, invertY=True)
-        self.right_image_viewbox = self.pg_widget.addViewBox(lockAspect=True, name='right_image', border=None, row=0,col=1, invertY=True)
+        # (shift-dragging in them selects all of the ROIs in a rectangle)
+        self.left_image_viewbox  = RegionSelectViewBox(lockAspect=True, name='left_image', border=None, invertY=True)
+        self.right_image_viewbox = RegionSelectViewBox(lockAspect=True, name='right_image', border=None, invertY=True)
+        self.pg_widget.addItem(self.left_image_viewbox, row=0, col=0)
+        self.pg_widget.addItem(self.right_image_viewbox, row=0, col=1)
+        self.left_image_viewbox.sigRegionSelected.connect(self.region_selected)
+        self.right_image_viewbox.sigRegionSelected.connect(self.region_selected)
         self.left_image_viewbox.setLimits(minXRange=10, minYRange=10, maxXRange=2000, maxYRange=2000)
         self.right_image_viewbox.setLimits(minXRange=10, minYRange=10, maxXRange=2000, maxYRange=2000)
         self.left_image_viewbox.setBackgroundColor(bg_color)
@@ -216,6 +222,12 @@ class PreviewWindow(QMainWindow):
         # create a timer for updating the frames
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_frame)
+
+        # create a thread that reads, adjusts & converts upcoming frames while the video plays
+        self.frame_buffer          = FrameRingBuffer()
+        self.playback_clock        = PlaybackClock(self.controller.gui_params['fps'])
+        self.frame_prefetch_thread = FramePrefetchThread(self, self.frame_buffer, prefetch_frame)
+        self.last_position         = -1
         
         self.set_initial_state()
 
@@ -260,6 +272,7 @@ class PreviewWindow(QMainWindow):
         self.top_widget.hide()
         self.bottom_widget.hide()
         self.timer.stop()
+        self.frame_buffer.reset(0)
         self.setWindowTitle("Preview")
         self.reset_default_statusbar_message()
 
@@ -417,8 +430,8 @@ class PreviewWindow(QMainWindow):
             contours = []
             for i in [roi]:
                 contours += self.controller.roi_contours[i]
-                x = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 0]) for j in range(len(self.controller.roi_contours[i])) ])
-                y = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 1]) for j in range(len(self.controller.roi_contours[i])) ])
+                # bottom-right corner of the ROI in the (transposed) overlay image
+                y, x = self.controller.roi_overlays.bounding_boxes[i, 2:]
                 
                 color = cmap(i % n_colors)[:3]
                 color = [255*color[0], 255*color[1], 255*color[2]]
@@ -437,8 +450,8 @@ class PreviewWindow(QMainWindow):
             for i in [roi]:
                 contours += self.controller.roi_contours[i]
                 
-                x = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 0]) for j in range(len(self.controller.roi_contours[i])) ])
-                y = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 1]) for j in range(len(self.controller.roi_contours[i])) ])
+                # bottom-right corner of the ROI in the (transposed) overlay image
+                y, x = self.controller.roi_overlays.bounding_boxes[i, 2:]
                 
                 color = cmap(i % n_colors)[:3]
                 color = [255*color[0], 255*color[1], 255*color[2]]
@@ -459,6 +472,29 @@ class PreviewWindow(QMainWindow):
                 # Plot cursor on secondary image
                 self.controller.plot_cursor(pos.x(), pos.y(), self.left_image.height(), self.left_image.width())
 
+    def add_roi_outlines(self, rois, viewbox):
+        for i in rois:
+            color = cmap(i % n_colors)[:3]
+            color = [255*color[0], 255*color[1], 255*color[2]]
+
+            for contour in self.controller.roi_contours[i]:
+                outline_item = pg.PlotDataItem(np.concatenate([contour[:, 0, 1], contour[:1, 0, 1]]), np.concatenate([contour[:, 0, 0], contour[:1, 0, 0]]), pen=pg.mkPen(color, width=3))
+                self.outline_items.append(outline_item)
+                viewbox.addItem(outline_item)
+
+    def region_selected(self, viewbox, start, end, modifiers):
+        if self.controller.drawing_mask:
+            return
+
+        self.clear_outline_items()
+
+        # select the kept ROIs in a rectangle on the left image, or the discarded ROIs on the right image
+        removed = viewbox is self.right_image_viewbox
+
+        self.controller.select_rois_in_region([(int(start.y()), int(start.x())), (int(end.y()), int(end.x()))], ctrl_held=bool(modifiers & Qt.ControlModifier), removed=removed)
+
+        self.add_roi_outlines(self.controller.selected_rois, viewbox)
+
     def plot_clicked(self, event):
         # get x-y coordinates of where the user clicked
         items = self.pg_widget.scene().items(event.scenePos())
@@ -497,47 +533,10 @@ class PreviewWindow(QMainWindow):
                         self.controller.selected_rois = []
 
                 if len(self.controller.selected_rois) > 0:
-                    roi_to_select = self.controller.selected_rois[0]
-
                     if self.left_image in items:
-                        image = self.kept_rois_image.copy()
-                        contours = []
-                        for i in self.controller.selected_rois:
-                            contours += self.controller.roi_contours[i]
-                            x = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 0]) for j in range(len(self.controller.roi_contours[i])) ])
-                            y = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 1]) for j in range(len(self.controller.roi_contours[i])) ])
-                            
-                            color = cmap(i % n_colors)[:3]
-                            color = [255*color[0], 255*color[1], 255*color[2]]
-
-                            # text_item = pg.TextItem("{}".format(i), color=color)
-                            # text_item.setPos(QPoint(int(y), int(x)))
-                            # self.text_items.append(text_item)
-                            # self.left_image_viewbox.addItem(text_item)
-                            for j in range(len(self.controller.roi_contours[i])):
-                                outline_item = pg.PlotDataItem(np.concatenate([self.controller.roi_contours[i][j][:, 0, 1], np.array([self.controller.roi_contours[i][j][0, 0, 1]])]), np.concatenate([self.controller.roi_contours[i][j][:, 0, 0], np.array([self.controller.roi_contours[i][j][0, 0, 0]])]), pen=pg.mkPen(color, width=3))
-                                self.outline_items.append(outline_item)
-                                self.left_image_viewbox.addItem(outline_item)
+                        self.add_roi_outlines(self.controller.selected_rois, self.left_image_viewbox)
                     else:
-                        image = self.removed_rois_image.copy()
-                        contours = []
-                        for i in self.controller.selected_rois:
-                            contours += self.controller.roi_contours[i]
-                            # print([ self.controller.roi_contours[i][j].shape for j in range(len(self.controller.roi_contours[i])) ])
-                            x = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 0]) for j in range(len(self.controller.roi_contours[i])) ])
-                            y = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 1]) for j in range(len(self.controller.roi_contours[i])) ])
-                            
-                            color = cmap(i % n_colors)[:3]
-                            color = [255*color[0], 255*color[1], 255*color[2]]
-
-                            # text_item = pg.TextItem("{}".format(i), color=color)
-                            # text_item.setPos(QPoint(int(y), int(x)))
-                            # self.text_items.append(text_item)
-                            # self.right_image_viewbox.addItem(text_item)
-                            for j in range(len(self.controller.roi_contours[i])):
-                                outline_item = pg.PlotDataItem(np.concatenate([self.controller.roi_contours[i][j][:, 0, 1], np.array([self.controller.roi_contours[i][j][0, 0, 1]])]), np.concatenate([self.controller.roi_contours[i][j][:, 0, 0], np.array([self.controller.roi_contours[i][j][0, 0, 0]])]), pen=pg.mkPen(color, width=3))
-                                self.outline_items.append(outline_item)
-                                self.right_image_viewbox.addItem(outline_item)
+                        self.add_roi_outlines(self.controller.selected_rois, self.right_image_viewbox)
             elif self.left_image in items:
                 if ctrl_held:
                     # add mask point
@@ -661,12 +660,20 @@ class PreviewWindow(QMainWindow):
         self.frame_num = 0
 
         # get the number of frames
-        self.n_frames = self.controller.adjusted_video.shape[0]
+        self.n_frames = self.controller.video.shape[0]
+
+        # start reading frames from the beginning of the video
+        self.frame_buffer.reset(0, self.n_frames, source=self.frame_source())
+        self.playback_clock.start(self.controller.gui_params['fps'])
+        self.last_position = -1
+
+        if not self.frame_prefetch_thread.isRunning():
+            self.frame_prefetch_thread.start()
 
         # start the timer to update the frames
         self.timer.start(int(1000.0/self.controller.gui_params['fps']))
 
-        self.kept_traces_viewbox.setXRange(0, self.controller.adjusted_video.shape[0])
+        self.kept_traces_viewbox.setXRange(0, self.controller.video.shape[0])
 
         self.create_text_items()
 
@@ -683,22 +690,49 @@ class PreviewWindow(QMainWindow):
     def set_fps(self, fps):
         # restart the timer with the new fps
         self.timer.stop()
+        self.playback_clock.set_fps(fps)
         self.timer.start(int(1000.0/fps))
 
+    def refresh_frames(self):
+        # discard frames that have already been read (eg. with an old contrast or gamma)
+        self.frame_buffer.reset(self.playback_clock.position(), self.n_frames, source=self.frame_source())
+
+    def frame_source(self):
+        # snapshot of the video, z plane & lookup table that the prefetch thread reads frames with -- it's
+        # taken here on the GUI thread, so the thread never reads controller state while it is being changed
+        if self.controller.video is None:
+            return None
+
+        self.controller.update_contrast_lut()
+
+        return (self.controller.video, self.controller.z, self.controller.contrast_lut)
+
     def show_frame(self, frame):
         self.update_left_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
         self.update_right_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
 
     def update_frame(self):
-        if self.controller.adjusted_video is not None:
-            frame = self.controller.adjusted_video[self.frame_num]
+        if self.controller.video is not None:
+            # get the position that playback should be at by now
+            position = self.playback_clock.position()
+
+            if position == self.last_position:
+                return
+
+            self.last_position = position
+
+            # get the prefetched frame -- if it isn't ready yet, it's dropped rather than waiting for it
+            frame = self.frame_buffer.take(position)
+
+            if frame is None:
+                return
+
+            self.frame_num = position % self.n_frames
 
             self.update_left_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
             self.update_right_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
 
-            # increment frame number (keeping it between 0 and n_frames)
-            self.frame_num += 1
-            self.frame_num = self.frame_num % self.n_frames
+            self.playback_clock.frame_shown()
 
             self.current_frame_line_1.setValue(self.frame_num + self.controller.frame_offset)
             self.current_frame_line_2.setValue(self.frame_num + self.controller.frame_offset)
@@ -706,11 +740,13 @@ class PreviewWindow(QMainWindow):
 
             if not self.item_hovered:
                 # update status bar
-                self.set_default_statusbar_message("Viewing {}. Z={}. Frame {}/{}.".format(self.video_name, self.controller.z, self.frame_num + 1, self.n_frames))
+                self.set_default_statusbar_message("Viewing {}. Z={}. Frame {}/{}. {:.1f}/{:.1f} FPS.".format(self.video_name, self.controller.z, self.frame_num + 1, self.n_frames, self.playback_clock.achieved_fps(), self.playback_clock.fps))
 
     def update_left_image_plot(self, image, roi_spatial_footprints=None, video_dimensions=None, removed_rois=None, selected_rois=None, show_rois=False):
-        image = 255.0*image/self.controller.video_max
-        image[image > 255] = 255
+        # frames adjusted with the contrast lookup table are already scaled to uint8
+        if image.dtype != np.uint8:
+            image = 255.0*image/self.controller.video_max
+            image[image > 255] = 255
 
         if len(image.shape) < 3:
             image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_GRAY2RGB)
@@ -798,8 +834,10 @@ class PreviewWindow(QMainWindow):
         self.right_image.setImage(image, autoLevels=False)
 
     def update_right_image_plot(self, image, roi_spatial_footprints=None, video_dimensions=None, removed_rois=None, selected_rois=None, show_rois=False):
-        image = 255.0*image/self.controller.video_max
-        image[image > 255] = 255
+        # frames adjusted with the contrast lookup table are already scaled to uint8
+        if image.dtype != np.uint8:
+            image = 255.0*image/self.controller.video_max
+            image[image > 255] = 255
 
         if len(image.shape) < 3:
             image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_GRAY2RGB)
@@ -834,6 +872,10 @@ class PreviewWindow(QMainWindow):
         if not self.controller.closing:
             ce.ignore()
         else:
+            # stop the prefetch thread
+            self.frame_buffer.stop()
+            self.frame_prefetch_thread.wait()
+
             ce.accept()
 
 class HoverCheckBox(QCheckBox):
@@ -886,3 +928,68 @@ def HLine():
     frame.setStyleSheet("color: rgba(0, 0, 0, 0.2);")
 
     return frame
+
+class RegionSelectViewBox(pg.ViewBox):
+    # emitted with the viewbox, the start & end points of the rectangle (in view coordinates) and the keyboard modifiers
+    sigRegionSelected = pyqtSignal(object, object, object, object)
+
+    def __init__(self, *args, **kwargs):
+        pg.ViewBox.__init__(self, *args, **kwargs)
+
+        self.region_item = None
+
+    def mouseDragEvent(self, ev, axis=None):
+        if ev.button() != Qt.LeftButton or not (ev.modifiers() & Qt.ShiftModifier):
+            pg.ViewBox.mouseDragEvent(self, ev, axis=axis)
+            return
+
+        ev.accept()
+
+        start = self.mapSceneToView(ev.buttonDownScenePos())
+        end   = self.mapSceneToView(ev.scenePos())
+
+        # draw the rectangle while dragging
+        if self.region_item is None:
+            self.region_item = pg.PlotDataItem(pen=pg.mkPen((255, 255, 255), style=Qt.DashLine))
+            self.addItem(self.region_item)
+
+        self.region_item.setData([start.x(), end.x(), end.x(), start.x(), start.x()], [start.y(), start.y(), end.y(), end.y(), start.y()])
+
+        if ev.isFinish():
+            self.removeItem(self.region_item)
+            self.region_item = None
+
+            self.sigRegionSelected.emit(self, start, end, ev.modifiers())
+
+def prefetch_frame(source, frame_num):
+    # called by the prefetch thread -- returns a contrast-adjusted RGB frame that is ready to display
+    video, z, contrast_lut = source
+
+    return cv2.cvtColor(contrast_lut(video[frame_num, z, :, :]), cv2.COLOR_GRAY2RGB)
+
+class FramePrefetchThread(QThread):
+    def __init__(self, parent, frame_buffer, read_frame):
+        QThread.__init__(self, parent)
+
+        self.frame_buffer = frame_buffer
+        self.read_frame   = read_frame
+
+    def run(self):
+        while True:
+            # wait until there's a video to read from and room in the buffer
+            request = self.frame_buffer.next_request()
+
+            if request is None:
+                break
+
+            generation, position, frame_num, source = request
+
+            try:
+                image = self.read_frame(source, frame_num)
+            except Exception as e:
+                print("Error reading frame {}: {}".format(frame_num, e))
+
+                # don't retry the read in a tight loop
+                self.msleep(10)
+            else:
+                self.frame_buffer.put(generation, position, image)
@@ -87,7 +87,7 @@ class RegressionPlotWindow(QMainWindow):
             if selected_regressors is None:
                 selected_regressors = self.controller.regressors
 
-            self.left_plot_canvas.plot_correlation(self.controller.correlation_results, self.controller.regressors, self.controller.spatial_footprints, self.controller.temporal_footprints, self.controller.calcium_video, self.controller.regressor_mean_images, self.controller.n_frames, self.controller.roi_centers, self.controller.regression_z, self.controller.max_p, self.controller.regressor_index)
+            self.left_plot_canvas.plot_correlation(self.controller.correlation_results, self.controller.regressors, self.controller.spatial_footprints, self.controller.temporal_footprints, self.controller.calcium_video, self.controller.regressor_mean_images, self.controller.n_frames, self.controller.roi_centers, self.controller.regression_z, self.controller.max_p, self.controller.regressor_index, fdr=self.controller.use_fdr)
             self.right_plot_canvas.plot_multilinear_regression(self.controller.regression_coefficients, self.controller.regression_intercepts, self.controller.regression_scores, selected_regressors, self.controller.spatial_footprints, self.controller.temporal_footprints, self.controller.calcium_video, self.controller.regressor_mean_images, self.controller.n_frames, self.controller.roi_centers, self.controller.regression_z)
         else:
             self.left_plot_canvas.clear_plot()
@@ -114,10 +114,10 @@ class PlotCanvas(FigureCanvas):
         self.fig.clear()
         self.draw()
 
-    def plot_correlation(self, correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index):
+    def plot_correlation(self, correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index, fdr=False):
         self.fig.clear()
 
-        plot_correlation(correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index, fig=self.fig)
+        plot_correlation(correlation_results, regressors, spatial_footprints, temporal_footprints, calcium_video, mean_images, n_frames, roi_centers, z, max_p, regressor_index, fig=self.fig, fdr=fdr)
 
         self.draw()
 